@@ -1,7 +1,14 @@
 from flask import Flask, render_template, request, jsonify, send_file
-import sqlite3, json, os, re, math
+import click
+import sqlite3, json, os, re, time, threading, queue, atexit, base64, zlib, hashlib, csv, io, string, contextvars, asyncio, html, math, random
 from datetime import datetime
-import urllib.request, urllib.error
+from functools import partial
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -12,25 +19,72 @@ app = Flask(
 )
 
 # No Render o disco persistente fica em /data.
-# Localmente (Windows/Linux) usa a pasta db/ do projeto.
-if os.environ.get('RENDER') and os.path.isdir('/data'):
+# Localmente (Windows/Linux) usa a pasta db/ do projeto; DATA_DIR aponta outra (ex.: testes).
+if os.environ.get('DATA_DIR'):
+    DATA_DIR = os.environ['DATA_DIR']
+elif os.environ.get('RENDER') and os.path.isdir('/data'):
     DATA_DIR = '/data'
 else:
     DATA_DIR = os.path.join(BASE_DIR, 'db')
 
 DB_DIR  = DATA_DIR
 DB_PATH = os.path.join(DATA_DIR, 'credito.db')
+LOG_RETENTION_DAYS = int(os.environ.get('LOG_RETENTION_DAYS', 30))
 
 # ─────────────────────────────────────────
 # DATABASE
 # ─────────────────────────────────────────
+# Uma conexão por thread (threads do gunicorn, pools de fetch e de jobs),
+# aberta uma vez com os pragmas abaixo; o sqlite3 guarda os statements
+# preparados por conexão. Quem chama get_db() não fecha: release_db() desfaz
+# qualquer transação esquecida no fim do request ou de uma etapa que falhou.
+DB_BUSY_TIMEOUT_MS   = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+DB_CACHE_KB          = int(os.environ.get('DB_CACHE_KB', 16 * 1024))
+DB_MMAP_BYTES        = int(os.environ.get('DB_MMAP_BYTES', 128 * 1024 * 1024))
+DB_CACHED_STATEMENTS = 256
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA foreign_keys=ON",
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+    f"PRAGMA cache_size=-{DB_CACHE_KB}",
+    f"PRAGMA mmap_size={DB_MMAP_BYTES}",
+    "PRAGMA temp_store=MEMORY",
+)
+DB_USER_VERSION = 1   # 1: dados_json migrado para payloads
+_db_local = threading.local()
+
+# Processo filho da simulação de política (simulacao.iniciar, ou este arquivo
+# reimportado pelo spawn como __mp_main__): só lê o banco que o servidor já
+# preparou, sem init_db nem tarefas de subida.
+PROCESSO_FILHO = bool(os.environ.get('CREDITOIA_FILHO')) or __name__ == '__mp_main__'
+
 def get_db():
-    os.makedirs(DB_DIR, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
+    conn = getattr(_db_local, 'conn', None)
+    # pid: uma conexão herdada num fork (gunicorn --preload) não pode ser reutilizada.
+    if conn is None or _db_local.pid != os.getpid():
+        os.makedirs(DB_DIR, exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               cached_statements=DB_CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        if PROCESSO_FILHO:
+            conn.execute("PRAGMA query_only=ON")
+        _db_local.conn, _db_local.pid = conn, os.getpid()
     return conn
 
+@app.teardown_appcontext
+def release_db(exc=None):
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and _db_local.pid == os.getpid() and conn.in_transaction:
+        conn.rollback()
+
+def add_column(conn, table, column, decl):
+    """ALTER TABLE ... ADD COLUMN só se a coluna ainda não existir (migração de bancos antigos)."""
+    if column not in {r['name'] for r in conn.execute(f"PRAGMA table_info({table})")}:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
 def init_db():
     from datetime import datetime
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -38,9 +92,6 @@ def init_db():
     cur  = conn.cursor()
 
     cur.executescript("""
-        PRAGMA journal_mode=WAL;
-        PRAGMA foreign_keys=ON;
-
         CREATE TABLE IF NOT EXISTS consultas (
             id                    INTEGER PRIMARY KEY AUTOINCREMENT,
             cnpj                  TEXT NOT NULL,
@@ -130,13 +181,216 @@ def init_db():
             FOREIGN KEY (consulta_id) REFERENCES consultas(id) ON DELETE CASCADE
         );
 
+        CREATE TABLE IF NOT EXISTS cache_fontes (
+            fonte      TEXT NOT NULL,
+            chave      TEXT NOT NULL,
+            payload    TEXT NOT NULL,
+            obtido_em  REAL NOT NULL,
+            PRIMARY KEY (fonte, chave)
+        );
+
+        CREATE TABLE IF NOT EXISTS rate_buckets (
+            provedor       TEXT PRIMARY KEY,
+            tokens         REAL NOT NULL,
+            atualizado_em  REAL NOT NULL,
+            bloqueado_ate  REAL NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS fetch_leases (
+            fonte      TEXT NOT NULL,
+            chave      TEXT NOT NULL,
+            dono       TEXT NOT NULL,
+            expira_em  REAL NOT NULL,
+            PRIMARY KEY (fonte, chave)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS cache_ia (
+            chave      TEXT PRIMARY KEY,
+            modelo     TEXT NOT NULL,
+            resposta   TEXT NOT NULL,
+            criado_em  REAL NOT NULL,
+            expira_em  REAL NOT NULL,
+            usado_em   REAL NOT NULL,
+            acessos    INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_cache_ia_usado ON cache_ia(usado_em);
+
+        CREATE TABLE IF NOT EXISTS analise_jobs (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            status      TEXT NOT NULL DEFAULT 'pendente',
+            etapa       TEXT,
+            progresso   INTEGER DEFAULT 0,
+            tentativas  INTEGER DEFAULT 0,
+            parametros  TEXT NOT NULL,
+            estado      TEXT,
+            consulta_id INTEGER,
+            erro        TEXT,
+            created_at  TEXT,
+            updated_at  TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS job_eventos (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id     INTEGER NOT NULL,
+            tipo       TEXT NOT NULL,
+            dados      TEXT,
+            created_at TEXT
+        );
+
+        -- Agregados por dia/UF/porte/risco mantidos pelos triggers abaixo:
+        -- /api/stats lê só esta tabela, não importa o tamanho de consultas.
+        CREATE TABLE IF NOT EXISTS stats_resumo (
+            dia              TEXT NOT NULL,
+            uf               TEXT NOT NULL,
+            porte            TEXT NOT NULL,
+            risco            TEXT NOT NULL,
+            total            INTEGER NOT NULL DEFAULT 0,
+            soma_score       INTEGER NOT NULL DEFAULT 0,
+            soma_solicitado  REAL NOT NULL DEFAULT 0,
+            soma_sugerido    REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, uf, porte, risco)
+        );
+
+        CREATE TRIGGER IF NOT EXISTS trg_stats_insert AFTER INSERT ON consultas
+        BEGIN
+            INSERT INTO stats_resumo (dia, uf, porte, risco, total, soma_score, soma_solicitado, soma_sugerido)
+            VALUES (COALESCE(substr(NEW.created_at, 1, 10), ''), COALESCE(NEW.uf, ''),
+                    COALESCE(NEW.porte_empresa, ''), COALESCE(NEW.risco, ''), 1,
+                    COALESCE(NEW.score_empresa, 0), COALESCE(NEW.valor_solicitado, 0),
+                    COALESCE(NEW.valor_sugerido, 0))
+            ON CONFLICT (dia, uf, porte, risco) DO UPDATE SET
+                total           = total + 1,
+                soma_score      = soma_score + excluded.soma_score,
+                soma_solicitado = soma_solicitado + excluded.soma_solicitado,
+                soma_sugerido   = soma_sugerido + excluded.soma_sugerido;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_stats_delete AFTER DELETE ON consultas
+        BEGIN
+            UPDATE stats_resumo SET
+                total           = total - 1,
+                soma_score      = soma_score - COALESCE(OLD.score_empresa, 0),
+                soma_solicitado = soma_solicitado - COALESCE(OLD.valor_solicitado, 0),
+                soma_sugerido   = soma_sugerido - COALESCE(OLD.valor_sugerido, 0)
+            WHERE dia = COALESCE(substr(OLD.created_at, 1, 10), '') AND uf = COALESCE(OLD.uf, '')
+              AND porte = COALESCE(OLD.porte_empresa, '') AND risco = COALESCE(OLD.risco, '');
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_stats_update
+        AFTER UPDATE OF created_at, uf, porte_empresa, risco, score_empresa, valor_solicitado, valor_sugerido
+        ON consultas
+        BEGIN
+            UPDATE stats_resumo SET
+                total           = total - 1,
+                soma_score      = soma_score - COALESCE(OLD.score_empresa, 0),
+                soma_solicitado = soma_solicitado - COALESCE(OLD.valor_solicitado, 0),
+                soma_sugerido   = soma_sugerido - COALESCE(OLD.valor_sugerido, 0)
+            WHERE dia = COALESCE(substr(OLD.created_at, 1, 10), '') AND uf = COALESCE(OLD.uf, '')
+              AND porte = COALESCE(OLD.porte_empresa, '') AND risco = COALESCE(OLD.risco, '');
+            INSERT INTO stats_resumo (dia, uf, porte, risco, total, soma_score, soma_solicitado, soma_sugerido)
+            VALUES (COALESCE(substr(NEW.created_at, 1, 10), ''), COALESCE(NEW.uf, ''),
+                    COALESCE(NEW.porte_empresa, ''), COALESCE(NEW.risco, ''), 1,
+                    COALESCE(NEW.score_empresa, 0), COALESCE(NEW.valor_solicitado, 0),
+                    COALESCE(NEW.valor_sugerido, 0))
+            ON CONFLICT (dia, uf, porte, risco) DO UPDATE SET
+                total           = total + 1,
+                soma_score      = soma_score + excluded.soma_score,
+                soma_solicitado = soma_solicitado + excluded.soma_solicitado,
+                soma_sugerido   = soma_sugerido + excluded.soma_sugerido;
+        END;
+
+        -- Análise em lote (carteiras): um lote e seus itens, um por CNPJ.
+        CREATE TABLE IF NOT EXISTS lotes (
+            id            INTEGER PRIMARY KEY AUTOINCREMENT,
+            status        TEXT NOT NULL DEFAULT 'pendente',
+            usar_ia       INTEGER DEFAULT 0,
+            origem        TEXT,
+            total         INTEGER DEFAULT 0,
+            duracao_s     REAL DEFAULT 0,
+            created_at    TEXT,
+            updated_at    TEXT,
+            concluido_em  TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS lote_itens (
+            id                INTEGER PRIMARY KEY AUTOINCREMENT,
+            lote_id           INTEGER NOT NULL,
+            linha             INTEGER,
+            cnpj              TEXT NOT NULL,
+            valor_solicitado  REAL,
+            parcelas          INTEGER,
+            juros             REAL,
+            status            TEXT NOT NULL DEFAULT 'pendente',
+            consulta_id       INTEGER,
+            erro              TEXT,
+            FOREIGN KEY (lote_id) REFERENCES lotes(id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_lote_itens_status ON lote_itens(lote_id, status, id);
+
+        -- Políticas de score versionadas (ver ScorePolicy). Uma 'ativa', no
+        -- máximo uma 'desafiante' (recebe `percentual` dos CNPJs); versões
+        -- gravadas não mudam, só o status.
+        CREATE TABLE IF NOT EXISTS politicas_score (
+            versao      INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome        TEXT,
+            regras      TEXT NOT NULL,
+            status      TEXT NOT NULL DEFAULT 'inativa',
+            percentual  INTEGER DEFAULT 0,
+            created_at  TEXT
+        );
+
+        -- Simulações pedidas pela API (rodam em segundo plano; ver simulate_policy).
+        CREATE TABLE IF NOT EXISTS simulacoes (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            status      TEXT NOT NULL DEFAULT 'pendente',
+            parametros  TEXT NOT NULL,
+            resultado   TEXT,
+            erro        TEXT,
+            created_at  TEXT,
+            updated_at  TEXT
+        );
+
+        -- A versão da configuração saiu do banco (ver CONFIG_SINAL).
+        DROP TRIGGER IF EXISTS trg_config_insert;
+        DROP TRIGGER IF EXISTS trg_config_update;
+        DROP TRIGGER IF EXISTS trg_config_delete;
+        DROP TABLE IF EXISTS config_versao;
+
+        -- Payloads das consultas (empresa, judicial, social, IA, score), fora da
+        -- linha principal: comprimidos e endereçados pelo conteúdo.
+        CREATE TABLE IF NOT EXISTS payloads (
+            hash     TEXT PRIMARY KEY,
+            codec    TEXT NOT NULL,
+            tamanho  INTEGER NOT NULL,
+            dados    BLOB NOT NULL
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS consulta_payloads (
+            consulta_id  INTEGER NOT NULL,
+            parte        TEXT NOT NULL,
+            hash         TEXT NOT NULL,
+            PRIMARY KEY (consulta_id, parte)
+        ) WITHOUT ROWID;
+
+        CREATE TRIGGER IF NOT EXISTS trg_payloads_delete AFTER DELETE ON consultas
+        BEGIN
+            DELETE FROM consulta_payloads WHERE consulta_id = OLD.id;
+        END;
+
+        -- Listagem paginada por (created_at, id): ver list_consultas().
+        DROP INDEX IF EXISTS idx_consultas_risco;
+        DROP INDEX IF EXISTS idx_consultas_created;
         CREATE INDEX IF NOT EXISTS idx_consultas_cnpj     ON consultas(cnpj);
-        CREATE INDEX IF NOT EXISTS idx_consultas_risco    ON consultas(risco);
-        CREATE INDEX IF NOT EXISTS idx_consultas_created  ON consultas(created_at);
+        CREATE INDEX IF NOT EXISTS idx_consultas_created_id    ON consultas(created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_consultas_risco_created ON consultas(risco, created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_consultas_uf_created    ON consultas(uf, created_at, id);
         CREATE INDEX IF NOT EXISTS idx_socios_consulta    ON socios(consulta_id);
         CREATE INDEX IF NOT EXISTS idx_processos_consulta ON processos(consulta_id);
         CREATE INDEX IF NOT EXISTS idx_logs_consulta      ON api_logs(consulta_id);
         CREATE INDEX IF NOT EXISTS idx_logs_api           ON api_logs(api_name);
+        CREATE INDEX IF NOT EXISTS idx_logs_created       ON api_logs(created_at);
+        CREATE INDEX IF NOT EXISTS idx_jobs_status        ON analise_jobs(status);
+        CREATE INDEX IF NOT EXISTS idx_eventos_job        ON job_eventos(job_id, id);
     """)
 
     apis = [
@@ -155,18 +409,281 @@ def init_db():
             (*a, now)
         )
 
+    add_column(conn, 'consultas', 'politica_versao', 'INTEGER')
+    add_column(conn, 'analise_jobs', 'retomadas', 'INTEGER DEFAULT 0')
+
+    conn.commit()
+    rebuild_stats(conn)
+    # Migração de dados, uma vez por banco: PRAGMA user_version guarda a última
+    # feita (o esquema acima é idempotente e roda sempre). O que sobrar de
+    # dados_json depois disso fica para `flask migrar-payloads`.
+    if conn.execute("PRAGMA user_version").fetchone()[0] < DB_USER_VERSION:
+        migrate_payloads(conn)
+        conn.execute(f"PRAGMA user_version = {DB_USER_VERSION}")
+    init_search(conn)
+
+    log_cutoff = datetime.fromtimestamp(time.time() - LOG_RETENTION_DAYS * 86400).strftime('%Y-%m-%d %H:%M:%S')
+    cur.execute("DELETE FROM api_logs WHERE created_at < ?", (log_cutoff,))
+
     conn.commit()
-    conn.close()
 
-init_db()
+def rebuild_stats(conn):
+    """
+    Recria stats_resumo a partir de consultas se os totais não baterem
+    (banco anterior aos triggers). Roda na subida; o resto do tempo os
+    triggers mantêm a tabela.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    n_consultas = conn.execute("SELECT COUNT(*) FROM consultas").fetchone()[0]
+    n_resumo = conn.execute("SELECT COALESCE(SUM(total), 0) FROM stats_resumo").fetchone()[0]
+    if n_consultas != n_resumo:
+        conn.execute("DELETE FROM stats_resumo")
+        conn.execute("""
+            INSERT INTO stats_resumo (dia, uf, porte, risco, total, soma_score, soma_solicitado, soma_sugerido)
+            SELECT COALESCE(substr(created_at, 1, 10), ''), COALESCE(uf, ''), COALESCE(porte_empresa, ''),
+                   COALESCE(risco, ''), COUNT(*), COALESCE(SUM(score_empresa), 0),
+                   COALESCE(SUM(valor_solicitado), 0), COALESCE(SUM(valor_sugerido), 0)
+            FROM consultas
+            GROUP BY 1, 2, 3, 4
+        """)
+    conn.commit()
 
 # ─────────────────────────────────────────
-# HELPERS
+# PAYLOADS DAS CONSULTAS
 # ─────────────────────────────────────────
-def get_api_config():
+# Cada parte do antigo dados_json (company, judicial, social, ai, ia_usada,
+# score) vira um blob zlib em `payloads`, com chave = sha256 do JSON canônico:
+# a mesma resposta de fonte gravada duas vezes ocupa espaço uma vez só.
+# `consulta_payloads` liga a consulta às suas partes; nada disso é lido na
+# listagem, só quando o relatório/PDF é aberto.
+PAYLOAD_CODEC = 'zlib'
+PAYLOAD_LEVEL = 6
+
+def encode_dados(dados):
+    """Serializa e comprime as partes (fora de transação): [(parte, hash, tamanho, blob)]."""
+    partes = []
+    for parte, valor in dados.items():
+        raw = json.dumps(valor, ensure_ascii=False, sort_keys=True).encode()
+        partes.append((parte, hashlib.sha256(raw).hexdigest(), len(raw), zlib.compress(raw, PAYLOAD_LEVEL)))
+    return partes
+
+def write_dados(conn, consulta_id, partes):
+    """Grava partes já codificadas (encode_dados) na transação de quem chamou."""
+    write_dados_many(conn, [(consulta_id, partes)])
+
+def write_dados_many(conn, itens):
+    """write_dados de várias consultas, [(consulta_id, partes)], em dois executemany."""
+    conn.executemany("INSERT OR IGNORE INTO payloads (hash, codec, tamanho, dados) VALUES (?,?,?,?)",
+                     [(h, PAYLOAD_CODEC, tamanho, blob) for _, partes in itens for _, h, tamanho, blob in partes])
+    conn.executemany("INSERT OR REPLACE INTO consulta_payloads (consulta_id, parte, hash) VALUES (?,?,?)",
+                     [(cid, parte, h) for cid, partes in itens for parte, h, _, _ in partes])
+
+def store_dados(conn, consulta_id, dados):
+    """Grava as partes de `dados` na transação de quem chamou."""
+    write_dados(conn, consulta_id, encode_dados(dados))
+
+def load_dados(conn, consulta_id, partes=None):
+    """
+    Dados completos da consulta (ou só as `partes` pedidas). Linhas ainda não
+    migradas caem no dados_json legado.
+    """
+    sql = """SELECT cp.parte, p.codec, p.dados FROM consulta_payloads cp
+             JOIN payloads p ON p.hash = cp.hash WHERE cp.consulta_id = ?"""
+    args = [consulta_id]
+    if partes:
+        sql += f" AND cp.parte IN ({','.join('?' * len(partes))})"
+        args += list(partes)
+    rows = conn.execute(sql, args).fetchall()
+    if rows:
+        return {r['parte']: json.loads(zlib.decompress(r['dados'])) for r in rows}
+    legado = conn.execute("SELECT dados_json FROM consultas WHERE id=?", (consulta_id,)).fetchone()
+    if not legado or not legado['dados_json']:
+        return {}
+    dados = json.loads(legado['dados_json'])
+    return {k: v for k, v in dados.items() if not partes or k in partes}
+
+def iter_dados(conn, partes, batch=2000, where='1=1', args=()):
+    """
+    Percorre as consultas em blocos de `batch` (por id), devolvendo listas de
+    (linha de consultas, dados) só com as `partes` pedidas. Blobs repetidos
+    (mesmo hash) são descomprimidos uma vez por bloco. Memória constante.
+    """
+    ultimo = 0
+    marcas = ','.join('?' * len(partes))
+    while True:
+        linhas = conn.execute(f"""
+            SELECT id, valor_solicitado, score_empresa, risco, valor_sugerido, dados_json
+            FROM consultas WHERE id > ? AND ({where}) ORDER BY id LIMIT ?
+        """, (ultimo, *args, batch)).fetchall()
+        if not linhas:
+            return
+        dados = {r['id']: {} for r in linhas}
+        blobs = {}
+        for r in conn.execute(f"""
+            SELECT cp.consulta_id, cp.parte, cp.hash, p.dados FROM consulta_payloads cp
+            JOIN payloads p ON p.hash = cp.hash
+            WHERE cp.consulta_id BETWEEN ? AND ? AND cp.parte IN ({marcas})
+        """, (linhas[0]['id'], linhas[-1]['id'], *partes)):
+            if r['consulta_id'] in dados:
+                if r['hash'] not in blobs:
+                    blobs[r['hash']] = json.loads(zlib.decompress(r['dados']))
+                dados[r['consulta_id']][r['parte']] = blobs[r['hash']]
+        for r in linhas:
+            if not dados[r['id']] and r['dados_json']:
+                legado = json.loads(r['dados_json'])
+                dados[r['id']] = {k: legado.get(k) for k in partes}
+        yield [(r, dados[r['id']]) for r in linhas]
+        ultimo = linhas[-1]['id']
+
+def migrate_payloads(conn, batch=200):
+    """
+    Move o dados_json das linhas antigas para `payloads`, em lotes curtos
+    (idempotente: só pega linhas com dados_json ainda preenchido).
+    Retorna quantas consultas migrou.
+    """
+    total, ultimo = 0, 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute("""SELECT id, dados_json FROM consultas
+                               WHERE id > ? AND dados_json IS NOT NULL ORDER BY id LIMIT ?""",
+                            (ultimo, batch)).fetchall()
+        for r in rows:
+            ultimo = r['id']
+            try:
+                store_dados(conn, r['id'], json.loads(r['dados_json']))
+            except ValueError:
+                print(f"Consulta {r['id']}: dados_json inválido, mantido como está")
+                continue
+            conn.execute("UPDATE consultas SET dados_json = NULL WHERE id=?", (r['id'],))
+            total += 1
+        conn.commit()
+        if len(rows) < batch:
+            return total
+
+# ─────────────────────────────────────────
+# BUSCA TEXTUAL (FTS5)
+# ─────────────────────────────────────────
+# Uma linha por consulta (rowid = consultas.id) com empresa, sócios e o texto
+# da IA. Mantida pelo Python em stage_gravacao; o backfill de bancos antigos é
+# o comando `flask --app app reindexar-busca`. Sem trigger em consultas: a busca
+# faz JOIN com consultas, então linhas apagadas simplesmente não aparecem.
+SEARCH_ENABLED = False
+SEARCH_WEIGHTS = (10.0, 6.0, 8.0, 5.0, 1.0)   # razao_social, nome_fantasia, cnpj, socios, analise
+# highlight()/snippet() marcam os termos com caracteres de controle; o texto é
+# escapado e só então eles viram <mark> (nomes e análise podem conter HTML).
+_HL_INI, _HL_FIM = '\x02', '\x03'
+SEARCH_HL_CAMPOS = ('razao_social_hl', 'socios_trecho', 'analise_trecho')
+
+def init_search(conn):
+    global SEARCH_ENABLED
+    try:
+        conn.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS busca_fts USING fts5(
+                razao_social, nome_fantasia, cnpj, socios, analise,
+                tokenize = 'unicode61 remove_diacritics 2'
+            );
+        """)
+        SEARCH_ENABLED = True
+    except sqlite3.OperationalError as e:
+        print(f"Busca textual indisponível (SQLite sem FTS5): {e}")
+
+def index_consulta(conn, consulta_id, company_data, socios, analise):
+    """Grava/atualiza a linha da consulta no índice, na transação de quem chamou."""
+    if not SEARCH_ENABLED:
+        return
+    conn.execute("""
+        INSERT OR REPLACE INTO busca_fts (rowid, razao_social, nome_fantasia, cnpj, socios, analise)
+        VALUES (?,?,?,?,?,?)
+    """, (
+        consulta_id,
+        company_data.get('razao_social', ''),
+        company_data.get('nome_fantasia', ''),
+        company_data.get('cnpj', ''),
+        '\n'.join(n for n in socios if n),
+        analise or '',
+    ))
+
+def reindex_search(batch=500):
+    """Reconstrói o índice a partir de consultas + socios. Retorna quantas linhas indexou."""
+    conn = get_db()
+    conn.execute("DELETE FROM busca_fts")
+    total, ultimo = 0, 0
+    while True:
+        rows = conn.execute("""
+            SELECT c.id, c.razao_social, c.nome_fantasia, c.cnpj,
+                   (SELECT group_concat(nome, char(10)) FROM socios s WHERE s.consulta_id = c.id) AS socios
+            FROM consultas c WHERE c.id > ? ORDER BY c.id LIMIT ?
+        """, (ultimo, batch)).fetchall()
+        if not rows:
+            break
+        for r in rows:
+            analise = load_dados(conn, r['id'], ['ai']).get('ai', '')
+            index_consulta(conn, r['id'], {'razao_social': r['razao_social'] or '',
+                                           'nome_fantasia': r['nome_fantasia'] or '',
+                                           'cnpj': r['cnpj'] or ''},
+                           (r['socios'] or '').split('\n'), analise)
+        conn.commit()
+        total += len(rows)
+        ultimo = rows[-1]['id']
+    conn.execute("INSERT INTO busca_fts (busca_fts) VALUES ('optimize')")
+    conn.commit()
+    return total
+
+def fts_query(texto):
+    """
+    Converte o texto digitado numa consulta FTS5 segura: cada termo vira uma
+    string entre aspas (AND implícito) e o último aceita prefixo, para a busca
+    funcionar enquanto o analista digita.
+    """
+    termos = re.findall(r'\w+', texto)
+    if not termos:
+        return None
+    partes = [f'"{t}"' for t in termos]
+    partes[-1] += '*'
+    return ' '.join(partes)
+
+def search_consultas(texto, limit=20):
+    match = fts_query(texto)
+    if not SEARCH_ENABLED or not match:
+        return []
     conn = get_db()
+    rows = conn.execute(f"""
+        SELECT c.id, c.cnpj, c.razao_social, c.nome_fantasia, c.score_empresa, c.risco, c.created_at,
+               highlight(busca_fts, 0, :ini, :fim) AS razao_social_hl,
+               snippet(busca_fts, 3, :ini, :fim, '…', 8)  AS socios_trecho,
+               snippet(busca_fts, 4, :ini, :fim, '…', 16) AS analise_trecho,
+               bm25(busca_fts, {', '.join(map(str, SEARCH_WEIGHTS))}) AS relevancia
+        FROM busca_fts JOIN consultas c ON c.id = busca_fts.rowid
+        WHERE busca_fts MATCH :match
+        ORDER BY relevancia
+        LIMIT :limit
+    """, {'ini': _HL_INI, 'fim': _HL_FIM, 'match': match, 'limit': limit}).fetchall()
+    return [{**r, **{k: _marcar(r[k]) for k in SEARCH_HL_CAMPOS}} for r in map(dict, rows)]
+
+def _marcar(trecho):
+    """Texto de highlight()/snippet() como HTML seguro: escapado, com os termos em <mark>."""
+    if trecho is None:
+        return None
+    return html.escape(trecho).replace(_HL_INI, '<mark>').replace(_HL_FIM, '</mark>')
+
+if not PROCESSO_FILHO:
+    init_db()
+
+# ─────────────────────────────────────────
+# HELPERS
+# ─────────────────────────────────────────
+# A configuração muda raramente: fica em memória e só é relida quando muda.
+# Quem grava api_config chama invalidate_api_config(), que recarrega na hora
+# neste processo e troca CONFIG_SINAL, um arquivo vazio ao lado do banco. Os
+# outros workers comparam o (inode, mtime) dele no máximo a cada
+# CONFIG_CHECK_INTERVAL segundos: um stat, sem query, até a configuração mudar.
+CONFIG_CHECK_INTERVAL = float(os.environ.get('CONFIG_CHECK_INTERVAL', 2))
+CONFIG_SINAL = os.path.join(DATA_DIR, 'config.versao')
+_config_cache = {'versao': None, 'cfg': None, 'checado': 0.0}
+_config_lock  = threading.Lock()
+
+def _load_api_config(conn):
     rows = conn.execute("SELECT key, label, descricao, enabled, api_key FROM api_config").fetchall()
-    conn.close()
     return {
         r['key']: {
             'enabled':   bool(r['enabled']),
@@ -177,64 +694,833 @@ def get_api_config():
         for r in rows
     }
 
-def fetch_url(url, headers=None, timeout=10):
+def _config_sinal():
+    try:
+        st = os.stat(CONFIG_SINAL)
+        return st.st_ino, st.st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def get_api_config():
+    now = time.monotonic()
+    with _config_lock:
+        if _config_cache['cfg'] is None or now - _config_cache['checado'] >= CONFIG_CHECK_INTERVAL:
+            # O sinal é lido antes do banco: quem grava faz commit antes de trocá-lo.
+            versao = _config_sinal()
+            if versao != _config_cache['versao'] or _config_cache['cfg'] is None:
+                _config_cache['cfg'] = _load_api_config(get_db())
+                _config_cache['versao'] = versao
+            _config_cache['checado'] = now
+        cfg = _config_cache['cfg']
+    # Cópia rasa por provedor: quem recebe pode alterar sem afetar o cache.
+    return {k: dict(v) for k, v in cfg.items()}
+
+def invalidate_api_config():
+    """Chamar depois do commit em api_config: avisa os outros workers e recarrega aqui."""
+    tmp = f"{CONFIG_SINAL}.{os.getpid()}"
+    open(tmp, 'w').close()
+    os.replace(tmp, CONFIG_SINAL)   # inode novo a cada troca
+    with _config_lock:
+        _config_cache['cfg'] = None
+
+# ─────────────────────────────────────────
+# API LOGS / METRICS
+# ─────────────────────────────────────────
+# Cada chamada externa e cada etapa do pipeline vira uma linha em api_logs.
+# Quem mede só enfileira; uma thread grava em lote (executemany) a cada
+# LOG_FLUSH_INTERVAL segundos, então o log não entra no tempo da requisição.
+# A thread e a fila são do processo: num worker que nasceu de fork a primeira
+# chamada cria as suas (a fila herdada teria os itens do pai, gravados duas vezes).
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 2))
+LOG_BATCH_MAX      = 500
+LOG_QUEUE_MAX      = 20000
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+_log_writer_pid = None
+_log_writer_lock = threading.Lock()
+
+def log_api_call(api_name, endpoint, status, response_time_ms, error=None, consulta_id=None):
+    global _log_writer_pid, _log_queue
+    if _log_writer_pid != os.getpid():
+        with _log_writer_lock:
+            if _log_writer_pid != os.getpid():
+                if _log_writer_pid is not None:
+                    _log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+                threading.Thread(target=_log_writer, name='api-logs', daemon=True).start()
+                _log_writer_pid = os.getpid()
+    try:
+        _log_queue.put_nowait((consulta_id, api_name, endpoint, status, int(response_time_ms),
+                               str(error)[:500] if error else None,
+                               datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    except queue.Full:
+        pass  # métrica perdida é melhor que travar a requisição
+
+def _flush_logs(batch):
+    if not batch:
+        return
+    conn = get_db()
+    conn.executemany("""
+        INSERT INTO api_logs (consulta_id, api_name, endpoint, status, response_time_ms, error, created_at)
+        VALUES (?,?,?,?,?,?,?)
+    """, batch)
+    conn.commit()
+
+def _drain_logs(first=None):
+    batch = [first] if first else []
+    while len(batch) < LOG_BATCH_MAX:
+        try:
+            batch.append(_log_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+def _log_writer():
+    while True:
+        first = _log_queue.get()
+        time.sleep(LOG_FLUSH_INTERVAL)
+        try:
+            _flush_logs(_drain_logs(first))
+        except Exception as e:
+            release_db()
+            print(f"api_logs flush error: {e}")
+
+@atexit.register
+def _flush_logs_at_exit():
+    try:
+        while not _log_queue.empty():
+            _flush_logs(_drain_logs())
+    except Exception:
+        pass
+
+@contextmanager
+def timed(api_name, endpoint=None, consulta_id=None):
+    """Mede um bloco (etapa do pipeline, escrita no banco...) e registra em api_logs."""
+    start = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        log_api_call(api_name, endpoint, 'erro', (time.monotonic() - start) * 1000, e, consulta_id)
+        raise
+    log_api_call(api_name, endpoint, 'ok', (time.monotonic() - start) * 1000, None, consulta_id)
+
+# Percentil por posição na série ordenada de cada api_name: o valor na posição
+# round(q * (n - 1)), calculado no SQLite (as linhas não vêm para o Python).
+_PERCENTIS = {'p50_ms': 0.50, 'p95_ms': 0.95, 'p99_ms': 0.99}
+
+def latency_metrics(horas=24):
+    """p50/p95/p99, contagem e erros por api_name em api_logs na janela dada."""
+    since = datetime.fromtimestamp(max(0, time.time() - horas * 3600)).strftime('%Y-%m-%d %H:%M:%S')
+    percentis = ',\n'.join(f"MAX(CASE WHEN pos = CAST({q} * (n - 1) + 0.5 AS INTEGER) THEN ms END) AS {nome}"
+                           for nome, q in _PERCENTIS.items())
+    rows = get_db().execute(f"""
+        SELECT api_name, COUNT(*) AS chamadas, SUM(erro) AS erros, SUM(ms) AS soma_ms,
+               {percentis}
+        FROM (SELECT api_name, COALESCE(status, '') != 'ok' AS erro, COALESCE(response_time_ms, 0) AS ms,
+                     ROW_NUMBER() OVER (PARTITION BY api_name ORDER BY COALESCE(response_time_ms, 0)) - 1 AS pos,
+                     COUNT(*) OVER (PARTITION BY api_name) AS n
+              FROM api_logs WHERE created_at >= ?)
+        GROUP BY api_name
+    """, (since,)).fetchall()
+    return {r['api_name']: {k: r[k] for k in ('chamadas', 'erros', 'soma_ms', *_PERCENTIS)} for r in rows}
+
+# ─────────────────────────────────────────
+# PROVIDER HEALTH (CIRCUIT BREAKER)
+# ─────────────────────────────────────────
+# Por provedor (chave do api_config): janela das últimas chamadas com latência
+# e erro. Depois de BREAKER_FAILURES falhas seguidas (ou taxa de erro alta na
+# janela) o circuito abre e o provedor é pulado por BREAKER_COOLDOWN segundos;
+# depois disso uma única chamada de teste decide se ele volta. O timeout de
+# leitura acompanha o p95 observado, limitado ao timeout padrão da chamada.
+HEALTH_WINDOW      = int(os.environ.get('HEALTH_WINDOW', 50))
+BREAKER_FAILURES   = int(os.environ.get('BREAKER_FAILURES', 5))
+BREAKER_ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', 0.5))
+BREAKER_COOLDOWN   = float(os.environ.get('BREAKER_COOLDOWN', 60))
+TIMEOUT_P95_FACTOR = float(os.environ.get('TIMEOUT_P95_FACTOR', 2.0))
+TIMEOUT_MIN        = float(os.environ.get('TIMEOUT_MIN', 2.0))
+
+class CircuitOpenError(Exception):
+    pass
+
+class ProviderHealth:
+    def __init__(self, key):
+        self.key = key
+        self.samples = deque(maxlen=HEALTH_WINDOW)   # (latência em s, ok)
+        self.failures = 0                            # falhas seguidas
+        self.open_until = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.open_until == 0.0:
+                return True
+            if time.monotonic() < self.open_until or self.probing:
+                return False
+            self.probing = True      # meio-aberto: deixa passar só uma chamada de teste
+            return True
+
+    def release(self):
+        """Chamada interrompida sem resultado (cancelada): libera a vaga de teste sem contar amostra."""
+        with self.lock:
+            self.probing = False
+
+    def record(self, latency, ok):
+        with self.lock:
+            self.samples.append((latency, ok))
+            self.probing = False
+            if ok:
+                self.failures = 0
+                self.open_until = 0.0
+                return
+            self.failures += 1
+            errors = sum(1 for _, good in self.samples if not good)
+            if (self.failures >= BREAKER_FAILURES or self.open_until
+                    or (len(self.samples) >= 10 and errors / len(self.samples) >= BREAKER_ERROR_RATE)):
+                self.open_until = time.monotonic() + BREAKER_COOLDOWN
+
+    def _p95(self):
+        lat = sorted(l for l, ok in self.samples if ok)
+        return lat[int(0.95 * (len(lat) - 1))] if len(lat) >= 5 else None
+
+    def timeout(self, default):
+        with self.lock:
+            p95 = self._p95()
+        if p95 is None:
+            return default
+        return min(default, max(TIMEOUT_MIN, p95 * TIMEOUT_P95_FACTOR))
+
+    def snapshot(self, default=None):
+        default = default or HTTP_READ_TIMEOUT
+        with self.lock:
+            n = len(self.samples)
+            errors = sum(1 for _, ok in self.samples if not ok)
+            p95 = self._p95()
+            remaining = max(0.0, self.open_until - time.monotonic())
+            estado = 'fechado' if not self.open_until else ('aberto' if remaining else 'meio-aberto')
+        return {
+            'estado':         estado,
+            'falhas_seguidas': self.failures,
+            'chamadas':       n,
+            'taxa_erro':      round(errors / n, 3) if n else 0.0,
+            'p95_ms':         round(p95 * 1000) if p95 is not None else None,
+            'timeout_s':      round(self.timeout(default), 2),
+            'reabre_em_s':    round(remaining, 1),
+        }
+
+_health = {}
+_health_lock = threading.Lock()
+
+def provider_health(key):
+    with _health_lock:
+        if key not in _health:
+            _health[key] = ProviderHealth(key)
+        return _health[key]
+
+def _is_provider_failure(e):
+    """
+    Erros 4xx (ex.: CNPJ inexistente) são respostas válidas; rede e 5xx são
+    falhas. 429 não abre o circuito: quem cuida dele é o limitador de taxa.
+    """
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    return status is None or status >= 500
+
+def _failure_status(e):
+    if isinstance(e, CircuitOpenError):
+        return 'circuito_aberto'
+    if isinstance(e, RateLimitedError):
+        return 'limite_taxa'
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    return f"http_{status}" if status else 'erro'
+
+@contextmanager
+def provider_call(key, endpoint=None):
+    """
+    Envolve uma chamada ao provedor: espera a vez no limitador de taxa,
+    respeita o circuito, alimenta o ProviderHealth e registra a chamada em
+    api_logs. Um 429 bloqueia o provedor pelo Retry-After.
+    """
+    try:
+        rate_acquire(key)
+    except RateLimitedError as e:
+        log_api_call(key, endpoint, 'limite_taxa', 0, e)
+        raise
+    health = _provider_enter(key, endpoint)
+    start = time.monotonic()
+    try:
+        yield health
+    except Exception as e:
+        _provider_exit(key, endpoint, health, start, e)
+        raise
+    except BaseException:
+        health.release()
+        raise
+    _provider_exit(key, endpoint, health, start)
+
+def _provider_enter(key, endpoint):
+    health = provider_health(key)
+    if not health.allow():
+        log_api_call(key, endpoint, 'circuito_aberto', 0)
+        raise CircuitOpenError(f"{key}: circuito aberto")
+    return health
+
+def _provider_exit(key, endpoint, health, start, error=None):
+    elapsed = time.monotonic() - start
+    if error is None:
+        health.record(elapsed, True)
+        log_api_call(key, endpoint, 'ok', elapsed * 1000)
+        return
+    health.record(elapsed, not _is_provider_failure(error))
+    log_api_call(key, endpoint, _failure_status(error), elapsed * 1000, error)
+    resp = getattr(error, 'response', None)
+    if getattr(resp, 'status_code', None) == 429:
+        rate_block(key, retry_after(resp))
+
+# ─────────────────────────────────────────
+# RATE LIMIT (TOKEN BUCKET POR PROVEDOR)
+# ─────────────────────────────────────────
+# Um balde por provedor (chave do api_config) em rate_buckets, compartilhado
+# pelos workers do gunicorn: cada chamada tira uma ficha numa transação curta;
+# sem ficha, a chamada espera na fila (até RATE_MAX_WAIT s, ou menos se quem
+# chamou tem prazo, ver _prazo) em vez de levar um 429. Um 429 com Retry-After bloqueia o provedor até lá. Trabalho em lote e
+# revalidação de cache rodam com prioridade 'lote' e não podem gastar a reserva
+# de RATE_RESERVA da rajada, que fica para as consultas interativas.
+RATE_LIMITS = {   # provedor: (fichas por segundo, rajada)
+    'opencnpj':   (5.0, 10),
+    'brasilapi':  (3.0, 6),
+    'cnpja':      (1.0, 3),
+    'invertexto': (1.0, 3),
+    'datajud':    (2.0, 4),
+    'perplexity': (1.0, 5),
+    'anthropic':  (0.5, 3),
+}
+RATE_LIMITS.update({k: tuple(v) for k, v in json.loads(os.environ.get('RATE_LIMITS', '{}')).items()})
+RATE_RESERVA       = float(os.environ.get('RATE_RESERVA', 0.3))
+RATE_MAX_WAIT      = float(os.environ.get('RATE_MAX_WAIT', 60))
+RATE_RETRY_DEFAULT = float(os.environ.get('RATE_RETRY_DEFAULT', 5))
+RATE_RETRIES       = int(os.environ.get('RATE_RETRIES', 2))
+_prioridade = contextvars.ContextVar('prioridade', default='interativa')
+# Instante (time.monotonic) em que quem disparou a chamada deixa de esperar por ela
+# (run_parallel, revalidação): a fila do limitador não passa disso, senão a thread
+# do _fetch_pool fica dormindo por um resultado que ninguém vai usar.
+_prazo = contextvars.ContextVar('prazo', default=None)
+
+class RateLimitedError(Exception):
+    pass
+
+def retry_after(resp, default=None):
+    """Segundos pedidos no Retry-After (número ou data HTTP), ou `default`."""
+    valor = resp.headers.get('Retry-After') if resp is not None else None
+    if valor:
+        try:
+            return max(0.0, float(valor))
+        except ValueError:
+            from email.utils import parsedate_to_datetime
+            try:
+                return max(0.0, parsedate_to_datetime(valor).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return RATE_RETRY_DEFAULT if default is None else default
+
+def _take_token(conn, key, taxa, rajada, reserva):
+    """Reabastece e tenta tirar uma ficha. Retorna 0 se conseguiu, senão quantos segundos esperar."""
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT tokens, atualizado_em, bloqueado_ate FROM rate_buckets WHERE provedor=?",
+                           (key,)).fetchone()
+        if row is None:
+            tokens, bloqueado = float(rajada), 0.0
+        else:
+            tokens = min(rajada, row['tokens'] + max(0.0, now - row['atualizado_em']) * taxa)
+            bloqueado = row['bloqueado_ate']
+        if now < bloqueado:
+            espera = bloqueado - now
+        elif tokens >= 1 + reserva:
+            tokens -= 1
+            espera = 0.0
+        else:
+            espera = (1 + reserva - tokens) / taxa
+        conn.execute("INSERT OR REPLACE INTO rate_buckets (provedor, tokens, atualizado_em, bloqueado_ate) "
+                     "VALUES (?,?,?,?)", (key, tokens, now, bloqueado))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return espera
+
+def _rate_params(key):
+    """(taxa, rajada, reserva) do provedor para a prioridade atual, ou None se ele não tem limite."""
+    limite = RATE_LIMITS.get(key)
+    if not limite:
+        return None
+    taxa, rajada = limite
+    return taxa, rajada, rajada * RATE_RESERVA if _prioridade.get() == 'lote' else 0.0
+
+def _rate_wait(key, inicio, espera):
+    agora, prazo = time.monotonic(), _prazo.get()
+    if agora - inicio + espera > RATE_MAX_WAIT:
+        raise RateLimitedError(f"{key}: fila do limite de taxa excedeu {RATE_MAX_WAIT:g}s")
+    if prazo is not None and agora + espera > prazo:
+        raise RateLimitedError(f"{key}: sem ficha antes do prazo de quem chamou")
+    return min(espera, 1.0)
+
+def _task_context(deadline):
+    """Contexto para uma tarefa do _fetch_pool: o atual, com _prazo daqui a `deadline` s."""
+    ctx = contextvars.copy_context()
+    ctx.run(_prazo.set, time.monotonic() + deadline)
+    return ctx
+
+def rate_acquire(key):
+    """Espera uma ficha do provedor; levanta RateLimitedError depois de RATE_MAX_WAIT s na fila."""
+    params = _rate_params(key)
+    if not params:
+        return
+    conn = get_db()
+    inicio = time.monotonic()
+    while True:
+        espera = _take_token(conn, key, *params)
+        if not espera:
+            return
+        time.sleep(_rate_wait(key, inicio, espera))
+
+def rate_block(key, segundos):
+    """Retry-After: nenhuma chamada ao provedor sai (em nenhum worker) nos próximos `segundos`."""
+    conn = get_db()
+    ate = time.time() + segundos
+    with conn:
+        conn.execute("""INSERT INTO rate_buckets (provedor, tokens, atualizado_em, bloqueado_ate) VALUES (?, 0, ?, ?)
+                        ON CONFLICT(provedor) DO UPDATE SET bloqueado_ate = MAX(bloqueado_ate, excluded.bloqueado_ate)""",
+                     (key, time.time(), ate))
+
+def rate_snapshot(key):
+    limite = RATE_LIMITS.get(key)
+    if not limite:
+        return None
+    row = get_db().execute("SELECT tokens, atualizado_em, bloqueado_ate FROM rate_buckets WHERE provedor=?",
+                           (key,)).fetchone()
+    now = time.time()
+    tokens = limite[1] if row is None else min(limite[1], row['tokens'] + (now - row['atualizado_em']) * limite[0])
+    return {'por_segundo': limite[0], 'rajada': limite[1], 'fichas': round(tokens, 2),
+            'bloqueado_s': round(max(0.0, row['bloqueado_ate'] - now), 1) if row else 0.0}
+
+# ─────────────────────────────────────────
+# HTTP CLIENT
+# ─────────────────────────────────────────
+# Uma sessão keep-alive por host (pool de conexões do urllib3), reaproveitada
+# por todas as threads: as chamadas seguintes ao mesmo host pulam TCP+TLS.
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT    = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+HTTP_POOL_SIZE       = int(os.environ.get('HTTP_POOL_SIZE', 16))
+ANTHROPIC_TIMEOUT    = float(os.environ.get('ANTHROPIC_TIMEOUT', 90))
+USER_AGENT = 'CreditoIA/1.0'
+PERPLEXITY_URL = "https://api.perplexity.ai/chat/completions"
+
+_sessions = {}
+_anthropic_clients = {}
+_clients_lock = threading.Lock()
+
+def http_session(url):
+    host = urlsplit(url).netloc
+    with _clients_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip, deflate'})
+            _sessions[host] = session
+    return session
+
+def http_request(method, url, headers=None, json_body=None, timeout=None, stream=False, provider=None):
+    """
+    Faz a chamada pela sessão do host e devolve o `requests.Response`.
+    `timeout` é o de leitura; o de conexão é sempre HTTP_CONNECT_TIMEOUT.
+    Com `provider`, passa pelo limitador de taxa e pelo circuit breaker, e o
+    timeout se ajusta ao p95 dele; um 429 volta para a fila (até RATE_RETRIES vezes).
+    Levanta exceção para erros de rede, status HTTP >= 400, circuito aberto
+    e fila do limite de taxa esgotada.
+    """
+    timeout = timeout or HTTP_READ_TIMEOUT
+    if provider is None:
+        return _http_send(method, url, headers, json_body, timeout, stream)
+    for tentativa in range(RATE_RETRIES + 1):
+        try:
+            # Só o caminho vai para o log: algumas APIs levam o token na query string.
+            with provider_call(provider, f"{method} {urlsplit(url).path}") as health:
+                return _http_send(method, url, headers, json_body, health.timeout(timeout), stream)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 429 or tentativa == RATE_RETRIES:
+                raise
+
+def _http_send(method, url, headers, json_body, timeout, stream):
+    resp = http_session(url).request(
+        method, url, headers=headers, json=json_body, stream=stream,
+        timeout=(HTTP_CONNECT_TIMEOUT, timeout),
+    )
+    resp.raise_for_status()
+    return resp
+
+def anthropic_client(api_key):
+    """Cliente Anthropic reaproveitado por chave (mantém o pool de conexões dele)."""
+    with _clients_lock:
+        client = _anthropic_clients.get(api_key)
+        if client is None:
+            import anthropic as ant_sdk
+            client = ant_sdk.Anthropic(api_key=api_key, timeout=ANTHROPIC_TIMEOUT)
+            _anthropic_clients[api_key] = client
+    return client
+
+def fetch_url(url, headers=None, timeout=10, provider=None):
     try:
-        req = urllib.request.Request(url, headers=headers or {'User-Agent': 'CreditoApp/1.0'})
-        with urllib.request.urlopen(req, timeout=timeout) as resp:
-            return json.loads(resp.read().decode())
+        return http_request('GET', url, headers=headers, timeout=timeout, provider=provider).json()
     except Exception as e:
         return {'error': str(e)}
 
 def clean_cnpj(cnpj):
     return re.sub(r'\D', '', cnpj)
 
+def _notify_result(on_result, name, fut):
+    if fut.exception() is None:
+        try:
+            on_result(name, fut.result())
+        except Exception as e:
+            print(f"Callback error ({name}): {e}")
+
+# Pool compartilhado para as chamadas externas (todas I/O bound).
+FETCH_WORKERS  = int(os.environ.get('FETCH_WORKERS', 16))
+FETCH_DEADLINE = float(os.environ.get('FETCH_DEADLINE', 12))
+_fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='fetch')
+
+def run_parallel(tasks, deadline=FETCH_DEADLINE, on_result=None):
+    """
+    Dispara todas as tarefas {nome: callable} ao mesmo tempo e espera no
+    máximo `deadline` segundos. Retorna {nome: resultado} só com o que
+    terminou a tempo; tarefas atrasadas ou com erro ficam de fora.
+    `on_result(nome, resultado)` é chamado assim que cada tarefa termina.
+    """
+    futures = {_fetch_pool.submit(_task_context(deadline).run, fn): name for name, fn in tasks.items()}
+    if on_result:
+        for fut, name in futures.items():
+            fut.add_done_callback(partial(_notify_result, on_result, name))
+    done, _ = wait(futures, timeout=deadline)
+    results = {}
+    for fut in done:
+        try:
+            results[futures[fut]] = fut.result()
+        except Exception as e:
+            print(f"Fetch error ({futures[fut]}): {e}")
+    return results
+
+class SingleFlight:
+    """
+    Junta chamadas simultâneas com a mesma chave: só a primeira (líder)
+    executa; as outras esperam e recebem o mesmo resultado (ou a mesma exceção).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """Retorna (resultado, compartilhado); compartilhado=True para quem só esperou."""
+        with self._lock:
+            call = self._calls.get(key)
+            lider = call is None
+            if lider:
+                call = self._calls[key] = {'pronto': threading.Event()}
+        if not lider:
+            call['pronto'].wait()
+            if 'erro' in call:
+                raise call['erro']
+            return call['valor'], True
+        try:
+            call['valor'] = fn()
+            return call['valor'], False
+        except BaseException as e:
+            call['erro'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['pronto'].set()
+
+# ─────────────────────────────────────────
+# CACHE DE FONTES
+# ─────────────────────────────────────────
+# (ttl, janela_stale) em segundos por fonte. Dentro do TTL o cache é servido
+# sem rede; depois dele, durante a janela stale, o valor antigo é servido e
+# revalidado em segundo plano. Fontes pagas ficam mais tempo em cache.
+#
+# Buscas simultâneas da mesma (fonte, chave) viram uma só: entre threads pelo
+# SingleFlight e entre os workers do gunicorn por uma lease em fetch_leases.
+# Quem não pega a lease espera o resultado do líder aparecer em cache_fontes
+# (até FETCH_LEASE_TTL s; depois disso busca por conta própria), consultando só
+# com SELECT e intervalos crescentes com jitter; tenta pegar a lease de novo só
+# quando ela some ou expira. A lease cobre o pior caso do líder, fila do
+# limitador de taxa + a requisição, para não expirar com ele ainda na fila e
+# deixar um segundo líder repetir a chamada paga.
+#
+# Resultado vazio (não encontrado, erro) também é gravado, como negativo válido
+# por CACHE_NEGATIVE_TTL s: quem esperava o líder recebe o mesmo vazio em vez de
+# repetir a chamada. Um negativo nunca substitui um positivo ainda servível.
+DAY = 86400
+CACHE_TTL = {
+    'opencnpj':   (7 * DAY,  7 * DAY),
+    'brasilapi':  (7 * DAY,  7 * DAY),
+    'cnpja':      (30 * DAY, 30 * DAY),
+    'invertexto': (30 * DAY, 30 * DAY),
+    'datajud':    (DAY,      DAY),
+}
+DATAJUD_TIMEOUT  = 15   # maior timeout de leitura entre as fontes em cache
+FETCH_LEASE_TTL  = max(float(os.environ.get('FETCH_LEASE_TTL', 0)),
+                       RATE_MAX_WAIT + HTTP_CONNECT_TIMEOUT + max(HTTP_READ_TIMEOUT, DATAJUD_TIMEOUT))
+FETCH_LEASE_POLL = 0.1   # primeira espera de quem segue o líder; dobra até FETCH_LEASE_POLL_MAX
+FETCH_LEASE_POLL_MAX = 1.0
+CACHE_NEGATIVE_TTL = float(os.environ.get('CACHE_NEGATIVE_TTL', 60))
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+_fetch_flight = SingleFlight()
+
+def _cache_get(fonte, chave):
+    conn = get_db()
+    row = conn.execute("SELECT payload, obtido_em FROM cache_fontes WHERE fonte=? AND chave=?",
+                       (fonte, chave)).fetchone()
+    return row
+
+def _cache_put(fonte, chave, data):
+    conn = get_db()
+    ttl, stale = CACHE_TTL.get(fonte, (DAY, 0))
+    now = time.time()
+    with conn:   # roda nas threads do _fetch_pool: commit ou rollback aqui mesmo
+        conn.execute("""
+            INSERT INTO cache_fontes (fonte, chave, payload, obtido_em) VALUES (?,?,?,?)
+            ON CONFLICT (fonte, chave) DO UPDATE SET payload=excluded.payload, obtido_em=excluded.obtido_em
+            WHERE ? OR cache_fontes.payload IN ('{}', '[]') OR cache_fontes.obtido_em < ?
+        """, (fonte, chave, json.dumps(data, ensure_ascii=False), now, bool(data), now - ttl - stale))
+
+def _cache_valido(fonte, row):
+    """Payload do cache se ainda servível (None se não), e se já passou do TTL (pede revalidação)."""
+    ttl, stale = CACHE_TTL.get(fonte, (DAY, 0))
+    age = time.time() - row['obtido_em']
+    data = json.loads(row['payload'])
+    if not data:
+        return (data, False) if age < CACHE_NEGATIVE_TTL else (None, False)
+    return (data, age >= ttl) if age < ttl + stale else (None, False)
+
+def _acquire_lease(fonte, chave, dono):
+    conn = get_db()
+    with conn:
+        conn.execute("DELETE FROM fetch_leases WHERE fonte=? AND chave=? AND expira_em < ?",
+                     (fonte, chave, time.time()))
+        cur = conn.execute("INSERT OR IGNORE INTO fetch_leases (fonte, chave, dono, expira_em) VALUES (?,?,?,?)",
+                           (fonte, chave, dono, time.time() + FETCH_LEASE_TTL))
+    return cur.rowcount == 1
+
+def _release_lease(fonte, chave, dono):
+    conn = get_db()
+    with conn:
+        conn.execute("DELETE FROM fetch_leases WHERE fonte=? AND chave=? AND dono=?", (fonte, chave, dono))
+
+def _situacao_lider(fonte, chave, inicio):
+    """
+    Só leitura, para quem espera o líder: ('pronto', dados) se ele já gravou o
+    resultado, ('livre', None) se a lease sumiu ou expirou sem resultado (vale
+    tentar pegá-la) e ('ocupado', None) enquanto ele ainda busca. A lease é lida
+    antes do cache: o líder grava o cache antes de soltá-la.
+    """
+    lease = get_db().execute("SELECT expira_em FROM fetch_leases WHERE fonte=? AND chave=?",
+                             (fonte, chave)).fetchone()
+    row = _cache_get(fonte, chave)
+    if row and row['obtido_em'] >= inicio:
+        return 'pronto', json.loads(row['payload'])
+    return ('livre' if lease is None or lease['expira_em'] < time.time() else 'ocupado'), None
+
+def _pausa_lider(espera):
+    """Próxima pausa de quem espera o líder (com jitter) e a espera base seguinte."""
+    return espera * random.uniform(0.5, 1.0), min(espera * 2, FETCH_LEASE_POLL_MAX)
+
+def _esperar_lider(inicio):
+    """Seguir esperando o líder? Até FETCH_LEASE_TTL, mas nunca além do prazo de quem chamou."""
+    prazo = _prazo.get()
+    return time.time() - inicio < FETCH_LEASE_TTL and (prazo is None or time.monotonic() < prazo)
+
+def _load_with_lease(fonte, chave, loader):
+    """Chama o loader só se este processo for o líder da (fonte, chave); senão espera o resultado do líder."""
+    dono = f"{os.getpid()}:{threading.get_ident()}"
+    inicio = time.time()
+    espera, livre = FETCH_LEASE_POLL, True
+    while _esperar_lider(inicio):
+        if livre and _acquire_lease(fonte, chave, dono):
+            try:
+                data = loader()
+                _cache_put(fonte, chave, data)
+                return data
+            finally:
+                _release_lease(fonte, chave, dono)
+        pausa, espera = _pausa_lider(espera)
+        time.sleep(pausa)
+        situacao, data = _situacao_lider(fonte, chave, inicio)
+        if situacao == 'pronto':
+            return data
+        livre = situacao == 'livre'
+    if time.time() - inicio < FETCH_LEASE_TTL:
+        return {}   # o prazo de quem chamou acabou antes: ninguém mais espera o resultado
+    data = loader()
+    _cache_put(fonte, chave, data)
+    return data
+
+def _load_and_store(fonte, chave, loader):
+    data, _ = _fetch_flight.do((fonte, chave), partial(_load_with_lease, fonte, chave, loader))
+    return data
+
+def _revalidate(fonte, chave, loader):
+    with _revalidating_lock:
+        if (fonte, chave) in _revalidating:
+            return
+        _revalidating.add((fonte, chave))
+
+    def job():
+        _prioridade.set('lote')   # revalidação em segundo plano não disputa a reserva interativa
+        try:
+            _load_and_store(fonte, chave, loader)
+        finally:
+            with _revalidating_lock:
+                _revalidating.discard((fonte, chave))
+    _fetch_pool.submit(_task_context(FETCH_DEADLINE).run, job)
+
+def cached_fetch(fonte, chave, loader, refresh=False):
+    """
+    Lê `fonte`/`chave` do cache persistente ou chama `loader()`.
+    Respostas vazias valem só CACHE_NEGATIVE_TTL s; `refresh=True` ignora o cache.
+    """
+    if not refresh:
+        row = _cache_get(fonte, chave)
+        if row:
+            data, revalidar = _cache_valido(fonte, row)
+            if revalidar:
+                _revalidate(fonte, chave, loader)
+            if data is not None:
+                return data
+    return _load_and_store(fonte, chave, loader)
+
 # ─────────────────────────────────────────
 # DATA FETCHERS
 # ─────────────────────────────────────────
-def fetch_opencnpj(cnpj, cfg):
+def _json_or_empty(provider, url, headers=None):
+    data = fetch_url(url, headers=headers, provider=provider)
+    return data if 'error' not in data else {}
+
+def fetch_opencnpj(cnpj, cfg, refresh=False):
     if not cfg.get('opencnpj', {}).get('enabled'):
         return {}
-    data = fetch_url(f"https://api.opencnpj.org/{cnpj}")
-    return data if 'error' not in data else {}
+    return cached_fetch('opencnpj', cnpj,
+        partial(_json_or_empty, 'opencnpj', f"https://api.opencnpj.org/{cnpj}"), refresh)
 
-def fetch_brasilapi(cnpj, cfg):
+def fetch_brasilapi(cnpj, cfg, refresh=False):
     if not cfg.get('brasilapi', {}).get('enabled'):
         return {}
-    data = fetch_url(f"https://brasilapi.com.br/api/cnpj/v1/{cnpj}")
-    return data if 'error' not in data else {}
+    return cached_fetch('brasilapi', cnpj,
+        partial(_json_or_empty, 'brasilapi', f"https://brasilapi.com.br/api/cnpj/v1/{cnpj}"), refresh)
 
-def fetch_cnpja(cnpj, cfg):
+def fetch_cnpja(cnpj, cfg, refresh=False):
     if not cfg.get('cnpja', {}).get('enabled'):
         return {}
     key = cfg['cnpja'].get('api_key', '')
     if not key:
         return {}
-    data = fetch_url(f"https://api.cnpja.com/office/{cnpj}", headers={'Authorization': key})
-    return data if 'error' not in data else {}
+    return cached_fetch('cnpja', cnpj,
+        partial(_json_or_empty, 'cnpja', f"https://api.cnpja.com/office/{cnpj}", {'Authorization': key}), refresh)
 
-def fetch_invertexto(cnpj, cfg):
+def fetch_invertexto(cnpj, cfg, refresh=False):
     if not cfg.get('invertexto', {}).get('enabled'):
         return {}
     key = cfg['invertexto'].get('api_key', '')
     if not key:
         return {}
-    data = fetch_url(f"https://api.invertexto.com/v1/cnpj/{cnpj}?token={key}")
-    return data if 'error' not in data else {}
+    return cached_fetch('invertexto', cnpj,
+        partial(_json_or_empty, 'invertexto', f"https://api.invertexto.com/v1/cnpj/{cnpj}?token={key}"), refresh)
 
-def fetch_datajud(nome_empresa, cfg):
-    if not cfg.get('datajud', {}).get('enabled'):
-        return {}
+def _datajud_search(nome_empresa):
     # DataJud CNJ public API
     url = f"https://api-publica.datajud.cnj.jus.br/api_publica_tjsp/_search"
     # Returns process data - simplified query
     try:
-        query = json.dumps({"query": {"match": {"partes.nome": nome_empresa}}, "size": 10})
-        req = urllib.request.Request(url, data=query.encode(), 
-            headers={'Content-Type': 'application/json', 'User-Agent': 'CreditoApp/1.0'})
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            return json.loads(resp.read().decode())
-    except:
+        query = {"query": {"match": {"partes.nome": nome_empresa}}, "size": 10}
+        data = http_request('POST', url, json_body=query, timeout=DATAJUD_TIMEOUT, provider='datajud').json()
+        return data if 'error' not in data else {}
+    except Exception as e:
+        print(f"DataJud error: {e}")
+        return {}
+
+def fetch_datajud(nome_empresa, cfg, refresh=False):
+    if not cfg.get('datajud', {}).get('enabled'):
         return {}
+    return cached_fetch('datajud', ' '.join(nome_empresa.upper().split()),
+                        partial(_datajud_search, nome_empresa), refresh)
+
+def processos_total(judicial_data):
+    """Total de processos informado pelo DataJud (hits.total), mesmo além dos `size` devolvidos."""
+    if isinstance(judicial_data, dict):
+        hits = judicial_data.get('hits', {})
+        if isinstance(hits, dict):
+            total = hits.get('total', 0)
+            return total.get('value', 0) if isinstance(total, dict) else int(total)
+    return 0
+
+def _nome_datajud(v):
+    return v.get('nome', '') if isinstance(v, dict) else str(v or '')
+
+def _data_datajud(v):
+    """'20200131000000' ou '2020-01-31T...' → '2020-01-31'."""
+    v = str(v or '')
+    return f"{v[:4]}-{v[4:6]}-{v[6:8]}" if v[:8].isdigit() else v[:10]
+
+def parse_processos(judicial_data):
+    """
+    Processos dos hits do DataJud (hits.hits[]._source) como tuplas no layout
+    da tabela processos, sem o consulta_id: (numero, tribunal, classe, assunto,
+    data_ajuizamento, situacao, valor_causa, partes). Situação = último movimento.
+    """
+    hits = judicial_data.get('hits', {}) if isinstance(judicial_data, dict) else {}
+    rows = []
+    for h in (hits.get('hits') or []) if isinstance(hits, dict) else []:
+        src = h.get('_source') or {}
+        assuntos = []
+        for a in src.get('assuntos') or []:
+            assuntos.extend(a if isinstance(a, list) else [a])   # às vezes vem aninhado
+        ultimo = max(src.get('movimentos') or [], key=lambda m: str(m.get('dataHora', '')), default={})
+        try:
+            valor = float(src['valorCausa']) if src.get('valorCausa') is not None else None
+        except (TypeError, ValueError):
+            valor = None
+        rows.append((
+            src.get('numeroProcesso', ''),
+            src.get('tribunal', ''),
+            _nome_datajud(src.get('classe')),
+            '; '.join(filter(None, map(_nome_datajud, assuntos))),
+            _data_datajud(src.get('dataAjuizamento')),
+            _nome_datajud(ultimo),
+            valor,
+            json.dumps(src['partes'], ensure_ascii=False) if src.get('partes') else None,
+        ))
+    return rows
+
+CNPJ_SOURCES = {
+    'opencnpj':   fetch_opencnpj,
+    'brasilapi':  fetch_brasilapi,
+    'cnpja':      fetch_cnpja,
+    'invertexto': fetch_invertexto,
+}
+
+def fetch_company_sources(cnpj, cfg, refresh=False, deadline=FETCH_DEADLINE):
+    """Consulta todas as fontes cadastrais habilitadas em paralelo, com prazo único."""
+    tasks = {
+        name: partial(fn, cnpj, cfg, refresh)
+        for name, fn in CNPJ_SOURCES.items()
+        if cfg.get(name, {}).get('enabled')
+    }
+    results = run_parallel(tasks, deadline)
+    return {name: results.get(name) or {} for name in CNPJ_SOURCES}
 
 def merge_company_data(opencnpj_data, brasilapi_data, cnpja_data):
     """Merge all sources, opencnpj takes priority"""
@@ -246,133 +1532,690 @@ def merge_company_data(opencnpj_data, brasilapi_data, cnpja_data):
 # ─────────────────────────────────────────
 # SCORING ENGINE
 # ─────────────────────────────────────────
-def calculate_score(company_data, judicial_data, social_data, valor_solicitado, capital_social):
-    score = 50  # base
-    reasons = []
+# As regras do score são dados (politicas_score), não código: cada versão de
+# política é validada e compilada uma vez em uma função Python gerada, com os
+# limites e pontos embutidos como constantes (mesmo custo dos if/elif fixos).
+# A política ativa é trocada atomicamente quando muda no banco; uma política
+# "desafiante" opcional recebe um percentual fixo dos CNPJs (teste A/B).
+DEFAULT_POLICY = {
+    'base': 50,
+    'situacao': {
+        'ativa':     {'pontos': 15,  'icone': '✓', 'texto': 'Empresa ativa na Receita Federal'},
+        'irregular': {'pontos': -25, 'icone': '✗', 'texto': 'Situação cadastral irregular: {situacao}'},
+    },
+    'idade': {   # anos de atividade: primeira faixa com anos >= min; abaixo de jovem.max penaliza
+        'faixas': [
+            {'min': 10, 'pontos': 15, 'icone': '✓', 'texto': 'Empresa com {anos} anos de atividade'},
+            {'min': 5,  'pontos': 8,  'icone': '~', 'texto': 'Empresa com {anos} anos de atividade'},
+        ],
+        'jovem': {'max': 2, 'pontos': -10, 'icone': '✗', 'texto': 'Empresa jovem ({anos} anos)'},
+    },
+    'capital': {   # capital social / valor solicitado
+        'faixas': [
+            {'min': 2,   'pontos': 12, 'icone': '✓', 'texto': 'Capital social ({cap:,.2f}) sólido vs valor solicitado'},
+            {'min': 0.5, 'pontos': 5,  'icone': '~', 'texto': 'Capital social adequado em relação ao crédito'},
+        ],
+        'abaixo': {'pontos': -8, 'icone': '✗', 'texto': 'Capital social baixo para o crédito solicitado'},
+    },
+    'porte': {
+        'grande': {'pontos': 10, 'icone': '✓', 'texto': 'Grande empresa'},
+        'medio':  {'pontos': 5,  'icone': '~', 'texto': 'Empresa de médio porte'},
+        'micro':  {'pontos': -3, 'icone': '~', 'texto': 'Microempresa/MEI'},
+    },
+    'processos': {   # primeira faixa com processos > acima
+        'faixas': [
+            {'acima': 10, 'pontos': -20, 'icone': '✗', 'texto': '{proc} processos judiciais encontrados'},
+            {'acima': 3,  'pontos': -10, 'icone': '~', 'texto': '{proc} processos judiciais encontrados'},
+            {'acima': 0,  'pontos': -3,  'icone': '~', 'texto': '{proc} processo(s) judicial(is) encontrado(s)'},
+        ],
+        'nenhum': {'pontos': 8, 'icone': '✓', 'texto': 'Nenhum processo judicial identificado'},
+    },
+    'controversias': {'pontos': -10, 'icone': '✗', 'texto': 'Controvérsias identificadas nas redes sociais'},
+    'risco': [
+        {'min': 75, 'nivel': 'BAIXO', 'cor': '#10b981'},
+        {'min': 50, 'nivel': 'MÉDIO', 'cor': '#f59e0b'},
+        {'min': 30, 'nivel': 'ALTO',  'cor': '#ef4444'},
+    ],
+    'risco_padrao': {'nivel': 'MUITO ALTO', 'cor': '#dc2626'},
+    'multiplicador': [
+        {'min': 75, 'valor': 1.0},
+        {'min': 60, 'valor': 0.8},
+        {'min': 45, 'valor': 0.5},
+        {'min': 30, 'valor': 0.25},
+    ],
+    'multiplicador_padrao': 0.0,
+}
+
+PORTE_CODES = {'grande': 1, 'medio': 2, 'micro': 3}
+SCORE_FACTORS = ('situacao', 'idade', 'capital', 'porte', 'processos', 'controversias')
+# Campos que o texto de cada fator pode usar (ex.: '{anos} anos').
+REASON_FIELDS = {'situacao': 'situacao', 'idade': 'anos', 'capital': 'cap', 'processos': 'proc'}
+_CAP_NOISE = re.compile(r'[^\d.,]')
 
-    # Situação cadastral
+# Layout de uma linha de score_features (array estruturado do NumPy).
+FEATURE_DTYPE = [('ativa', '?'), ('situacao', 'O'), ('ano', 'i8'), ('tem_ano', '?'),
+                 ('capital', 'f8'), ('porte', 'i8'), ('processos', 'i8'), ('controversias', '?')]
+
+_ano_cache = (0.0, 0)
+
+def ano_corrente():
+    """Ano corrente, relido a cada minuto (datetime.now() a cada score pesa no lote)."""
+    global _ano_cache
+    now = time.monotonic()
+    if now >= _ano_cache[0]:
+        _ano_cache = (now + 60, datetime.now().year)
+    return _ano_cache[1]
+
+def score_features(company_data, judicial_data, social_data, capital_social):
+    """
+    Reduz uma empresa às entradas do score numa tupla no layout de
+    FEATURE_DTYPE. Ano que não se deixa ler fica com tem_ano=False; capital
+    ilegível vira NaN (a regra de capital não se aplica).
+    """
     situacao = str(company_data.get('situacao_cadastral', '')).lower()
-    if 'ativa' in situacao:
-        score += 15
-        reasons.append(('✓', 'Empresa ativa na Receita Federal', +15))
-    else:
-        score -= 25
-        reasons.append(('✗', f'Situação cadastral irregular: {situacao}', -25))
 
-    # Tempo de empresa
-    try:
-        inicio = company_data.get('data_inicio_atividade', '') or company_data.get('abertura', '')
-        if inicio:
-            ano = int(str(inicio)[:4])
-            anos = datetime.now().year - ano
-            if anos >= 10:
-                score += 15
-                reasons.append(('✓', f'Empresa com {anos} anos de atividade', +15))
-            elif anos >= 5:
-                score += 8
-                reasons.append(('~', f'Empresa com {anos} anos de atividade', +8))
-            elif anos < 2:
-                score -= 10
-                reasons.append(('✗', f'Empresa jovem ({anos} anos)', -10))
-    except:
-        pass
+    ano, tem_ano = 0, False
+    inicio = company_data.get('data_inicio_atividade', '') or company_data.get('abertura', '')
+    if inicio:
+        try:
+            ano, tem_ano = int(str(inicio)[:4]), True
+        except ValueError:
+            pass
 
-    # Capital social vs valor solicitado
     try:
         cap_str = str(capital_social or company_data.get('capital_social', '0'))
-        cap = float(re.sub(r'[^\d.,]', '', cap_str).replace(',', '.'))
-        if cap > 0 and valor_solicitado > 0:
-            ratio = cap / valor_solicitado
-            if ratio >= 2:
-                score += 12
-                reasons.append(('✓', f'Capital social ({cap:,.2f}) sólido vs valor solicitado', +12))
-            elif ratio >= 0.5:
-                score += 5
-                reasons.append(('~', f'Capital social adequado em relação ao crédito', +5))
-            else:
-                score -= 8
-                reasons.append(('✗', 'Capital social baixo para o crédito solicitado', -8))
-    except:
-        pass
+        cap = float(_CAP_NOISE.sub('', cap_str).replace(',', '.'))
+    except ValueError:
+        cap = float('nan')
 
-    # Porte
     porte = str(company_data.get('porte_empresa', '') or company_data.get('porte', '')).lower()
     if 'grande' in porte:
-        score += 10
-        reasons.append(('✓', 'Grande empresa', +10))
+        porte_code = PORTE_CODES['grande']
     elif 'medio' in porte or 'média' in porte:
-        score += 5
-        reasons.append(('~', 'Empresa de médio porte', +5))
+        porte_code = PORTE_CODES['medio']
     elif 'micro' in porte or 'mei' in porte:
-        score -= 3
-        reasons.append(('~', 'Microempresa/MEI', -3))
-
-    # Processos judiciais
-    proc_count = 0
-    if isinstance(judicial_data, dict):
-        hits = judicial_data.get('hits', {})
-        if isinstance(hits, dict):
-            proc_count = hits.get('total', {}).get('value', 0) if isinstance(hits.get('total'), dict) else int(hits.get('total', 0))
-    if proc_count > 10:
-        score -= 20
-        reasons.append(('✗', f'{proc_count} processos judiciais encontrados', -20))
-    elif proc_count > 3:
-        score -= 10
-        reasons.append(('~', f'{proc_count} processos judiciais encontrados', -10))
-    elif proc_count > 0:
-        score -= 3
-        reasons.append(('~', f'{proc_count} processo(s) judicial(is) encontrado(s)', -3))
+        porte_code = PORTE_CODES['micro']
     else:
-        score += 8
-        reasons.append(('✓', 'Nenhum processo judicial identificado', +8))
+        porte_code = 0
 
-    # Social media issues
-    if social_data.get('controversias'):
-        score -= 10
-        reasons.append(('✗', 'Controvérsias identificadas nas redes sociais', -10))
+    return ('ativa' in situacao, situacao, ano, tem_ano, cap, porte_code, processos_total(judicial_data),
+            bool(social_data.get('controversias')))
 
-    score = max(0, min(100, score))
-    
-    # Risk level
-    if score >= 75:
-        risco = 'BAIXO'
-        risco_color = '#10b981'
-    elif score >= 50:
-        risco = 'MÉDIO'
-        risco_color = '#f59e0b'
-    elif score >= 30:
-        risco = 'ALTO'
-        risco_color = '#ef4444'
-    else:
-        risco = 'MUITO ALTO'
-        risco_color = '#dc2626'
-
-    # Suggested value
-    if score >= 75:
-        mult = 1.0
-    elif score >= 60:
-        mult = 0.8
-    elif score >= 45:
-        mult = 0.5
-    elif score >= 30:
-        mult = 0.25
+def features_from_dados(d):
+    """score_features a partir dos payloads gravados de uma consulta."""
+    company = d.get('company') or {}
+    return score_features(company, d.get('judicial') or {}, d.get('social') or {},
+                          company.get('capital_social', '0'))
+
+def _numerico(v):
+    """Número finito de verdade: bool, NaN e infinito viram repr inválido no código gerado."""
+    return isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v)
+
+def _secao(policy, nome, tipo=dict):
+    """Seção da política com o tipo esperado (objeto ou lista), ou ValueError."""
+    v = policy[nome]
+    if not isinstance(v, tipo):
+        raise ValueError(f"{nome}: {'objeto' if tipo is dict else 'lista'} esperado")
+    return v
+
+def _policy_bands(policy):
+    """
+    Normaliza a política em (fator, [(condição, limite, regra), ...]) na ordem
+    de avaliação; a primeira condição verdadeira de cada fator vale. Levanta
+    ValueError se faltar campo, se uma seção não tiver o tipo esperado, se um
+    texto usar campo desconhecido ou se as faixas não estiverem em ordem
+    decrescente.
+    """
+    def regra(r, fator):
+        if not isinstance(r, dict):
+            raise ValueError(f"{fator}: regra precisa ser um objeto")
+        if not _numerico(r.get('pontos')):
+            raise ValueError(f"{fator}: 'pontos' numérico obrigatório")
+        if not isinstance(r.get('icone', ''), str) or not isinstance(r.get('texto'), str):
+            raise ValueError(f"{fator}: 'texto' obrigatório")
+        # O texto vira f-string no código gerado: só o campo do fator, com formato simples.
+        campo = REASON_FIELDS.get(fator)
+        try:
+            partes = list(string.Formatter().parse(r['texto']))
+        except ValueError:
+            partes = [(None, '?', None, None)]
+        for _, nome, formato, conversao in partes:
+            if nome is not None and (nome != campo or conversao or not re.fullmatch(r'[\w,.<>=^+\- #%]*', formato)):
+                raise ValueError(f"{fator}: o texto só pode usar {{{campo}}}" if campo else
+                                 f"{fator}: o texto não aceita campos")
+        return {'pontos': r['pontos'], 'icone': r.get('icone', ''), 'texto': r['texto']}
+
+    def faixas(lista, chave, fator):
+        if not isinstance(lista, list) or not all(isinstance(f, dict) for f in lista):
+            raise ValueError(f"{fator}: 'faixas' precisa ser uma lista de objetos")
+        limites = [f.get(chave) for f in lista]
+        if not all(map(_numerico, limites)) or limites != sorted(limites, reverse=True):
+            raise ValueError(f"{fator}: faixas precisam de '{chave}' numérico em ordem decrescente")
+        return [(chave, f[chave], regra(f, fator)) for f in lista]
+
+    def jovem(r):
+        if not isinstance(r, dict) or not _numerico(r.get('max')):
+            raise ValueError("idade.jovem: 'max' numérico obrigatório")
+        return [('max', r['max'], regra(r, 'idade'))]
+
+    if not isinstance(policy, dict):
+        raise ValueError("a política precisa ser um objeto")
+    p = {k: _secao(policy, k) for k in ('situacao', 'idade', 'capital', 'porte', 'processos')}
+    p['controversias'] = policy.get('controversias')
+    bands = [
+        ('situacao', [('ativa', None, regra(p['situacao']['ativa'], 'situacao')),
+                      ('senao', None, regra(p['situacao']['irregular'], 'situacao'))]),
+        ('idade', faixas(p['idade'].get('faixas', []), 'min', 'idade') +
+                  (jovem(p['idade']['jovem']) if p['idade'].get('jovem') else [])),
+        ('capital', faixas(p['capital'].get('faixas', []), 'min', 'capital') +
+                    ([('senao', None, regra(p['capital']['abaixo'], 'capital'))]
+                     if p['capital'].get('abaixo') else [])),
+        ('porte', [('porte', PORTE_CODES[k], regra(p['porte'][k], 'porte'))
+                   for k in ('grande', 'medio', 'micro') if p['porte'].get(k)]),
+        ('processos', faixas(p['processos'].get('faixas', []), 'acima', 'processos') +
+                      ([('senao', None, regra(p['processos']['nenhum'], 'processos'))]
+                       if p['processos'].get('nenhum') else [])),
+        ('controversias', [('controversias', None, regra(p['controversias'], 'controversias'))]
+                          if p.get('controversias') else []),
+    ]
+    return bands
+
+def _score_tables(policy):
+    """Faixas de risco e de multiplicador já validadas."""
+    for nome in ('risco', 'multiplicador'):
+        if not all(isinstance(f, dict) for f in _secao(policy, nome, list)):
+            raise ValueError(f"{nome}: faixas precisam ser objetos")
+    risco = [(r['min'], str(r['nivel']), str(r['cor'])) for r in policy['risco']]
+    mult  = [(m['min'], float(m['valor'])) for m in policy['multiplicador']]
+    for nome, faixas in (('risco', risco), ('multiplicador', mult)):
+        limites = [f[0] for f in faixas]
+        if not all(map(_numerico, limites)) or limites != sorted(limites, reverse=True):
+            raise ValueError(f"{nome}: faixas precisam de 'min' numérico em ordem decrescente")
+    padrao = _secao(policy, 'risco_padrao')
+    mult_padrao = float(policy['multiplicador_padrao'])
+    if not all(math.isfinite(v) for v in [v for _, v in mult] + [mult_padrao]):
+        raise ValueError("multiplicador: 'valor' precisa ser um número finito")
+    return risco, (str(padrao['nivel']), str(padrao['cor'])), mult, mult_padrao
+
+# Condição de cada fator no código gerado, por tipo de faixa.
+_SCALAR_CONDITIONS = {
+    ('idade', 'min'):       'anos >= {0!r}',
+    ('idade', 'max'):       'anos < {0!r}',
+    ('capital', 'min'):     'ratio >= {0!r}',
+    ('processos', 'acima'): 'proc > {0!r}',
+    ('porte', 'porte'):     'porte == {0!r}',
+}
+# Cabeçalho de cada fator: só avalia as faixas se o dado existe.
+_SCALAR_GUARDS = {
+    'idade':         ('if tem_ano:', 'anos = ano_corrente() - ano'),
+    'capital':       ('if cap > 0 and valor > 0:', 'ratio = cap / valor'),
+    'controversias': ('if contro:', None),
+}
+
+def _generate_evaluator(bands, tables, base, versao):
+    """Gera o código-fonte da função de score da política (só constantes via repr)."""
+    risco, risco_padrao, mult, mult_padrao = tables
+    L = ["def avaliar(feat, valor):",
+         "    ativa, situacao, ano, tem_ano, cap, porte, proc, contro = feat",
+         f"    score = {base!r}",
+         "    reasons = []"]
+    for fator, faixas in bands:
+        if not faixas:
+            continue
+        indent = '    '
+        guard, setup = _SCALAR_GUARDS.get(fator, (None, None))
+        if guard:
+            L.append(indent + guard)
+            indent += '    '
+            if setup:
+                L.append(indent + setup)
+        campo = REASON_FIELDS.get(fator)
+        for i, (cond, limite, r) in enumerate(faixas):
+            if cond == 'controversias' or (cond == 'senao' and i == 0):
+                head = None
+            elif cond == 'senao':
+                head = 'else:'
+            else:
+                expr = 'ativa' if cond == 'ativa' else _SCALAR_CONDITIONS[(fator, cond)].format(limite)
+                head = f"{'if' if i == 0 else 'elif'} {expr}:"
+            body = indent
+            if head:
+                L.append(indent + head)
+                body = indent + '    '
+            texto = ('f' if campo else '') + repr(r['texto'])
+            L.append(f"{body}score += {r['pontos']!r}")
+            L.append(f"{body}reasons.append(({r['icone']!r}, {texto}, {r['pontos']!r}))")
+    L.append("    score = max(0, min(100, score))")
+
+    def cascata(faixas, destino, padrao):
+        for i, (minimo, valor) in enumerate(faixas):
+            L.append(f"    {'if' if i == 0 else 'elif'} score >= {minimo!r}:")
+            L.append(f"        {destino} = {valor!r}")
+        if faixas:
+            L.append("    else:")
+        L.append(f"    {'    ' if faixas else ''}{destino} = {padrao!r}")
+
+    cascata([(m, (n, c)) for m, n, c in risco], 'risco, cor', risco_padrao)
+    cascata(mult, 'mult', mult_padrao)
+    L.append("    return {'score': score, 'risco': risco, 'risco_color': cor,"
+             " 'valor_sugerido': round(valor * mult, 2), 'multiplicador': mult,"
+             f" 'reasons': reasons, 'politica_versao': {versao!r}}}")
+    return '\n'.join(L)
+
+class ScorePolicy:
+    """Uma versão de política compilada: score individual (código gerado) e em massa (NumPy)."""
+
+    def __init__(self, regras, versao=None):
+        try:
+            self.bands  = _policy_bands(regras)
+            self.tables = _score_tables(regras)
+            self.base   = regras['base']
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"política incompleta: {e}")
+        if not _numerico(self.base):
+            raise ValueError("'base' numérico obrigatório")
+        self.versao = versao
+        self.regras = regras
+        self.pontos_inteiros = isinstance(self.base, int) and all(
+            isinstance(r['pontos'], int) for _, bands in self.bands for _, _, r in bands)
+        self.source = _generate_evaluator(self.bands, self.tables, self.base, versao)
+        namespace = {'ano_corrente': ano_corrente}
+        exec(compile(self.source, f"<politica {versao}>", 'exec'), namespace)
+        self._avaliar = namespace['avaliar']
+
+    def score(self, company_data, judicial_data, social_data, valor_solicitado, capital_social):
+        return self._avaliar(score_features(company_data, judicial_data, social_data, capital_social),
+                             valor_solicitado)
+
+    def score_from_features(self, feat, valor_solicitado):
+        return self._avaliar(feat, valor_solicitado)
+
+    def bulk(self, features, valores, with_reasons=False):
+        """
+        Score de muitas empresas de uma vez. `features` é uma lista de tuplas de
+        score_features (ou o array estruturado equivalente) e `valores` os
+        valores solicitados. Retorna um dict de arrays (score, risco,
+        risco_color, multiplicador, valor_sugerido), `pontos` (n × fatores) e
+        `faixas` (índice da faixa aplicada em cada fator, -1 se nenhuma); com
+        with_reasons=True inclui também `reasons`, igual à do score individual.
+        """
+        import numpy as np
+
+        f = features if isinstance(features, np.ndarray) else np.array(features, dtype=FEATURE_DTYPE)
+        valor = np.asarray(valores, dtype=np.float64)
+        anos = ano_corrente() - f['ano']
+        cap, proc, porte = f['capital'], f['processos'], f['porte']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tem_cap = (cap > 0) & (valor > 0)
+            ratio = np.where(tem_cap, cap / np.where(valor > 0, valor, 1), 0)
+        n = len(f)
+        vetor = {
+            ('situacao', 'ativa'):      lambda _: f['ativa'],
+            ('idade', 'min'):           lambda v: f['tem_ano'] & (anos >= v),
+            ('idade', 'max'):           lambda v: f['tem_ano'] & (anos < v),
+            ('capital', 'min'):         lambda v: tem_cap & (ratio >= v),
+            ('situacao', 'senao'):      lambda _: np.ones(n, bool),
+            ('capital', 'senao'):       lambda _: tem_cap,
+            ('processos', 'senao'):     lambda _: np.ones(n, bool),
+            ('porte', 'porte'):         lambda v: porte == v,
+            ('processos', 'acima'):     lambda v: proc > v,
+            ('controversias', 'controversias'): lambda _: f['controversias'],
+        }
+        faixas = np.full((n, len(self.bands)), -1, dtype=np.int64)
+        pontos = np.zeros((n, len(self.bands)), dtype=np.int64 if self.pontos_inteiros else np.float64)
+        for j, (fator, bands) in enumerate(self.bands):
+            if not bands:
+                continue
+            conds = [vetor[(fator, cond)](limite) for cond, limite, _ in bands]
+            faixas[:, j] = np.select(conds, list(range(len(bands))), -1)
+            tabela = np.array([r['pontos'] for _, _, r in bands] + [0], dtype=pontos.dtype)
+            pontos[:, j] = tabela[faixas[:, j]]
+
+        score = np.clip(self.base + pontos.sum(axis=1), 0, 100)
+        risco, risco_padrao, mult_t, mult_padrao = self.tables
+        risco_idx = np.select([score >= m for m, _, _ in risco], list(range(len(risco))), len(risco))
+        niveis = np.array([r[1] for r in risco] + [risco_padrao[0]], dtype=object)
+        cores  = np.array([r[2] for r in risco] + [risco_padrao[1]], dtype=object)
+        mult = np.select([score >= m for m, _ in mult_t], [v for _, v in mult_t], mult_padrao).astype(np.float64)
+        # np.round difere do round() do Python só quando o valor está colado no meio
+        # centavo; esses poucos casos são refeitos com round() para bater centavo a centavo.
+        bruto = valor * mult
+        sugerido = np.round(bruto, 2)
+        frac = np.abs(bruto * 100 - np.floor(bruto * 100) - 0.5)
+        for i in np.flatnonzero(frac < 1e-6):
+            sugerido[i] = round(float(bruto[i]), 2)
+
+        result = {
+            'score':          score,
+            'risco':          niveis[risco_idx],
+            'risco_color':    cores[risco_idx],
+            'multiplicador':  mult,
+            'valor_sugerido': sugerido,
+            'pontos':         pontos,
+            'faixas':         faixas,
+            'features':       f,
+            'anos':           anos,
+        }
+        if with_reasons:
+            result['reasons'] = [self.bulk_row(result, i)['reasons'] for i in range(n)]
+        return result
+
+    def bulk_row(self, result, i):
+        """A linha `i` de bulk() no formato do score individual."""
+        feat = result['features'][i]
+        campos = {'situacao': feat['situacao'], 'anos': int(result['anos'][i]),
+                  'cap': float(feat['capital']), 'proc': int(feat['processos'])}
+        reasons = []
+        for j, (fator, bands) in enumerate(self.bands):
+            k = int(result['faixas'][i, j])
+            if k >= 0:
+                r = bands[k][2]
+                campo = REASON_FIELDS.get(fator)
+                texto = r['texto'].format(**{campo: campos[campo]}) if campo else r['texto']
+                reasons.append((r['icone'], texto, r['pontos']))
+        score = result['score'][i]
+        return {
+            'score':          int(score) if float(score).is_integer() else float(score),
+            'risco':          result['risco'][i],
+            'risco_color':    result['risco_color'][i],
+            'valor_sugerido': float(result['valor_sugerido'][i]),
+            'multiplicador':  float(result['multiplicador'][i]),
+            'reasons':        reasons,
+            'politica_versao': self.versao,
+        }
+
+# ─────────────────────────────────────────
+# POLÍTICAS DE SCORE (VERSÕES, A/B)
+# ─────────────────────────────────────────
+POLICY_CHECK_INTERVAL = CONFIG_CHECK_INTERVAL
+# (chave do banco, (ativa, desafiante, percentual)) — trocado inteiro, nunca alterado.
+_policy_state = (None, (ScorePolicy(DEFAULT_POLICY), None, 0))
+_policy_checado = 0.0
+_policy_lock = threading.Lock()
+_policy_compiled = {}   # versao -> ScorePolicy (versões são imutáveis)
+
+def _ensure_default_policy(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    if not conn.execute("SELECT 1 FROM politicas_score WHERE status='ativa'").fetchone():
+        conn.execute("""
+            INSERT INTO politicas_score (nome, regras, status, percentual, created_at)
+            VALUES ('Padrão', ?, 'ativa', 0, ?)
+        """, (json.dumps(DEFAULT_POLICY, ensure_ascii=False), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    conn.commit()
+
+def _compiled_policy(conn, versao):
+    if versao not in _policy_compiled:
+        row = conn.execute("SELECT regras FROM politicas_score WHERE versao=?", (versao,)).fetchone()
+        _policy_compiled[versao] = ScorePolicy(json.loads(row['regras']), versao)
+    return _policy_compiled[versao]
+
+def policy_state():
+    """(ativa, desafiante, percentual) atuais, relendo o banco no máximo a cada POLICY_CHECK_INTERVAL s."""
+    global _policy_state, _policy_checado
+    now = time.monotonic()
+    if now - _policy_checado >= POLICY_CHECK_INTERVAL:
+        with _policy_lock:
+            if now - _policy_checado >= POLICY_CHECK_INTERVAL:
+                conn = get_db()
+                rows = conn.execute("""SELECT versao, status, percentual FROM politicas_score
+                                       WHERE status IN ('ativa', 'desafiante')""").fetchall()
+                if not any(r['status'] == 'ativa' for r in rows):
+                    _ensure_default_policy(conn)
+                    rows = conn.execute("""SELECT versao, status, percentual FROM politicas_score
+                                           WHERE status IN ('ativa', 'desafiante')""").fetchall()
+                chave = tuple(sorted((r['versao'], r['status'], r['percentual']) for r in rows))
+                if chave != _policy_state[0]:
+                    ativa = next(r for r in rows if r['status'] == 'ativa')
+                    desafiante = next((r for r in rows if r['status'] == 'desafiante'), None)
+                    _policy_state = (chave, (
+                        _compiled_policy(conn, ativa['versao']),
+                        _compiled_policy(conn, desafiante['versao']) if desafiante else None,
+                        desafiante['percentual'] if desafiante else 0,
+                    ))
+                _policy_checado = now
+    return _policy_state[1]
+
+def invalidate_policy():
+    global _policy_checado
+    _policy_checado = 0.0
+
+def policy_for(cnpj):
+    """Política que vale para o CNPJ: a desafiante para um percentual fixo de CNPJs, senão a ativa."""
+    ativa, desafiante, percentual = policy_state()
+    if desafiante and cnpj:
+        balde = int(hashlib.sha1(clean_cnpj(str(cnpj)).encode()).hexdigest()[:8], 16) % 100
+        if balde < percentual:
+            return desafiante
+    return ativa
+
+def calculate_score(company_data, judicial_data, social_data, valor_solicitado, capital_social, politica=None):
+    politica = politica or policy_for(company_data.get('cnpj', ''))
+    return politica._avaliar(score_features(company_data, judicial_data, social_data, capital_social),
+                             valor_solicitado)
+
+def calculate_scores_bulk(features, valores, with_reasons=False, politica=None):
+    """Score em massa com a política ativa (ou a informada); ver ScorePolicy.bulk."""
+    return (politica or policy_state()[0]).bulk(features, valores, with_reasons)
+
+# ─────────────────────────────────────────
+# SIMULAÇÃO DE POLÍTICA (WHAT-IF SOBRE O HISTÓRICO)
+# ─────────────────────────────────────────
+# Reaplica duas políticas (a base, por padrão a ativa, e uma candidata) sobre os
+# payloads já gravados, sem chamar API nenhuma. O histórico é dividido em
+# intervalos de id processados em paralelo por processos filhos; cada um lê em
+# blocos (iter_dados) e devolve só contadores, então a memória não cresce com o banco.
+# Os filhos nascem com 'spawn' (via simulacao.py): o servidor tem várias threads
+# (logs, fetch, event loop) e um fork herdaria locks presos por elas. Pela API a
+# simulação vira um registro em `simulacoes` e roda fora do request (_sim_pool).
+SIM_WORKERS = int(os.environ.get('SIM_WORKERS', os.cpu_count() or 1))
+SIM_BLOCO   = int(os.environ.get('SIM_BLOCO', 5000))
+
+def _simular_intervalo(regras_base, regras_cand, de_id, ate_id, where, args):
+    """Roda num processo filho: agrega a simulação das consultas com id em [de_id, ate_id]."""
+    base, cand = ScorePolicy(regras_base), ScorePolicy(regras_cand)
+    conn = get_db()
+    parcial = {'total': 0, 'matriz': {}, 'aprovadas': [0, 0], 'valor': [0.0, 0.0],
+               'score': [0.0, 0.0], 'subiram': 0, 'desceram': 0}
+    for bloco in iter_dados(conn, ('company', 'judicial', 'social'), batch=SIM_BLOCO,
+                            where=f"id BETWEEN ? AND ? AND ({where})", args=(de_id, ate_id, *args)):
+        feats = [features_from_dados(d) for _, d in bloco]
+        valores = [r['valor_solicitado'] or 0 for r, _ in bloco]
+        rb, rc = base.bulk(feats, valores), cand.bulk(feats, valores)
+        parcial['total'] += len(bloco)
+        for par in zip(rb['risco'].tolist(), rc['risco'].tolist()):
+            parcial['matriz'][par] = parcial['matriz'].get(par, 0) + 1
+        for k, res in enumerate((rb, rc)):
+            parcial['aprovadas'][k] += int((res['valor_sugerido'] > 0).sum())
+            parcial['valor'][k] += float(res['valor_sugerido'].sum())
+            parcial['score'][k] += float(res['score'].sum())
+        parcial['subiram'] += int((rc['score'] > rb['score']).sum())
+        parcial['desceram'] += int((rc['score'] < rb['score']).sum())
+    return parcial
+
+def _intervalos_simulacao(conn, partes, minimo, where, args):
+    """Divide os ids que casam com o filtro em até `partes` intervalos parecidos, de pelo menos `minimo` linhas."""
+    total = conn.execute(f"SELECT COUNT(*) FROM consultas WHERE {where}", args).fetchone()[0]
+    if not total:
+        return []
+    passo = max(minimo, -(-total // partes))
+    cortes = [r[0] for r in conn.execute(f"""
+        SELECT id FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY id) - 1 AS n FROM consultas WHERE {where})
+        WHERE n % ? = 0 ORDER BY id
+    """, (*args, passo))]
+    fim = conn.execute(f"SELECT MAX(id) FROM consultas WHERE {where}", args).fetchone()[0]
+    return [(de, (cortes[i + 1] - 1) if i + 1 < len(cortes) else fim) for i, de in enumerate(cortes)]
+
+def simulate_policy(cand, base=None, de=None, ate=None, workers=None):
+    """
+    Compara a ScorePolicy candidata com a base (a ativa, se None) sobre todas
+    as consultas gravadas, opcionalmente entre as datas `de` e `ate`
+    (AAAA-MM-DD). Retorna a matriz de migração entre faixas de risco,
+    aprovações (valor sugerido > 0) e o valor total aprovado em cada
+    política, com o delta.
+    """
+    base = base or policy_state()[0]
+    where, args = ['1=1'], []
+    if de:
+        where.append("created_at >= ?"); args.append(de)
+    if ate:
+        where.append("created_at < date(?, '+1 day')"); args.append(ate)
+    where = ' AND '.join(where)
+
+    t0 = time.time()
+    workers = max(1, workers or SIM_WORKERS)
+    conn = get_db()
+    tarefas = [(base.regras, cand.regras, de_id, ate_id, where, tuple(args))
+               for de_id, ate_id in _intervalos_simulacao(conn, workers * 2, SIM_BLOCO, where, tuple(args))]
+    if workers > 1 and len(tarefas) > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        import simulacao
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=simulacao.iniciar) as pool:
+            parciais = list(pool.map(simulacao.simular_intervalo, *zip(*tarefas)))
     else:
-        mult = 0.0
+        parciais = [_simular_intervalo(*t) for t in tarefas]
+
+    total = sum(p['total'] for p in parciais)
+    matriz = {}
+    for p in parciais:
+        for par, n in p['matriz'].items():
+            matriz[par] = matriz.get(par, 0) + n
+    niveis_b = [r[1] for r in base.tables[0]] + [base.tables[1][0]]
+    niveis_c = [r[1] for r in cand.tables[0]] + [cand.tables[1][0]]
 
-    valor_sugerido = round(valor_solicitado * mult, 2)
+    def soma(campo, k):
+        return sum(p[campo][k] for p in parciais)
 
+    valor_b, valor_c = round(soma('valor', 0), 2), round(soma('valor', 1), 2)
     return {
-        'score': score,
-        'risco': risco,
-        'risco_color': risco_color,
-        'valor_sugerido': valor_sugerido,
-        'multiplicador': mult,
-        'reasons': reasons
+        'total': total,
+        'filtro': {'de': de, 'ate': ate},
+        'base_versao': base.versao,
+        'candidata_versao': cand.versao,
+        'matriz': {
+            'linhas': niveis_b,    # faixa na política base
+            'colunas': niveis_c,   # faixa na candidata
+            'contagem': [[matriz.get((b, c), 0) for c in niveis_c] for b in niveis_b],
+        },
+        'mudaram_faixa': sum(n for (b, c), n in matriz.items() if b != c),
+        'score_subiu': sum(p['subiram'] for p in parciais),
+        'score_desceu': sum(p['desceram'] for p in parciais),
+        'score_medio': {'base': round(soma('score', 0) / total, 2) if total else None,
+                        'candidata': round(soma('score', 1) / total, 2) if total else None},
+        'aprovadas': {'base': soma('aprovadas', 0), 'candidata': soma('aprovadas', 1),
+                      'delta': soma('aprovadas', 1) - soma('aprovadas', 0)},
+        'valor_aprovado': {'base': valor_b, 'candidata': valor_c, 'delta': round(valor_c - valor_b, 2)},
+        'duracao_s': round(time.time() - t0, 2),
     }
 
+_sim_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='simulacao')
+
+def enqueue_simulacao(cand, base=None, de=None, ate=None):
+    """Grava o pedido de simulação e o coloca na fila; retorna o id."""
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    params = {'candidata': {'regras': cand.regras, 'versao': cand.versao},
+              'base': {'regras': base.regras, 'versao': base.versao} if base else None,
+              'de': de, 'ate': ate}
+    conn = get_db()
+    with conn:
+        sim_id = conn.execute(
+            "INSERT INTO simulacoes (status, parametros, created_at, updated_at) VALUES ('pendente',?,?,?)",
+            (json.dumps(params, ensure_ascii=False), now, now)
+        ).lastrowid
+    _sim_pool.submit(run_simulacao, sim_id)
+    return sim_id
+
+def run_simulacao(sim_id):
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db()
+    with conn:
+        claimed = conn.execute("UPDATE simulacoes SET status='executando', updated_at=? WHERE id=? AND status='pendente'",
+                               (now, sim_id)).rowcount
+    if not claimed:
+        return
+    try:
+        p = json.loads(conn.execute("SELECT parametros FROM simulacoes WHERE id=?", (sim_id,)).fetchone()[0])
+        cand = ScorePolicy(p['candidata']['regras'], p['candidata']['versao'])
+        base = ScorePolicy(p['base']['regras'], p['base']['versao']) if p['base'] else None
+        res, status, erro = simulate_policy(cand, base, p['de'], p['ate']), 'concluida', None
+    except Exception as e:
+        print(f"Simulação {sim_id} error: {e}")
+        import traceback; traceback.print_exc()
+        res, status, erro = None, 'erro', str(e)[:500]
+    with conn:
+        conn.execute("UPDATE simulacoes SET status=?, resultado=?, erro=?, updated_at=? WHERE id=?",
+                     (status, json.dumps(res, ensure_ascii=False) if res else None, erro,
+                      datetime.now().strftime('%Y-%m-%d %H:%M:%S'), sim_id))
+
+def resume_simulacoes():
+    """Na subida do processo: retoma simulações pendentes e as que ficaram presas em execução."""
+    stale = datetime.fromtimestamp(time.time() - JOB_STALE_SECONDS).strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE simulacoes SET status='pendente' WHERE status='executando' AND updated_at < ?", (stale,))
+    for r in conn.execute("SELECT id FROM simulacoes WHERE status='pendente' ORDER BY id").fetchall():
+        _sim_pool.submit(run_simulacao, r['id'])
+
+# ─────────────────────────────────────────
+# CACHE DE RESPOSTAS DE IA
+# ─────────────────────────────────────────
+# Respostas de IA (análise final e buscas da Perplexity) ficam em cache_ia,
+# endereçadas pelo hash de (modelo, prompt): a mesma empresa, com os mesmos
+# dados, processos, pesquisa e score, gera o mesmo prompt e reaproveita a
+# análise. Cada entrada expira no seu TTL; acima de AI_CACHE_MAX entradas as
+# menos usadas recentemente saem. Chamadas idênticas simultâneas viram uma só.
+AI_CACHE_TTL    = int(os.environ.get('AI_CACHE_TTL', 7 * DAY))
+AI_RESEARCH_TTL = int(os.environ.get('AI_RESEARCH_TTL', DAY))
+AI_CACHE_MAX    = int(os.environ.get('AI_CACHE_MAX', 5000))
+_ai_flight = SingleFlight()
+
+def ai_cache_key(modelo, prompt):
+    return hashlib.sha256(f"{modelo}\0{prompt}".encode()).hexdigest()
+
+def _ai_cache_get(chave):
+    conn = get_db()
+    now = time.time()
+    row = conn.execute("SELECT resposta FROM cache_ia WHERE chave=? AND expira_em > ?", (chave, now)).fetchone()
+    if row:
+        with conn:
+            conn.execute("UPDATE cache_ia SET usado_em=?, acessos=acessos+1 WHERE chave=?", (now, chave))
+        return row['resposta']
+    return None
+
+def _ai_cache_put(chave, modelo, resposta, ttl):
+    conn = get_db()
+    now = time.time()
+    with conn:
+        conn.execute("""INSERT OR REPLACE INTO cache_ia (chave, modelo, resposta, criado_em, expira_em, usado_em)
+                        VALUES (?,?,?,?,?,?)""", (chave, modelo, resposta, now, now + ttl, now))
+        conn.execute("DELETE FROM cache_ia WHERE expira_em <= ?", (now,))
+        conn.execute("""DELETE FROM cache_ia WHERE chave IN
+                        (SELECT chave FROM cache_ia ORDER BY usado_em DESC LIMIT -1 OFFSET ?)""", (AI_CACHE_MAX,))
+
+def cached_ai(modelo, prompt, loader, ttl=AI_CACHE_TTL):
+    """
+    Resposta de `loader()` para (modelo, prompt), vinda do cache quando
+    possível. Só textos não vazios são gravados; exceções do loader não.
+    Retorna (texto, reaproveitado): reaproveitado=True se veio do cache ou
+    de uma chamada idêntica que já estava em andamento.
+    """
+    chave = ai_cache_key(modelo, prompt)
+    texto = _ai_cache_get(chave)
+    if texto is not None:
+        return texto, True
+
+    def carregar():
+        texto = loader()
+        if texto:
+            _ai_cache_put(chave, modelo, texto, ttl)
+        return texto
+    return _ai_flight.do(chave, carregar)
+
 # ─────────────────────────────────────────
 # AI ANALYSIS
 # ─────────────────────────────────────────
+ANTHROPIC_MODEL = "claude-sonnet-4-20250514"
 
 AI_PROMPT = """Você é um analista de crédito sênior especializado em empresas brasileiras.
 
@@ -413,80 +2256,125 @@ Seja direto: recomendar ou não o crédito, qual valor e quais condições/garan
 Use linguagem profissional, clara e objetiva em português brasileiro."""
 
 
-def fetch_perplexity_research(company_name, cnpj, cfg):
-    """Usa a Perplexity para pesquisa web em tempo real sobre a empresa."""
+RESEARCH_DEADLINE = float(os.environ.get('RESEARCH_DEADLINE', 25))
+
+def perplexity_key(cfg):
     plex_cfg = cfg.get('perplexity', {})
     if not plex_cfg.get('enabled'):
-        return None
+        return ''
+    return plex_cfg.get('api_key', '') or os.environ.get('PERPLEXITY_API_KEY', '')
 
-    key = plex_cfg.get('api_key', '') or os.environ.get('PERPLEXITY_API_KEY', '')
-    if not key:
-        return None
-
-    queries = [
+def research_queries(company_name, cnpj):
+    return [
         f'"{company_name}" CNPJ {cnpj} notícias recentes problemas dívidas',
         f'"{company_name}" processos judiciais falência recuperação judicial',
         f'"{company_name}" reputação reclamações Reclame Aqui avaliações',
     ]
 
-    results = []
-    for q in queries:
-        try:
-            payload = json.dumps({
-                "model": "sonar",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "Você é um pesquisador financeiro. Busque e resuma informações relevantes sobre empresas brasileiras. Seja objetivo e cite fontes."
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Pesquise na web: {q}\n\nResuma os resultados mais relevantes encontrados, incluindo datas e fontes."
-                    }
-                ],
-                "max_tokens": 800,
-                "search_recency_filter": "month",
-                "return_citations": True,
-            }).encode()
-
-            req = urllib.request.Request(
-                "https://api.perplexity.ai/chat/completions",
-                data=payload,
-                headers={
-                    "Authorization": f"Bearer {key}",
-                    "Content-Type": "application/json",
-                    "User-Agent": "CreditoIA/1.0",
-                }
-            )
-            with urllib.request.urlopen(req, timeout=20) as resp:
-                data = json.loads(resp.read().decode())
-                text = data.get('choices', [{}])[0].get('message', {}).get('content', '')
-                if text:
-                    results.append(f"[Busca: {q}]\n{text}")
-        except Exception as e:
-            results.append(f"[Busca falhou: {q}] Erro: {str(e)}")
+def research_payload(q):
+    return {
+        "model": "sonar",
+        "messages": [
+            {
+                "role": "system",
+                "content": "Você é um pesquisador financeiro. Busque e resuma informações relevantes sobre empresas brasileiras. Seja objetivo e cite fontes."
+            },
+            {
+                "role": "user",
+                "content": f"Pesquise na web: {q}\n\nResuma os resultados mais relevantes encontrados, incluindo datas e fontes."
+            }
+        ],
+        "max_tokens": 800,
+        "search_recency_filter": "month",
+        "return_citations": True,
+    }
+
+def completion_text(data):
+    return data.get('choices', [{}])[0].get('message', {}).get('content', '')
+
+def fetch_perplexity_query(q, key):
+    """Executa uma busca na Perplexity (ou a reaproveita do cache) e devolve o bloco rotulado (ou None se vazio)."""
+    def buscar():
+        data = http_request('POST', PERPLEXITY_URL, headers={"Authorization": f"Bearer {key}"},
+                            json_body=research_payload(q), timeout=20, provider='perplexity').json()
+        return completion_text(data)
+
+    try:
+        text, _ = cached_ai('sonar', q, buscar, ttl=AI_RESEARCH_TTL)
+        return f"[Busca: {q}]\n{text}" if text else None
+    except Exception as e:
+        return f"[Busca falhou: {q}] Erro: {str(e)}"
 
-    return "\n\n---\n\n".join(results) if results else None
+def join_research(queries, results):
+    """Monta o texto da pesquisa na ordem das buscas, marcando as que estouraram o prazo."""
+    blocks = []
+    for q in queries:
+        if q not in results:
+            blocks.append(f"[Busca falhou: {q}] Erro: tempo limite excedido")
+        elif results[q]:
+            blocks.append(results[q])
+    return "\n\n---\n\n".join(blocks) if blocks else None
 
+def fetch_perplexity_research(company_name, cnpj, cfg, deadline=RESEARCH_DEADLINE):
+    """Usa a Perplexity para pesquisa web em tempo real sobre a empresa (buscas em paralelo)."""
+    key = perplexity_key(cfg)
+    if not key:
+        return None
+    queries = research_queries(company_name, cnpj)
+    results = run_parallel({q: partial(fetch_perplexity_query, q, key) for q in queries}, deadline)
+    return join_research(queries, results)
 
-def ai_analyze(company_data, judicial_data, social_data, cfg, score_result):
+def fetch_research_stage(company_data, cfg, deadline=RESEARCH_DEADLINE, on_result=None):
     """
-    Tenta Perplexity primeiro (pesquisa web em tempo real),
-    depois usa Anthropic ou Perplexity para gerar a análise final.
-    Retorna (texto_analise, ia_usada).
+    Roda a busca no DataJud e as buscas da Perplexity ao mesmo tempo, sob um
+    único prazo. Retorna (judicial_data, web_research).
+    `on_result` recebe (('datajud'|'perplexity', nome_ou_busca), resultado) conforme chegam.
     """
-    company_name = company_data.get('razao_social', '')
-    cnpj         = company_data.get('cnpj', '')
+    nome = company_data.get('razao_social', '')
+    key  = perplexity_key(cfg)
+    queries = research_queries(nome, company_data.get('cnpj', '')) if key else []
 
-    # ── 1. Pesquisa web com Perplexity ──────────────────────────
-    web_research = fetch_perplexity_research(company_name, cnpj, cfg)
+    tasks = {('perplexity', q): partial(fetch_perplexity_query, q, key) for q in queries}
+    if nome:
+        tasks[('datajud', nome)] = partial(fetch_datajud, nome, cfg)
+    results = run_parallel(tasks, deadline, on_result)
+
+    judicial_data = results.get(('datajud', nome)) or {}
+    research      = {q: results[('perplexity', q)] for q in queries if ('perplexity', q) in results}
+    web_research  = join_research(queries, research) if queries else None
+    return judicial_data, web_research
+
+
+def _sse_delta(line):
+    """Trecho de texto de uma linha SSE de chat/completions; None no fim do stream, '' se não houver texto."""
+    line = line.strip()
+    if not line.startswith('data:'):
+        return ''
+    chunk = line[5:].strip()
+    if chunk == '[DONE]':
+        return None
+    return json.loads(chunk).get('choices', [{}])[0].get('delta', {}).get('content', '')
+
+def _read_sse_completion(lines, on_token):
+    """Lê uma resposta chat/completions em streaming (SSE) repassando cada delta."""
+    parts = []
+    for raw in lines:
+        delta = _sse_delta(raw.decode())
+        if delta is None:
+            break
+        if delta:
+            parts.append(delta)
+            on_token(delta)
+    return ''.join(parts)
+
+
+def build_ai_prompt(company_data, judicial_data, score_result, web_research):
     if not web_research:
         web_research = (
             "Pesquisa web não realizada "
             "(Perplexity desabilitada ou sem chave configurada)."
         )
-
-    prompt = AI_PROMPT.format(
+    return AI_PROMPT.format(
         company_json  = json.dumps(company_data,  ensure_ascii=False, indent=2)[:3000],
         judicial_json = json.dumps(judicial_data, ensure_ascii=False, indent=2)[:1000],
         web_research  = web_research[:2000],
@@ -495,60 +2383,109 @@ def ai_analyze(company_data, judicial_data, social_data, cfg, score_result):
         valor_sugerido= f"{score_result['valor_sugerido']:,.2f}",
     )
 
-    # ── 2a. Análise final com Anthropic ─────────────────────────
+def analysis_payload(prompt, stream):
+    """Corpo da análise final pela Perplexity (sonar-pro)."""
+    return {
+        "model": "sonar-pro",
+        "messages": [
+            {"role": "system", "content": "Você é um analista de crédito sênior especializado em empresas brasileiras."},
+            {"role": "user",   "content": prompt}
+        ],
+        "max_tokens": 2500,
+        "stream": stream,
+    }
+
+def anthropic_key(cfg):
     ant_cfg = cfg.get('anthropic', {})
-    if ant_cfg.get('enabled'):
-        ant_key = ant_cfg.get('api_key', '') or os.environ.get('ANTHROPIC_API_KEY', '')
-        if ant_key:
-            try:
-                import anthropic as ant_sdk
-                client = ant_sdk.Anthropic(api_key=ant_key)
+    if not ant_cfg.get('enabled'):
+        return ''
+    return ant_cfg.get('api_key', '') or os.environ.get('ANTHROPIC_API_KEY', '')
+
+NO_AI_MESSAGE = (
+    "Nenhuma IA configurada. Acesse Configurações de API e insira a chave "
+    "da Anthropic ou da Perplexity para gerar a análise automática."
+)
+
+def ai_analyze(company_data, judicial_data, social_data, cfg, score_result, web_research=None,
+               on_token=None):
+    """
+    Tenta Perplexity primeiro (pesquisa web em tempo real),
+    depois usa Anthropic ou Perplexity para gerar a análise final.
+    Se `web_research` já vier pronto (ex.: de fetch_research_stage) a busca não é refeita.
+    Com `on_token`, a resposta é pedida em streaming e cada trecho é repassado
+    assim que chega; on_token(None) avisa que o texto parcial deve ser descartado
+    (a Anthropic falhou no meio e a Perplexity vai recomeçar). Respostas que
+    vêm de cache_ia (ver cached_ai) chegam ao on_token num trecho só.
+    Retorna (texto_analise, ia_usada).
+    """
+    company_name = company_data.get('razao_social', '')
+    cnpj         = company_data.get('cnpj', '')
+
+    # ── 1. Pesquisa web com Perplexity ──────────────────────────
+    if web_research is None:
+        web_research = fetch_perplexity_research(company_name, cnpj, cfg)
+    prompt = build_ai_prompt(company_data, judicial_data, score_result, web_research)
+
+    # ── 2a. Análise final com Anthropic ─────────────────────────
+    ant_key = anthropic_key(cfg)
+    if ant_key:
+        streamed = False
+
+        def chamar_anthropic():
+            nonlocal streamed
+            client = anthropic_client(ant_key)
+            with provider_call('anthropic', 'messages'):
+                if on_token:
+                    with client.messages.stream(
+                        model=ANTHROPIC_MODEL,
+                        max_tokens=2500,
+                        messages=[{"role": "user", "content": prompt}]
+                    ) as stream:
+                        for text in stream.text_stream:
+                            streamed = True
+                            on_token(text)
+                        return stream.get_final_text()
                 msg = client.messages.create(
-                    model="claude-sonnet-4-20250514",
+                    model=ANTHROPIC_MODEL,
                     max_tokens=2500,
                     messages=[{"role": "user", "content": prompt}]
                 )
-                return msg.content[0].text, "Anthropic Claude"
-            except Exception as e:
-                pass  # cai para Perplexity
+                return msg.content[0].text
+
+        try:
+            text, reaproveitado = cached_ai(ANTHROPIC_MODEL, prompt, chamar_anthropic)
+            if reaproveitado and on_token:
+                on_token(text)
+            return text, "Anthropic Claude"
+        except Exception:
+            if streamed:
+                on_token(None)
+            # cai para Perplexity
 
     # ── 2b. Análise final com Perplexity (fallback) ──────────────
-    plex_cfg = cfg.get('perplexity', {})
-    if plex_cfg.get('enabled'):
-        plex_key = plex_cfg.get('api_key', '') or os.environ.get('PERPLEXITY_API_KEY', '')
-        if plex_key:
-            try:
-                payload = json.dumps({
-                    "model": "sonar-pro",
-                    "messages": [
-                        {"role": "system", "content": "Você é um analista de crédito sênior especializado em empresas brasileiras."},
-                        {"role": "user",   "content": prompt}
-                    ],
-                    "max_tokens": 2500,
-                }).encode()
-
-                req = urllib.request.Request(
-                    "https://api.perplexity.ai/chat/completions",
-                    data=payload,
-                    headers={
-                        "Authorization": f"Bearer {plex_key}",
-                        "Content-Type":  "application/json",
-                        "User-Agent":    "CreditoIA/1.0",
-                    }
-                )
-                with urllib.request.urlopen(req, timeout=30) as resp:
-                    data = json.loads(resp.read().decode())
-                    text = data.get('choices', [{}])[0].get('message', {}).get('content', '')
-                    if text:
-                        return text, "Perplexity AI"
-            except Exception as e:
-                return f"Análise IA indisponível: {str(e)}", "Erro"
+    plex_key = perplexity_key(cfg)
+    if plex_key:
+        def chamar_perplexity():
+            with http_request('POST', PERPLEXITY_URL, headers={"Authorization": f"Bearer {plex_key}"},
+                              json_body=analysis_payload(prompt, bool(on_token)), timeout=30,
+                              stream=bool(on_token), provider='perplexity') as resp:
+                if on_token:
+                    text = _read_sse_completion(resp.iter_lines(), on_token)
+                    if not text:
+                        raise ValueError("resposta vazia")
+                    return text
+                return completion_text(resp.json())
 
-    return (
-        "Nenhuma IA configurada. Acesse Configurações de API e insira a chave "
-        "da Anthropic ou da Perplexity para gerar a análise automática.",
-        "N/A"
-    )
+        try:
+            text, reaproveitado = cached_ai('sonar-pro', prompt, chamar_perplexity)
+            if text:
+                if reaproveitado and on_token:
+                    on_token(text)
+                return text, "Perplexity AI"
+        except Exception as e:
+            return f"Análise IA indisponível: {str(e)}", "Erro"
+
+    return NO_AI_MESSAGE, "N/A"
 
 # ─────────────────────────────────────────
 # PDF REPORT GENERATOR
@@ -561,13 +2498,12 @@ def generate_pdf(consulta_id, company_data, score_result, ai_analysis, valor_sol
         from reportlab.lib import colors
         from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, HRFlowable
         from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
-        import matplotlib
-        matplotlib.use('Agg')
-        import matplotlib.pyplot as plt
-        import io
+        from charts import score_charts
 
         pdf_path = os.path.join(BASE_DIR, 'db', f'relatorio_{consulta_id}.pdf')
-        doc = SimpleDocTemplate(pdf_path, pagesize=A4,
+        # Gera em arquivo temporário e troca no fim: quem baixa nunca vê um PDF pela metade.
+        tmp_path = f"{pdf_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        doc = SimpleDocTemplate(tmp_path, pagesize=A4,
             leftMargin=2*cm, rightMargin=2*cm, topMargin=2*cm, bottomMargin=2*cm)
 
         story = []
@@ -659,70 +2595,8 @@ def generate_pdf(consulta_id, company_data, score_result, ai_analysis, valor_sol
         story.append(Spacer(1, 0.5*cm))
         story.append(Paragraph("3. SCORE DE RISCO", h2_style))
 
-        # Generate matplotlib gauge chart
-        fig, ax = plt.subplots(figsize=(6, 3), subplot_kw={'projection': 'polar'})
         score = score_result['score']
-        
-        # Create gauge
-        fig2, (ax1, ax2) = plt.subplots(1, 2, figsize=(10, 4))
-        
-        # Score gauge
-        theta = score / 100 * math.pi
-        colors_gauge = ['#ef4444', '#f97316', '#eab308', '#84cc16', '#10b981']
-        for i, c in enumerate(colors_gauge):
-            ax1.bar(0, 1, bottom=0, color=c, alpha=0.8, width=0.8)
-        
-        ax1.set_xlim(-1.5, 1.5)
-        ax1.set_ylim(-0.2, 1.2)
-        ax1.set_aspect('equal')
-        ax1.axis('off')
-        
-        # Draw semicircle gauge properly
-        ax1.clear()
-        for i in range(100):
-            ang = math.pi - (i/100)*math.pi
-            ang_next = math.pi - ((i+1)/100)*math.pi
-            c_idx = min(int(i/25), 3)
-            c = ['#ef4444','#f97316','#eab308','#10b981'][c_idx]
-            x = [0, math.cos(ang)*0.9, math.cos(ang_next)*0.9, 0]
-            y = [0, math.sin(ang)*0.9, math.sin(ang_next)*0.9, 0]
-            ax1.fill(x, y, color=c, alpha=0.7)
-        
-        # Needle
-        needle_ang = math.pi - (score/100)*math.pi
-        ax1.plot([0, math.cos(needle_ang)*0.75], [0, math.sin(needle_ang)*0.75], 
-                 'k-', linewidth=3, solid_capstyle='round')
-        ax1.plot(0, 0, 'ko', markersize=8)
-        ax1.text(0, -0.15, f'{score}/100', ha='center', va='center', fontsize=16, fontweight='bold')
-        ax1.text(0, -0.32, score_result['risco'], ha='center', va='center', fontsize=12,
-                 color=score_result['risco_color'], fontweight='bold')
-        ax1.text(-0.95, -0.1, 'MUITO\nALTO', ha='center', fontsize=7, color='#ef4444')
-        ax1.text(0.95, -0.1, 'BAIXO', ha='center', fontsize=7, color='#10b981')
-        ax1.set_xlim(-1.2, 1.2); ax1.set_ylim(-0.5, 1.1)
-        ax1.axis('off')
-        ax1.set_title('Score da Empresa', fontsize=11, fontweight='bold', pad=10)
-
-        # Reasons bar chart
-        reasons = score_result.get('reasons', [])
-        labels = [r[1][:35]+'...' if len(r[1])>35 else r[1] for r in reasons[:8]]
-        values = [r[2] for r in reasons[:8]]
-        bar_colors = ['#10b981' if v > 0 else '#ef4444' for v in values]
-        bars = ax2.barh(range(len(labels)), values, color=bar_colors, alpha=0.8)
-        ax2.set_yticks(range(len(labels)))
-        ax2.set_yticklabels(labels, fontsize=7)
-        ax2.axvline(0, color='black', linewidth=0.8)
-        ax2.set_title('Fatores de Avaliação', fontsize=11, fontweight='bold')
-        ax2.set_xlabel('Impacto no Score')
-        
-        plt.tight_layout()
-        img_buf = io.BytesIO()
-        plt.savefig(img_buf, format='PNG', dpi=150, bbox_inches='tight')
-        img_buf.seek(0)
-        plt.close()
-
-        from reportlab.platypus import Image as RLImage
-        img = RLImage(img_buf, width=17*cm, height=7*cm)
-        story.append(img)
+        story.append(score_charts(score_result, 17*cm, 7*cm))
         story.append(Spacer(1, 0.3*cm))
 
         # Score table
@@ -792,106 +2666,194 @@ def generate_pdf(consulta_id, company_data, score_result, ai_analysis, valor_sol
             ParagraphStyle('Disclaimer', parent=small_style, textColor=colors.HexColor('#9ca3af'))))
 
         doc.build(story)
+        os.replace(tmp_path, pdf_path)
         return pdf_path
     except Exception as e:
         print(f"PDF error: {e}")
         import traceback; traceback.print_exc()
         return None
 
-# ─────────────────────────────────────────
-# ROUTES
-# ─────────────────────────────────────────
-@app.route('/')
-def dashboard():
+_pdf_locks = {}
+_pdf_locks_guard = threading.Lock()
+
+def _stored_score(c, dados):
+    """
+    score_result de uma consulta gravada. Linhas antigas não guardavam o
+    resultado completo: os fatores são recalculados, mas score, risco e valor
+    sugerido continuam os que foram gravados.
+    """
+    if dados.get('score'):
+        return dados['score']
+    company = dados.get('company', {})
+    result = calculate_score(company, dados.get('judicial') or {}, dados.get('social') or {},
+                             c['valor_solicitado'] or 0, company.get('capital_social', '0'))
+    result['score'] = c['score_empresa']
+    result['risco'] = c['risco']
+    result['risco_color'] = {'BAIXO': '#10b981', 'MÉDIO': '#f59e0b', 'ALTO': '#ef4444'}.get(c['risco'], '#dc2626')
+    result['valor_sugerido'] = c['valor_sugerido'] or 0
+    result['multiplicador'] = (c['valor_sugerido'] or 0) / c['valor_solicitado'] if c['valor_solicitado'] else 0
+    return result
+
+def ensure_pdf(consulta_id):
+    """
+    Caminho do PDF da consulta, gerando-o na primeira vez a partir dos payloads gravados.
+    O resultado fica registrado em `relatorios` e os próximos pedidos vão direto ao disco.
+    """
     conn = get_db()
-    consultas = conn.execute(
-        "SELECT * FROM consultas ORDER BY created_at DESC LIMIT 20"
-    ).fetchall()
-    conn.close()
-    return render_template('dashboard.html', consultas=consultas)
+    r = conn.execute("SELECT pdf_path FROM relatorios WHERE consulta_id=?", (consulta_id,)).fetchone()
+    if r and r['pdf_path'] and os.path.exists(r['pdf_path']):
+        return r['pdf_path']
 
-@app.route('/nova-consulta')
-def nova_consulta():
-    cfg = get_api_config()
-    return render_template('nova_consulta.html', cfg=cfg)
+    with _pdf_locks_guard:
+        lock = _pdf_locks.setdefault(consulta_id, threading.Lock())
+    try:
+        with lock:
+            return _render_pdf(consulta_id)
+    finally:
+        with _pdf_locks_guard:
+            _pdf_locks.pop(consulta_id, None)
 
-@app.route('/api/fetch-cnpj', methods=['POST'])
-def api_fetch_cnpj():
-    data = request.json
-    cnpj = clean_cnpj(data.get('cnpj', ''))
-    if len(cnpj) != 14:
-        return jsonify({'error': 'CNPJ inválido'}), 400
-    
-    cfg = get_api_config()
-    
-    # Fetch from all enabled APIs
-    opencnpj_data = fetch_opencnpj(cnpj, cfg)
-    brasilapi_data = fetch_brasilapi(cnpj, cfg)
-    cnpja_data = fetch_cnpja(cnpj, cfg)
-    invertexto_data = fetch_invertexto(cnpj, cfg)
-    
-    merged = merge_company_data(opencnpj_data, brasilapi_data, cnpja_data)
-    
-    return jsonify({
-        'success': True,
-        'data': merged,
-        'sources': {
-            'opencnpj': bool(opencnpj_data and 'cnpj' in opencnpj_data),
-            'brasilapi': bool(brasilapi_data and 'cnpj' in brasilapi_data),
-            'cnpja': bool(cnpja_data),
-            'invertexto': bool(invertexto_data),
-        }
-    })
+def _render_pdf(consulta_id):
+    conn = get_db()
+    r = conn.execute("SELECT pdf_path FROM relatorios WHERE consulta_id=?", (consulta_id,)).fetchone()
+    if r and r['pdf_path'] and os.path.exists(r['pdf_path']):
+        return r['pdf_path']
+    c = conn.execute("SELECT * FROM consultas WHERE id=?", (consulta_id,)).fetchone()
+    dados = load_dados(conn, consulta_id) if c else {}
+    if not dados:
+        return None
 
-@app.route('/api/analisar', methods=['POST'])
-def api_analisar():
-    data = request.json
-    cnpj = clean_cnpj(data.get('cnpj', ''))
-    valor_solicitado = float(data.get('valor_solicitado', 0))
-    parcelas = int(data.get('parcelas', 12))
-    juros = float(data.get('juros', 2.5))
-    company_data = data.get('company_data', {})
-    
-    cfg = get_api_config()
-    
-    # Judicial data
-    nome = company_data.get('razao_social', '')
-    judicial_data = fetch_datajud(nome, cfg) if nome else {}
-    
+    with timed('etapa:pdf', consulta_id=consulta_id):
+        pdf_path = generate_pdf(consulta_id, dados.get('company', {}), _stored_score(c, dados),
+                                dados.get('ai') or '', c['valor_solicitado'] or 0, c['parcelas'], c['juros'])
+    if not (pdf_path and os.path.exists(pdf_path)):
+        return None
+
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db()
+    conn.execute("UPDATE consultas SET relatorio_path=?, updated_at=? WHERE id=?",
+                 (pdf_path, now, consulta_id))
+    conn.execute("""
+        INSERT OR REPLACE INTO relatorios (consulta_id, pdf_path, tamanho_bytes, gerado_em)
+        VALUES (?,?,?,?)
+    """, (consulta_id, pdf_path, os.path.getsize(pdf_path), now))
+    conn.commit()
+    return pdf_path
+
+# ─────────────────────────────────────────
+# ANALYSIS PIPELINE (JOB QUEUE)
+# ─────────────────────────────────────────
+# /api/analisar só grava um job em analise_jobs e devolve o id; o trabalho
+# pesado roda em um pool de threads local. Cada etapa concluída é salva em
+# `estado`, então um retry recomeça da etapa que falhou. Um job em execução
+# atualiza updated_at a cada etapa; se ficar JOB_STALE_SECONDS sem atualizar
+# (o worker que o pegou morreu), a varredura de cada processo o devolve à fila,
+# até JOB_MAX_TENTATIVAS vezes, e depois o marca como erro.
+JOB_WORKERS        = int(os.environ.get('JOB_WORKERS', 2))
+JOB_MAX_TENTATIVAS = int(os.environ.get('JOB_MAX_TENTATIVAS', 3))
+JOB_STALE_SECONDS  = int(os.environ.get('JOB_STALE_SECONDS', 600))
+JOB_SWEEP_INTERVAL = float(os.environ.get('JOB_SWEEP_INTERVAL', 60))
+_job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='analise')
+
+def _job_score(job, judicial_data, social_data):
+    p = job['params']
+    capital = p['company_data'].get('capital_social', '0')
+    return calculate_score(p['company_data'], judicial_data, social_data, p['valor_solicitado'], capital)
+
+def social_placeholder():
     # Social placeholder (scraping would require browser)
-    social_data = {
+    return {
         'instagram': None,
         'linkedin': None,
         'facebook': None,
         'controversias': False,
         'nota': 'Análise de redes sociais requer configuração de scraping adicional.'
     }
-    
-    # Score
-    capital = company_data.get('capital_social', '0')
-    score_result = calculate_score(company_data, judicial_data, social_data, valor_solicitado, capital)
-    
-    # AI Analysis (retorna tupla: texto, ia_usada)
-    ai_text, ia_usada = ai_analyze(company_data, judicial_data, social_data, cfg, score_result)
-    
-    # Save to DB
-    from datetime import datetime
+
+def stage_pesquisa(job):
+    social_data = social_placeholder()
+    cfg = job['cfg']
+    score_sent = threading.Event()
+
+    def send_score(judicial_data):
+        if not score_sent.is_set():
+            score_sent.set()
+            emit_event(job['id'], 'score', {'score': _job_score(job, judicial_data, social_data)})
+
+    # O score só depende do DataJud: sai assim que ele responde, sem esperar a Perplexity.
+    if not (cfg.get('datajud', {}).get('enabled') and job['params']['company_data'].get('razao_social')):
+        send_score({})
+
+    def on_result(name, result):
+        fonte, q = name
+        if fonte == 'datajud':
+            emit_event(job['id'], 'datajud', {'judicial': result or {}})
+            send_score(result or {})
+        else:
+            emit_event(job['id'], 'pesquisa', {'busca': q, 'texto': result})
+
+    judicial_data, web_research = fetch_research_stage(job['params']['company_data'], cfg,
+                                                       on_result=on_result)
+    send_score(judicial_data)
+    return {'judicial': judicial_data, 'social': social_data, 'web_research': web_research or ''}
+
+def stage_score(job):
+    e = job['estado']
+    return {'score': _job_score(job, e['judicial'], e['social'])}
+
+def _token_emitter(job_id, interval=0.2):
+    """Agrupa os trechos do streaming da IA em eventos 'ia_delta' a cada `interval` s."""
+    buf, last = [], [time.time()]
+
+    def flush():
+        if buf:
+            emit_event(job_id, 'ia_delta', {'texto': ''.join(buf)})
+            buf.clear()
+        last[0] = time.time()
+
+    def on_token(text):
+        if text is None:
+            buf.clear()
+            emit_event(job_id, 'ia_reset', {})
+            return
+        buf.append(text)
+        if time.time() - last[0] >= interval:
+            flush()
+
+    return on_token, flush
+
+def stage_ia(job):
+    p, e = job['params'], job['estado']
+    on_token, flush = _token_emitter(job['id'])
+    ai_text, ia_usada = ai_analyze(p['company_data'], e['judicial'], e['social'], job['cfg'],
+                                   e['score'], web_research=e['web_research'], on_token=on_token)
+    flush()
+    emit_event(job['id'], 'ia', {'ai_analysis': ai_text, 'ia_usada': ia_usada})
+    return {'ai': ai_text, 'ia_usada': ia_usada}
+
+def prepare_consulta(params, company_data, estado):
+    """
+    Monta, fora de qualquer transação, tudo o que uma análise grava: linha de
+    consultas, payloads já comprimidos, sócios, processos do DataJud e linha
+    do índice de busca. `estado` traz judicial, social, ai, ia_usada e score.
+    """
+    score_result = estado['score']
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    qsa  = company_data.get('QSA', company_data.get('qsa', []))
-    conn = get_db()
-    cur = conn.execute("""
-        INSERT INTO consultas
-        (cnpj, razao_social, nome_fantasia, valor_solicitado, parcelas, juros,
-         score_empresa, score_controladores, valor_sugerido, risco,
-         situacao_cadastral, porte_empresa, natureza_juridica, capital_social,
-         data_inicio_atividade, municipio, uf, email, cnae_principal,
-         num_socios, num_processos, dados_json, created_at, updated_at)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-    """, (
-        cnpj,
+    qsa = company_data.get('QSA', company_data.get('qsa', []))
+    socios = [(
+        s.get('nome_socio', s.get('nome', '')),
+        s.get('cnpj_cpf_socio', s.get('cpf_cnpj', '')),
+        s.get('qualificacao_socio', s.get('qualificacao', '')),
+        s.get('data_entrada_sociedade', ''),
+        s.get('faixa_etaria', ''),
+        s.get('identificador_socio', s.get('identificador', '')),
+    ) for s in qsa]
+    processos = parse_processos(estado['judicial'])
+    consulta = (
+        params['cnpj'],
         company_data.get('razao_social', ''),
         company_data.get('nome_fantasia', ''),
-        valor_solicitado, parcelas, juros,
+        params['valor_solicitado'], params['parcelas'], params['juros'],
         score_result['score'],
         score_result['score'],
         score_result['valor_sugerido'],
@@ -905,70 +2867,1351 @@ def api_analisar():
         company_data.get('uf', ''),
         company_data.get('email', ''),
         str(company_data.get('cnae_principal', company_data.get('cnae_fiscal', ''))),
-        len(qsa),
-        0,
-        json.dumps({'company': company_data, 'judicial': judicial_data, 'social': social_data, 'ai': ai_text, 'ia_usada': ia_usada}, ensure_ascii=False),
+        len(socios),
+        max(processos_total(estado['judicial']), len(processos)),
+        score_result.get('politica_versao'),
         now, now
-    ))
+    )
+    payloads = encode_dados({'company': company_data, 'judicial': estado['judicial'],
+                             'social': estado['social'], 'ai': estado['ai'],
+                             'ia_usada': estado['ia_usada'], 'score': score_result})
+    busca = ({**company_data, 'cnpj': params['cnpj']}, [s[0] for s in socios], estado['ai'])
+    return {'consulta': consulta, 'payloads': payloads, 'socios': socios,
+            'processos': processos, 'busca': busca}
+
+def write_consulta(conn, linhas):
+    """Grava o que prepare_consulta montou, na transação de quem chamou, e retorna o id."""
+    cur = conn.execute("""
+        INSERT INTO consultas
+        (cnpj, razao_social, nome_fantasia, valor_solicitado, parcelas, juros,
+         score_empresa, score_controladores, valor_sugerido, risco,
+         situacao_cadastral, porte_empresa, natureza_juridica, capital_social,
+         data_inicio_atividade, municipio, uf, email, cnae_principal,
+         num_socios, num_processos, politica_versao, created_at, updated_at)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    """, linhas['consulta'])
     consulta_id = cur.lastrowid
+    write_dados(conn, consulta_id, linhas['payloads'])
+    conn.executemany("""
+        INSERT INTO socios (consulta_id, nome, cpf_cnpj, qualificacao, data_entrada, faixa_etaria, identificador)
+        VALUES (?,?,?,?,?,?,?)
+    """, [(consulta_id, *s) for s in linhas['socios']])
+    conn.executemany("""
+        INSERT INTO processos (consulta_id, numero, tribunal, classe, assunto, data_ajuizamento,
+                               situacao, valor_causa, partes)
+        VALUES (?,?,?,?,?,?,?,?,?)
+    """, [(consulta_id, *p) for p in linhas['processos']])
+    index_consulta(conn, consulta_id, *linhas['busca'])
+    return consulta_id
 
-    # Salvar sócios separadamente
-    for s in qsa:
-        conn.execute("""
-            INSERT INTO socios (consulta_id, nome, cpf_cnpj, qualificacao, data_entrada, faixa_etaria, identificador)
-            VALUES (?,?,?,?,?,?,?)
-        """, (
-            consulta_id,
-            s.get('nome_socio', s.get('nome', '')),
-            s.get('cnpj_cpf_socio', s.get('cpf_cnpj', '')),
-            s.get('qualificacao_socio', s.get('qualificacao', '')),
-            s.get('data_entrada_sociedade', ''),
-            s.get('faixa_etaria', ''),
-            s.get('identificador_socio', s.get('identificador', '')),
-        ))
-    
-    # Generate PDF
-    pdf_path = generate_pdf(consulta_id, company_data, score_result, ai_text, valor_solicitado, parcelas, juros)
-    if pdf_path and os.path.exists(pdf_path):
-        size = os.path.getsize(pdf_path)
-        conn.execute("UPDATE consultas SET relatorio_path=?, updated_at=? WHERE id=?",
-                     (pdf_path, now, consulta_id))
-        conn.execute("""
-            INSERT OR REPLACE INTO relatorios (consulta_id, pdf_path, tamanho_bytes, gerado_em)
-            VALUES (?,?,?,?)
-        """, (consulta_id, pdf_path, size, now))
-    
-    conn.commit()
-    conn.close()
-    
-    return jsonify({
+def stage_gravacao(job):
+    # Serialização e compressão antes do BEGIN: o lock de escrita dura só os INSERTs.
+    linhas = prepare_consulta(job['params'], job['params']['company_data'], job['estado'])
+    conn = get_db()
+    with conn:
+        consulta_id = write_consulta(conn, linhas)
+        # O id da consulta vai para o job na mesma transação: um retry nunca duplica a linha.
+        conn.execute("UPDATE analise_jobs SET consulta_id=? WHERE id=?", (consulta_id, job['id']))
+    emit_event(job['id'], 'consulta', {'consulta_id': consulta_id})
+    # O PDF é gerado sob demanda no primeiro download (ensure_pdf).
+    emit_event(job['id'], 'pdf', {'url': f"/download-pdf/{consulta_id}"})
+    return {'consulta_id': consulta_id}
+
+# (etapa, progresso ao concluir, função)
+PIPELINE = [
+    ('pesquisa',  30, stage_pesquisa),
+    ('score',     40, stage_score),
+    ('ia',        80, stage_ia),
+    ('gravacao', 100, stage_gravacao),
+]
+
+def emit_event(job_id, tipo, dados):
+    """Grava um evento do job; /api/jobs/<id>/eventos repassa via SSE (de qualquer worker)."""
+    conn = get_db()
+    conn.execute("INSERT INTO job_eventos (job_id, tipo, dados, created_at) VALUES (?,?,?,?)",
+                 (job_id, tipo, json.dumps(dados, ensure_ascii=False),
+                  datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    conn.commit()
+
+def _job_set(job_id, **fields):
+    if 'estado' in fields:
+        fields['estado'] = json.dumps(fields['estado'], ensure_ascii=False)
+    fields['updated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cols = ', '.join(f"{k}=?" for k in fields)
+    conn = get_db()
+    conn.execute(f"UPDATE analise_jobs SET {cols} WHERE id=?", (*fields.values(), job_id))
+    conn.commit()
+
+def enqueue_analysis(params):
+    now  = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db()
+    cur = conn.execute(
+        "INSERT INTO analise_jobs (status, parametros, estado, created_at, updated_at) VALUES ('pendente',?,?,?,?)",
+        (json.dumps(params, ensure_ascii=False), '{}', now, now)
+    )
+    job_id = cur.lastrowid
+    conn.commit()
+    submit_job(job_id)
+    return job_id
+
+def submit_job(job_id):
+    """Coloca o job para rodar: no event loop assíncrono (ASYNC_PIPELINE) ou no pool de threads."""
+    if ASYNC_PIPELINE:
+        asyncio.run_coroutine_threadsafe(run_job_async(job_id), async_loop())
+    else:
+        _job_pool.submit(run_job, job_id)
+
+def run_job(job_id):
+    try:
+        _run_job(job_id)
+    except Exception as e:
+        print(f"Job {job_id} error: {e}")
+        import traceback; traceback.print_exc()
+        _job_set(job_id, status='erro', erro=str(e))
+
+def _claim_job(job_id):
+    """Claim atômico: só um worker (de qualquer processo) executa o job. Retorna a linha ou None."""
+    now  = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db()
+    claimed = conn.execute(
+        "UPDATE analise_jobs SET status='executando', erro=NULL, updated_at=? WHERE id=? AND status='pendente'",
+        (now, job_id)
+    ).rowcount
+    conn.commit()
+    if not claimed:
+        return None
+    return conn.execute("SELECT parametros, estado, tentativas, consulta_id FROM analise_jobs WHERE id=?",
+                        (job_id,)).fetchone()
+
+def _load_job(job_id, row):
+    job = {
+        'id':     job_id,
+        'params': json.loads(row['parametros']),
+        'estado': json.loads(row['estado'] or '{}'),
+        'cfg':    get_api_config(),
+    }
+    feitas = job['estado'].setdefault('etapas_ok', [])
+    if row['consulta_id'] and 'gravacao' not in feitas:
+        job['estado']['consulta_id'] = row['consulta_id']
+        feitas.append('gravacao')
+    return job
+
+def _run_job(job_id):
+    row = _claim_job(job_id)
+    if not row:
+        return
+    try:
+        _execute_pipeline(job_id, row)
+    except Exception as e:
+        release_db()
+        emit_event(job_id, 'erro', {'erro': str(e)})
+        raise
+
+def _execute_pipeline(job_id, row):
+    job = _load_job(job_id, row)
+    tentativas = row['tentativas'] or 0
+    feitas = job['estado']['etapas_ok']
+
+    emit_event(job_id, 'cadastro', {'company': job['params']['company_data']})
+    for etapa, progresso, fn in PIPELINE:
+        if etapa in feitas:
+            continue
+        _job_set(job_id, etapa=etapa)
+        emit_event(job_id, 'etapa', {'etapa': etapa})
+        for tentativa in range(1, JOB_MAX_TENTATIVAS + 1):
+            try:
+                with timed(f"etapa:{etapa}", consulta_id=job['estado'].get('consulta_id')):
+                    job['estado'].update(fn(job))
+                break
+            except Exception as e:
+                release_db()
+                tentativas += 1
+                print(f"Job {job_id} etapa {etapa} falhou ({tentativa}/{JOB_MAX_TENTATIVAS}): {e}")
+                if tentativa == JOB_MAX_TENTATIVAS:
+                    _job_set(job_id, status='erro', erro=f"{etapa}: {e}", tentativas=tentativas)
+                    emit_event(job_id, 'erro', {'etapa': etapa, 'erro': str(e)})
+                    return
+                time.sleep(2 ** tentativa)
+        feitas.append(etapa)
+        _job_set(job_id, progresso=progresso, estado=job['estado'], tentativas=tentativas)
+
+    _job_set(job_id, status='concluido')
+    emit_event(job_id, 'concluido', {'resultado': job_resultado(job['estado'])})
+
+def retry_job(job_id):
+    """Recoloca um job com erro na fila; as etapas já concluídas não são refeitas."""
+    conn = get_db()
+    ok = conn.execute(
+        "UPDATE analise_jobs SET status='pendente', retomadas=0, updated_at=? WHERE id=? AND status='erro'",
+        (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), job_id)
+    ).rowcount
+    conn.commit()
+    if ok:
+        submit_job(job_id)
+    return bool(ok)
+
+def requeue_stale_jobs():
+    """
+    Devolve à fila os jobs presos em 'executando' há mais de JOB_STALE_SECONDS
+    (ou marca erro nos que já foram retomados JOB_MAX_TENTATIVAS vezes).
+    Retorna os ids que voltaram para 'pendente'.
+    """
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    stale = datetime.fromtimestamp(time.time() - JOB_STALE_SECONDS).strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db()
+    conn.execute("BEGIN IMMEDIATE")   # com vários processos varrendo, cada job é pego por um só
+    try:
+        presos = conn.execute("SELECT id, retomadas FROM analise_jobs WHERE status='executando' AND updated_at < ?",
+                              (stale,)).fetchall()
+        perdidos = [r['id'] for r in presos if (r['retomadas'] or 0) >= JOB_MAX_TENTATIVAS]
+        ids = [r['id'] for r in presos if (r['retomadas'] or 0) < JOB_MAX_TENTATIVAS]
+        conn.executemany("UPDATE analise_jobs SET status='erro', erro='execução interrompida', updated_at=? WHERE id=?",
+                         [(now, i) for i in perdidos])
+        conn.executemany("""UPDATE analise_jobs SET status='pendente', retomadas=COALESCE(retomadas, 0) + 1,
+                            updated_at=? WHERE id=?""", [(now, i) for i in ids])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    for job_id in perdidos:
+        emit_event(job_id, 'erro', {'erro': 'execução interrompida'})
+    return ids
+
+def _job_sweeper():
+    while True:
+        time.sleep(JOB_SWEEP_INTERVAL)
+        try:
+            for job_id in requeue_stale_jobs():
+                print(f"Job {job_id} parado há mais de {JOB_STALE_SECONDS}s: de volta à fila")
+                submit_job(job_id)
+        except Exception as e:
+            print(f"Varredura de jobs falhou: {e}")
+
+def resume_jobs():
+    """
+    Na subida do processo: retoma jobs pendentes e os que ficaram presos em
+    execução, e inicia a varredura periódica dos que travarem depois.
+    """
+    requeue_stale_jobs()
+    conn = get_db()
+    # Eventos só servem enquanto alguém acompanha a análise.
+    conn.execute("DELETE FROM job_eventos WHERE created_at < ?",
+                 (datetime.fromtimestamp(time.time() - DAY).strftime('%Y-%m-%d %H:%M:%S'),))
+    conn.commit()
+    ids = [r['id'] for r in conn.execute("SELECT id FROM analise_jobs WHERE status='pendente' ORDER BY id")]
+    for job_id in ids:
+        submit_job(job_id)
+    threading.Thread(target=_job_sweeper, name='jobs-varredura', daemon=True).start()
+
+def job_resultado(estado):
+    """Mesmo formato que /api/analisar devolvia quando era síncrono."""
+    return {
+        'success':     True,
+        'consulta_id': estado.get('consulta_id'),
+        'score':       estado.get('score'),
+        'ai_analysis': estado.get('ai'),
+        'ia_usada':    estado.get('ia_usada'),
+        'judicial':    estado.get('judicial'),
+        'social':      estado.get('social'),
+        'has_pdf':     bool(estado.get('consulta_id')),
+    }
+
+# ─────────────────────────────────────────
+# PIPELINE ASSÍNCRONO (ASYNCIO)
+# ─────────────────────────────────────────
+# Com ASYNC_PIPELINE (padrão), os jobs de /api/analisar rodam como corrotinas
+# num event loop do processo (uma thread só): DataJud e Perplexity vão por um
+# httpx.AsyncClient compartilhado e a análise final por anthropic.AsyncAnthropic.
+# Enquanto uma análise espera um upstream, as outras andam, então um processo
+# leva até ASYNC_MAX_JOBS análises ao mesmo tempo em vez de JOB_WORKERS.
+# Cache, leases, limitador de taxa e circuit breaker são os mesmos do caminho
+# síncrono; o que toca o SQLite (milissegundos) roda em asyncio.to_thread.
+ASYNC_PIPELINE = os.environ.get('ASYNC_PIPELINE', '1') == '1'
+ASYNC_MAX_JOBS = int(os.environ.get('ASYNC_MAX_JOBS', 50))
+_async = {'pid': None}
+_async_lock = threading.Lock()
+
+def async_loop():
+    """Event loop do processo (criado na primeira vez, de novo depois de um fork)."""
+    with _async_lock:
+        if _async['pid'] != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='asyncio', daemon=True).start()
+            _async.update(pid=os.getpid(), loop=loop, http=None, anthropic={},
+                          jobs=asyncio.Semaphore(ASYNC_MAX_JOBS), fetch_flight=AsyncSingleFlight(),
+                          ai_flight=AsyncSingleFlight())
+        return _async['loop']
+
+class AsyncSingleFlight:
+    """
+    SingleFlight para corrotinas de um mesmo event loop. A chamada roda numa
+    task própria e cada interessado (o líder também) só a espera com shield:
+    o prazo de um job cancela a espera dele, nunca a chamada dos outros.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        shared = task is not None
+        if not shared:
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(partial(self._done, key))
+        return await asyncio.shield(task), shared
+
+    def _done(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()   # ninguém esperando: não avisa "exception was never retrieved"
+
+def async_http():
+    if _async['http'] is None:
+        import httpx
+        _async['http'] = httpx.AsyncClient(
+            headers={'User-Agent': USER_AGENT},
+            limits=httpx.Limits(max_connections=HTTP_POOL_SIZE * 4, max_keepalive_connections=HTTP_POOL_SIZE),
+        )
+    return _async['http']
+
+def anthropic_async_client(api_key):
+    client = _async['anthropic'].get(api_key)
+    if client is None:
+        import anthropic as ant_sdk
+        client = _async['anthropic'][api_key] = ant_sdk.AsyncAnthropic(api_key=api_key, timeout=ANTHROPIC_TIMEOUT)
+    return client
+
+async def rate_acquire_async(key):
+    params = _rate_params(key)
+    if not params:
+        return
+    inicio = time.monotonic()
+    while True:
+        espera = await asyncio.to_thread(lambda: _take_token(get_db(), key, *params))
+        if not espera:
+            return
+        await asyncio.sleep(_rate_wait(key, inicio, espera))
+
+@asynccontextmanager
+async def provider_call_async(key, endpoint=None):
+    """provider_call para corrotinas: a espera pelo limitador não ocupa thread."""
+    try:
+        await rate_acquire_async(key)
+    except RateLimitedError as e:
+        log_api_call(key, endpoint, 'limite_taxa', 0, e)
+        raise
+    health = _provider_enter(key, endpoint)
+    start = time.monotonic()
+    try:
+        yield health
+    except Exception as e:
+        # Num 429 o _provider_exit grava o bloqueio (rate_block) no SQLite: fora do loop.
+        await asyncio.to_thread(_provider_exit, key, endpoint, health, start, e)
+        raise
+    except BaseException:
+        # CancelledError (prazo, shield cancelado): sem isso o meio-aberto ficaria preso em probing.
+        health.release()
+        raise
+    _provider_exit(key, endpoint, health, start)
+
+async def http_request_async(method, url, headers=None, json_body=None, timeout=None, stream=False, provider=None):
+    """
+    http_request com httpx.AsyncClient: devolve o httpx.Response (com
+    stream=True, só os cabeçalhos foram lidos e quem chamou fecha com aclose()).
+    """
+    import httpx
+    timeout = timeout or HTTP_READ_TIMEOUT
+
+    async def send(read_timeout):
+        req = async_http().build_request(method, url, headers=headers, json=json_body,
+                                         timeout=httpx.Timeout(read_timeout, connect=HTTP_CONNECT_TIMEOUT))
+        resp = await async_http().send(req, stream=stream)
+        if resp.is_error:
+            if stream:
+                await resp.aclose()
+            resp.raise_for_status()
+        return resp
+
+    if provider is None:
+        return await send(timeout)
+    for tentativa in range(RATE_RETRIES + 1):
+        try:
+            async with provider_call_async(provider, f"{method} {urlsplit(url).path}") as health:
+                return await send(health.timeout(timeout))
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 429 or tentativa == RATE_RETRIES:
+                raise
+
+async def _load_with_lease_async(fonte, chave, loader):
+    dono = f"{os.getpid()}:async:{id(asyncio.current_task())}"
+    inicio = time.time()
+    espera, livre = FETCH_LEASE_POLL, True
+    while _esperar_lider(inicio):
+        if livre and await asyncio.to_thread(_acquire_lease, fonte, chave, dono):
+            try:
+                data = await loader()
+                await asyncio.to_thread(_cache_put, fonte, chave, data)
+                return data
+            finally:
+                await asyncio.to_thread(_release_lease, fonte, chave, dono)
+        pausa, espera = _pausa_lider(espera)
+        await asyncio.sleep(pausa)
+        situacao, data = await asyncio.to_thread(_situacao_lider, fonte, chave, inicio)
+        if situacao == 'pronto':
+            return data
+        livre = situacao == 'livre'
+    if time.time() - inicio < FETCH_LEASE_TTL:
+        return {}
+    data = await loader()
+    await asyncio.to_thread(_cache_put, fonte, chave, data)
+    return data
+
+async def _load_and_store_async(fonte, chave, loader):
+    data, _ = await _async['fetch_flight'].do((fonte, chave), partial(_load_with_lease_async, fonte, chave, loader))
+    return data
+
+def _revalidated(fonte, chave, task):
+    with _revalidating_lock:
+        _revalidating.discard((fonte, chave))
+    if not task.cancelled() and task.exception():
+        print(f"Revalidação {fonte}/{chave} falhou: {task.exception()}")
+
+async def cached_fetch_async(fonte, chave, loader, refresh=False):
+    """cached_fetch com loader assíncrono; a revalidação stale vira uma task em segundo plano."""
+    if not refresh:
+        row = await asyncio.to_thread(_cache_get, fonte, chave)
+        if row:
+            data, revalidar = _cache_valido(fonte, row)
+            if revalidar:
+                with _revalidating_lock:
+                    novo = (fonte, chave) not in _revalidating
+                    _revalidating.add((fonte, chave))
+                if novo:
+                    ctx = contextvars.copy_context()
+                    ctx.run(_prioridade.set, 'lote')
+                    task = asyncio.create_task(_load_and_store_async(fonte, chave, loader), context=ctx)
+                    task.add_done_callback(partial(_revalidated, fonte, chave))
+            if data is not None:
+                return data
+    return await _load_and_store_async(fonte, chave, loader)
+
+async def cached_ai_async(modelo, prompt, loader, ttl=AI_CACHE_TTL):
+    chave = ai_cache_key(modelo, prompt)
+    texto = await asyncio.to_thread(_ai_cache_get, chave)
+    if texto is not None:
+        return texto, True
+
+    async def carregar():
+        texto = await loader()
+        if texto:
+            await asyncio.to_thread(_ai_cache_put, chave, modelo, texto, ttl)
+        return texto
+    return await _async['ai_flight'].do(chave, carregar)
+
+async def fetch_datajud_async(nome_empresa, cfg):
+    if not cfg.get('datajud', {}).get('enabled'):
+        return {}
+
+    async def buscar():
+        url = "https://api-publica.datajud.cnj.jus.br/api_publica_tjsp/_search"
+        try:
+            query = {"query": {"match": {"partes.nome": nome_empresa}}, "size": 10}
+            data = (await http_request_async('POST', url, json_body=query, timeout=DATAJUD_TIMEOUT,
+                                             provider='datajud')).json()
+            return data if 'error' not in data else {}
+        except Exception as e:
+            print(f"DataJud error: {e}")
+            return {}
+    return await cached_fetch_async('datajud', ' '.join(nome_empresa.upper().split()), buscar)
+
+async def fetch_perplexity_query_async(q, key):
+    async def buscar():
+        resp = await http_request_async('POST', PERPLEXITY_URL, headers={"Authorization": f"Bearer {key}"},
+                                        json_body=research_payload(q), timeout=20, provider='perplexity')
+        return completion_text(resp.json())
+    try:
+        text, _ = await cached_ai_async('sonar', q, buscar, ttl=AI_RESEARCH_TTL)
+        return f"[Busca: {q}]\n{text}" if text else None
+    except Exception as e:
+        return f"[Busca falhou: {q}] Erro: {str(e)}"
+
+async def fetch_research_stage_async(company_data, cfg, deadline=RESEARCH_DEADLINE, on_result=None):
+    """fetch_research_stage em corrotinas; `on_result` é uma corrotina chamada a cada resultado."""
+    nome = company_data.get('razao_social', '')
+    key  = perplexity_key(cfg)
+    queries = research_queries(nome, company_data.get('cnpj', '')) if key else []
+
+    coros = {('perplexity', q): fetch_perplexity_query_async(q, key) for q in queries}
+    if nome:
+        coros[('datajud', nome)] = fetch_datajud_async(nome, cfg)
+
+    async def rodar(name, coro):
+        _prazo.set(time.monotonic() + deadline)   # cada task tem seu contexto
+        result = await coro
+        if on_result:
+            await on_result(name, result)
+        return result
+
+    tasks = {asyncio.create_task(rodar(name, coro)): name for name, coro in coros.items()}
+    results = {}
+    if tasks:
+        done, pendentes = await asyncio.wait(tasks, timeout=deadline)
+        for t in pendentes:
+            t.cancel()
+        for t in done:
+            if t.cancelled():
+                print(f"Fetch cancelado ({tasks[t]})")
+            elif t.exception() is None:
+                results[tasks[t]] = t.result()
+            else:
+                print(f"Fetch error ({tasks[t]}): {t.exception()}")
+
+    judicial_data = results.get(('datajud', nome)) or {}
+    research      = {q: results[('perplexity', q)] for q in queries if ('perplexity', q) in results}
+    web_research  = join_research(queries, research) if queries else None
+    return judicial_data, web_research
+
+async def ai_analyze_async(company_data, judicial_data, social_data, cfg, score_result, web_research=None,
+                           on_token=None):
+    """ai_analyze com AsyncAnthropic e Perplexity via httpx (mesmo cache, mesmo fallback)."""
+    if web_research is None:
+        web_research = await asyncio.to_thread(fetch_perplexity_research, company_data.get('razao_social', ''),
+                                               company_data.get('cnpj', ''), cfg)
+    prompt = build_ai_prompt(company_data, judicial_data, score_result, web_research)
+
+    ant_key = anthropic_key(cfg)
+    if ant_key:
+        streamed = False
+
+        async def chamar_anthropic():
+            nonlocal streamed
+            client = anthropic_async_client(ant_key)
+            async with provider_call_async('anthropic', 'messages'):
+                if on_token:
+                    async with client.messages.stream(
+                        model=ANTHROPIC_MODEL,
+                        max_tokens=2500,
+                        messages=[{"role": "user", "content": prompt}]
+                    ) as stream:
+                        async for text in stream.text_stream:
+                            streamed = True
+                            on_token(text)
+                        return await stream.get_final_text()
+                msg = await client.messages.create(
+                    model=ANTHROPIC_MODEL,
+                    max_tokens=2500,
+                    messages=[{"role": "user", "content": prompt}]
+                )
+                return msg.content[0].text
+
+        try:
+            text, reaproveitado = await cached_ai_async(ANTHROPIC_MODEL, prompt, chamar_anthropic)
+            if reaproveitado and on_token:
+                on_token(text)
+            return text, "Anthropic Claude"
+        except Exception:
+            if streamed:
+                on_token(None)
+            # cai para Perplexity
+
+    plex_key = perplexity_key(cfg)
+    if plex_key:
+        async def chamar_perplexity():
+            resp = await http_request_async('POST', PERPLEXITY_URL, headers={"Authorization": f"Bearer {plex_key}"},
+                                            json_body=analysis_payload(prompt, bool(on_token)), timeout=30,
+                                            stream=bool(on_token), provider='perplexity')
+            if not on_token:
+                return completion_text(resp.json())
+            parts = []
+            try:
+                async for line in resp.aiter_lines():
+                    delta = _sse_delta(line)
+                    if delta is None:
+                        break
+                    if delta:
+                        parts.append(delta)
+                        on_token(delta)
+            finally:
+                await resp.aclose()
+            if not parts:
+                raise ValueError("resposta vazia")
+            return ''.join(parts)
+
+        try:
+            text, reaproveitado = await cached_ai_async('sonar-pro', prompt, chamar_perplexity)
+            if text:
+                if reaproveitado and on_token:
+                    on_token(text)
+                return text, "Perplexity AI"
+        except Exception as e:
+            return f"Análise IA indisponível: {str(e)}", "Erro"
+
+    return NO_AI_MESSAGE, "N/A"
+
+async def stage_pesquisa_async(job):
+    social_data = social_placeholder()
+    cfg = job['cfg']
+    score_sent = False
+
+    async def send_score(judicial_data):
+        nonlocal score_sent
+        if not score_sent:
+            score_sent = True
+            score = await asyncio.to_thread(_job_score, job, judicial_data, social_data)
+            await asyncio.to_thread(emit_event, job['id'], 'score', {'score': score})
+
+    if not (cfg.get('datajud', {}).get('enabled') and job['params']['company_data'].get('razao_social')):
+        await send_score({})
+
+    async def on_result(name, result):
+        fonte, q = name
+        if fonte == 'datajud':
+            await asyncio.to_thread(emit_event, job['id'], 'datajud', {'judicial': result or {}})
+            await send_score(result or {})
+        else:
+            await asyncio.to_thread(emit_event, job['id'], 'pesquisa', {'busca': q, 'texto': result})
+
+    judicial_data, web_research = await fetch_research_stage_async(job['params']['company_data'], cfg,
+                                                                   on_result=on_result)
+    await send_score(judicial_data)
+    return {'judicial': judicial_data, 'social': social_data, 'web_research': web_research or ''}
+
+def _token_emitter_async(job_id, interval=0.2):
+    """
+    _token_emitter para corrotinas: on_token continua síncrono (só bufferiza) e
+    cada gravação vai para asyncio.to_thread, encadeada na anterior para os
+    eventos saírem em ordem. `flush` é uma corrotina que espera tudo ser gravado.
+    """
+    buf, last, fila = [], [time.time()], [None]
+
+    def enviar(tipo, dados):
+        anterior = fila[0]
+
+        async def gravar():
+            if anterior:
+                await anterior
+            await asyncio.to_thread(emit_event, job_id, tipo, dados)
+        fila[0] = asyncio.ensure_future(gravar())
+
+    def despejar():
+        if buf:
+            enviar('ia_delta', {'texto': ''.join(buf)})
+            buf.clear()
+        last[0] = time.time()
+
+    def on_token(text):
+        if text is None:
+            buf.clear()
+            enviar('ia_reset', {})
+            return
+        buf.append(text)
+        if time.time() - last[0] >= interval:
+            despejar()
+
+    async def flush():
+        despejar()
+        if fila[0]:
+            await fila[0]
+
+    return on_token, flush
+
+async def stage_ia_async(job):
+    p, e = job['params'], job['estado']
+    on_token, flush = _token_emitter_async(job['id'])
+    ai_text, ia_usada = await ai_analyze_async(p['company_data'], e['judicial'], e['social'], job['cfg'],
+                                               e['score'], web_research=e['web_research'], on_token=on_token)
+    await flush()
+    await asyncio.to_thread(emit_event, job['id'], 'ia', {'ai_analysis': ai_text, 'ia_usada': ia_usada})
+    return {'ai': ai_text, 'ia_usada': ia_usada}
+
+# Etapas com rede viram corrotinas; score e gravação (CPU/SQLite) rodam em to_thread.
+ASYNC_STAGES = {'pesquisa': stage_pesquisa_async, 'ia': stage_ia_async}
+
+async def run_job_async(job_id):
+    async with _async['jobs']:
+        try:
+            row = await asyncio.to_thread(_claim_job, job_id)
+            if row:
+                try:
+                    await _execute_pipeline_async(job_id, row)
+                except (Exception, asyncio.CancelledError) as e:
+                    await asyncio.to_thread(emit_event, job_id, 'erro', {'erro': str(e) or 'cancelado'})
+                    raise
+        except (Exception, asyncio.CancelledError) as e:
+            # CancelledError não é Exception: sem isto o job ficaria 'executando' para sempre.
+            print(f"Job {job_id} error: {e!r}")
+            import traceback; traceback.print_exc()
+            await asyncio.to_thread(_job_set, job_id, status='erro', erro=str(e) or 'cancelado')
+            if isinstance(e, asyncio.CancelledError):
+                raise
+
+async def _execute_pipeline_async(job_id, row):
+    job = await asyncio.to_thread(_load_job, job_id, row)
+    tentativas = row['tentativas'] or 0
+    feitas = job['estado']['etapas_ok']
+
+    await asyncio.to_thread(emit_event, job_id, 'cadastro', {'company': job['params']['company_data']})
+    for etapa, progresso, fn in PIPELINE:
+        if etapa in feitas:
+            continue
+        await asyncio.to_thread(_job_set, job_id, etapa=etapa)
+        await asyncio.to_thread(emit_event, job_id, 'etapa', {'etapa': etapa})
+        for tentativa in range(1, JOB_MAX_TENTATIVAS + 1):
+            try:
+                with timed(f"etapa:{etapa}", consulta_id=job['estado'].get('consulta_id')):
+                    if etapa in ASYNC_STAGES:
+                        resultado = await ASYNC_STAGES[etapa](job)
+                    else:
+                        resultado = await asyncio.to_thread(fn, job)
+                job['estado'].update(resultado)
+                break
+            except (Exception, asyncio.CancelledError) as e:
+                # Cancelamento vindo de dentro da etapa é falha dela; o do próprio job sobe.
+                if isinstance(e, asyncio.CancelledError) and asyncio.current_task().cancelling():
+                    raise
+                tentativas += 1
+                motivo = str(e) or 'cancelado'
+                print(f"Job {job_id} etapa {etapa} falhou ({tentativa}/{JOB_MAX_TENTATIVAS}): {motivo}")
+                if tentativa == JOB_MAX_TENTATIVAS:
+                    await asyncio.to_thread(_job_set, job_id, status='erro', erro=f"{etapa}: {motivo}",
+                                            tentativas=tentativas)
+                    await asyncio.to_thread(emit_event, job_id, 'erro', {'etapa': etapa, 'erro': motivo})
+                    return
+                await asyncio.sleep(2 ** tentativa)
+        feitas.append(etapa)
+        await asyncio.to_thread(_job_set, job_id, progresso=progresso, estado=job['estado'], tentativas=tentativas)
+
+    await asyncio.to_thread(_job_set, job_id, status='concluido')
+    await asyncio.to_thread(emit_event, job_id, 'concluido', {'resultado': job_resultado(job['estado'])})
+
+# ─────────────────────────────────────────
+# ANÁLISE EM LOTE (CARTEIRAS)
+# ─────────────────────────────────────────
+# Um lote é uma lista de CNPJs com valores (CSV ou JSONL) que passa pelo
+# mesmo caminho da análise individual: fontes cadastrais → calculate_score →
+# IA opcional. Os itens são processados em blocos de LOTE_BLOCO; cada bloco é
+# gravado numa única transação (consultas + status dos itens), então um lote
+# interrompido recomeça exatamente dos itens ainda pendentes.
+# Concorrência: LOTE_WORKERS itens ao mesmo tempo, e cada item chama cada
+# provedor no máximo uma vez, então nenhum provedor recebe mais que
+# LOTE_WORKERS chamadas simultâneas do lote; o resto do _fetch_pool fica
+# livre para as consultas interativas. O circuit breaker vale aqui também.
+LOTE_WORKERS   = int(os.environ.get('LOTE_WORKERS', 3))
+LOTE_BLOCO     = int(os.environ.get('LOTE_BLOCO', 50))
+LOTE_MAX_ITENS = int(os.environ.get('LOTE_MAX_ITENS', 20000))
+_lote_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='lote')
+
+def _to_float(v, default=0.0):
+    """Aceita 1234.56, 1.234,56 e 1234,56."""
+    if v in (None, ''):
+        return default
+    if isinstance(v, (int, float)):
+        return float(v)
+    v = str(v).strip().replace('R$', '').strip()
+    if ',' in v:
+        v = v.replace('.', '').replace(',', '.')
+    return float(v)
+
+def parse_lote(texto, formato='csv'):
+    """
+    Itens de um arquivo CSV (com cabeçalho; `,` ou `;`) ou JSONL com os campos
+    cnpj, valor_solicitado, parcelas e juros. Levanta ValueError indicando a
+    linha do primeiro registro inválido.
+    """
+    if formato == 'jsonl':
+        registros = [(n, json.loads(l)) for n, l in enumerate(texto.splitlines(), 1) if l.strip()]
+    else:
+        cabecalho = texto.lstrip('\ufeff').split('\n', 1)[0]
+        leitor = csv.DictReader(io.StringIO(texto.lstrip('\ufeff')),
+                                delimiter=';' if ';' in cabecalho else ',')
+        registros = [(n, {k.strip().lower(): v for k, v in r.items() if k}) for n, r in enumerate(leitor, 2)]
+
+    itens = []
+    for linha, r in registros:
+        try:
+            if not isinstance(r, dict):
+                raise ValueError('o registro precisa ser um objeto')
+            cnpj = clean_cnpj(str(r.get('cnpj', '')))
+            if len(cnpj) != 14:
+                raise ValueError('CNPJ inválido')
+            itens.append({
+                'linha':            linha,
+                'cnpj':             cnpj,
+                'valor_solicitado': _to_float(r.get('valor_solicitado')),
+                'parcelas':         int(_to_float(r.get('parcelas'), 12)),
+                'juros':            _to_float(r.get('juros'), 2.5),
+            })
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"linha {linha}: {e}")
+    if not itens:
+        raise ValueError('arquivo sem itens')
+    if len(itens) > LOTE_MAX_ITENS:
+        raise ValueError(f"máximo de {LOTE_MAX_ITENS} itens por lote")
+    return itens
+
+def create_lote(itens, usar_ia=False, origem=''):
+    now  = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db()
+    with conn:
+        lote_id = conn.execute(
+            "INSERT INTO lotes (status, usar_ia, origem, total, created_at, updated_at) VALUES ('pendente',?,?,?,?,?)",
+            (1 if usar_ia else 0, origem, len(itens), now, now)
+        ).lastrowid
+        conn.executemany("""
+            INSERT INTO lote_itens (lote_id, linha, cnpj, valor_solicitado, parcelas, juros)
+            VALUES (?,?,?,?,?,?)
+        """, [(lote_id, i['linha'], i['cnpj'], i['valor_solicitado'], i['parcelas'], i['juros']) for i in itens])
+    return lote_id
+
+def _claim_lote(lote_id):
+    now  = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db()
+    with conn:
+        return conn.execute(
+            "UPDATE lotes SET status='executando', updated_at=? WHERE id=? AND status='pendente'",
+            (now, lote_id)
+        ).rowcount
+
+def analyze_item(item, cfg, usar_ia):
+    """
+    Fontes cadastrais → (DataJud/pesquisa) → score → IA opcional, sem gravar nada.
+    Retorna (params, company_data, estado) no formato de prepare_consulta.
+    """
+    sources = fetch_company_sources(item['cnpj'], cfg)
+    company_data = merge_company_data(sources['opencnpj'], sources['brasilapi'], sources['cnpja'])
+    if not company_data:
+        raise ValueError('nenhuma fonte cadastral respondeu')
+    social_data = social_placeholder()
+    if usar_ia:
+        judicial_data, web_research = fetch_research_stage(company_data, cfg)
+    else:
+        nome = company_data.get('razao_social', '')
+        judicial_data, web_research = (fetch_datajud(nome, cfg) if nome else {}), ''
+    score_result = calculate_score(company_data, judicial_data, social_data, item['valor_solicitado'],
+                                   company_data.get('capital_social', '0'))
+    if usar_ia:
+        ai_text, ia_usada = ai_analyze(company_data, judicial_data, social_data, cfg, score_result,
+                                       web_research=web_research)
+    else:
+        ai_text, ia_usada = '', 'N/A'
+    params = {k: item[k] for k in ('cnpj', 'valor_solicitado', 'parcelas', 'juros')}
+    estado = {'judicial': judicial_data, 'social': social_data, 'ai': ai_text,
+              'ia_usada': ia_usada, 'score': score_result}
+    return params, company_data, estado
+
+def _save_bloco(lote_id, itens, resultados, segundos):
+    """Grava o bloco inteiro numa transação: consultas novas + status dos itens."""
+    now  = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    linhas = [res if isinstance(res, Exception) else prepare_consulta(*res) for res in resultados]
+    conn = get_db()
+    with conn:
+        status = []
+        for item, res in zip(itens, linhas):
+            if isinstance(res, Exception):
+                status.append(('erro', None, str(res)[:500], item['id']))
+            else:
+                status.append(('ok', write_consulta(conn, res), None, item['id']))
+        conn.executemany("UPDATE lote_itens SET status=?, consulta_id=?, erro=? WHERE id=?", status)
+        conn.execute("UPDATE lotes SET duracao_s = duracao_s + ?, updated_at=? WHERE id=?",
+                     (segundos, now, lote_id))
+
+def run_lote(lote_id, on_bloco=None):
+    """
+    Processa os itens pendentes do lote até o fim (só quem fizer o claim roda)
+    e retorna o relatório. `on_bloco(relatorio)` é chamado após cada bloco.
+    """
+    if not _claim_lote(lote_id):
+        return lote_report(lote_id)
+    conn = get_db()
+    lote = conn.execute("SELECT usar_ia FROM lotes WHERE id=?", (lote_id,)).fetchone()
+    cfg  = get_api_config()
+
+    def analisar(item):
+        _prioridade.set('lote')
+        try:
+            return analyze_item(item, cfg, bool(lote['usar_ia']))
+        except Exception as e:
+            return e
+
+    try:
+        with ThreadPoolExecutor(max_workers=LOTE_WORKERS, thread_name_prefix='lote-item') as pool:
+            while True:
+                itens = conn.execute(
+                    "SELECT * FROM lote_itens WHERE lote_id=? AND status='pendente' ORDER BY id LIMIT ?",
+                    (lote_id, LOTE_BLOCO)
+                ).fetchall()
+                if not itens:
+                    break
+                t0 = time.time()
+                resultados = list(pool.map(analisar, itens))
+                _save_bloco(lote_id, itens, resultados, time.time() - t0)
+                if on_bloco:
+                    on_bloco(lote_report(lote_id))
+    except Exception:
+        release_db()
+        with conn:
+            conn.execute("UPDATE lotes SET status='pendente' WHERE id=?", (lote_id,))
+        raise
+
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with conn:
+        conn.execute("UPDATE lotes SET status='concluido', concluido_em=?, updated_at=? WHERE id=?",
+                     (now, now, lote_id))
+    return lote_report(lote_id)
+
+def run_lote_background(lote_id):
+    try:
+        run_lote(lote_id)
+    except Exception as e:
+        print(f"Lote {lote_id} error: {e}")
+        import traceback; traceback.print_exc()
+
+def retry_lote(lote_id):
+    """Volta os itens com erro para a fila e reabre o lote."""
+    conn = get_db()
+    with conn:
+        n = conn.execute("UPDATE lote_itens SET status='pendente', erro=NULL WHERE lote_id=? AND status='erro'",
+                         (lote_id,)).rowcount
+        conn.execute("UPDATE lotes SET status='pendente', concluido_em=NULL WHERE id=? AND status!='executando'",
+                     (lote_id,))
+    return n
+
+def lote_report(lote_id):
+    """Andamento e vazão do lote, com a distribuição de risco do que já foi gravado."""
+    conn = get_db()
+    lote = conn.execute("SELECT * FROM lotes WHERE id=?", (lote_id,)).fetchone()
+    if not lote:
+        return None
+    por_status = dict(conn.execute(
+        "SELECT status, COUNT(*) FROM lote_itens WHERE lote_id=? GROUP BY status", (lote_id,)
+    ).fetchall())
+    agregados = conn.execute("""
+        SELECT c.risco, COUNT(*) AS n, SUM(c.valor_solicitado) AS solicitado, SUM(c.valor_sugerido) AS sugerido
+        FROM lote_itens i JOIN consultas c ON c.id = i.consulta_id
+        WHERE i.lote_id=? GROUP BY c.risco
+    """, (lote_id,)).fetchall()
+    erros = conn.execute(
+        "SELECT linha, cnpj, erro FROM lote_itens WHERE lote_id=? AND status='erro' ORDER BY id LIMIT 50",
+        (lote_id,)
+    ).fetchall()
+    processados = por_status.get('ok', 0) + por_status.get('erro', 0)
+    return {
+        'id':              lote['id'],
+        'status':          lote['status'],
+        'usar_ia':         bool(lote['usar_ia']),
+        'total':           lote['total'],
+        'pendentes':       por_status.get('pendente', 0),
+        'ok':              por_status.get('ok', 0),
+        'erros':           por_status.get('erro', 0),
+        'duracao_s':       round(lote['duracao_s'] or 0, 1),
+        'itens_por_min':   round(processados / lote['duracao_s'] * 60, 1) if lote['duracao_s'] else 0,
+        'por_risco':       {r['risco']: r['n'] for r in agregados},
+        'total_solicitado': sum(r['solicitado'] or 0 for r in agregados),
+        'total_sugerido':  sum(r['sugerido'] or 0 for r in agregados),
+        'amostra_erros':   [dict(r) for r in erros],
+        'created_at':      lote['created_at'],
+        'concluido_em':    lote['concluido_em'],
+    }
+
+def resume_lotes():
+    """Na subida do processo: retoma lotes pendentes e os que ficaram presos em execução."""
+    stale = datetime.fromtimestamp(time.time() - JOB_STALE_SECONDS).strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE lotes SET status='pendente' WHERE status='executando' AND updated_at < ?", (stale,))
+    for r in conn.execute("SELECT id FROM lotes WHERE status='pendente' ORDER BY id").fetchall():
+        _lote_pool.submit(run_lote_background, r['id'])
+
+# ─────────────────────────────────────────
+# LISTAGEM DE CONSULTAS
+# ─────────────────────────────────────────
+# Paginação por cursor (keyset) em (created_at, id): cada página é uma busca
+# no índice a partir da última linha vista, sem OFFSET. dados_json fica fora.
+LIST_COLUMNS = """id, cnpj, razao_social, nome_fantasia, valor_solicitado, valor_sugerido,
+                  score_empresa, risco, uf, municipio, porte_empresa, situacao_cadastral,
+                  politica_versao, created_at"""
+LIST_MAX = 100
+
+def encode_cursor(row):
+    raw = json.dumps([row['created_at'], row['id']]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    created_at, consulta_id = json.loads(raw)
+    return created_at, int(consulta_id)
+
+def list_consultas(filtros, cursor=None, limit=20):
+    """
+    Uma página de consultas, mais recentes primeiro. `filtros` aceita
+    risco (vírgulas para vários), uf, score_min, score_max, inicio e fim
+    (AAAA-MM-DD). Retorna (linhas, cursor_da_próxima_página ou None).
+    """
+    where, args = [], []
+    if filtros.get('risco'):
+        riscos = [r.strip() for r in filtros['risco'].split(',') if r.strip()]
+        where.append(f"risco IN ({','.join('?' * len(riscos))})"); args += riscos
+    if filtros.get('uf'):
+        where.append("uf = ?"); args.append(filtros['uf'].upper())
+    if filtros.get('score_min') not in (None, ''):
+        where.append("score_empresa >= ?"); args.append(int(filtros['score_min']))
+    if filtros.get('score_max') not in (None, ''):
+        where.append("score_empresa <= ?"); args.append(int(filtros['score_max']))
+    if filtros.get('inicio'):
+        where.append("created_at >= ?"); args.append(filtros['inicio'])
+    if filtros.get('fim'):
+        where.append("created_at < ?"); args.append(filtros['fim'] + '\uffff')
+    if cursor:
+        where.append("(created_at, id) < (?, ?)"); args += list(decode_cursor(cursor))
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+
+    limit = max(1, min(int(limit), LIST_MAX))
+    conn = get_db()
+    rows = conn.execute(f"""
+        SELECT {LIST_COLUMNS} FROM consultas {where_sql}
+        ORDER BY created_at DESC, id DESC LIMIT ?
+    """, (*args, limit + 1)).fetchall()
+    proximo = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], proximo
+
+# ─────────────────────────────────────────
+# ROUTES
+# ─────────────────────────────────────────
+@app.route('/')
+def dashboard():
+    consultas, proximo = list_consultas({}, limit=20)
+    return render_template('dashboard.html', consultas=consultas, proximo_cursor=proximo)
+
+@app.route('/nova-consulta')
+def nova_consulta():
+    cfg = get_api_config()
+    return render_template('nova_consulta.html', cfg=cfg)
+
+@app.route('/api/fetch-cnpj', methods=['POST'])
+def api_fetch_cnpj():
+    data = request.json
+    cnpj = clean_cnpj(data.get('cnpj', ''))
+    if len(cnpj) != 14:
+        return jsonify({'error': 'CNPJ inválido'}), 400
+    
+    cfg = get_api_config()
+    
+    # Fetch from all enabled APIs (em paralelo; fontes lentas ficam de fora)
+    with timed('etapa:cadastro'):
+        sources = fetch_company_sources(cnpj, cfg, refresh=bool(data.get('refresh')))
+    opencnpj_data   = sources['opencnpj']
+    brasilapi_data  = sources['brasilapi']
+    cnpja_data      = sources['cnpja']
+    invertexto_data = sources['invertexto']
+    
+    merged = merge_company_data(opencnpj_data, brasilapi_data, cnpja_data)
+    
+    return jsonify({
         'success': True,
-        'consulta_id': consulta_id,
-        'score': score_result,
-        'ai_analysis': ai_text,
-        'ia_usada': ia_usada,
-        'judicial': judicial_data,
-        'social': social_data,
-        'has_pdf': bool(pdf_path)
+        'data': merged,
+        'sources': {
+            'opencnpj': bool(opencnpj_data and 'cnpj' in opencnpj_data),
+            'brasilapi': bool(brasilapi_data and 'cnpj' in brasilapi_data),
+            'cnpja': bool(cnpja_data),
+            'invertexto': bool(invertexto_data),
+        }
     })
 
+@app.route('/api/analisar', methods=['POST'])
+def api_analisar():
+    data = request.json
+    cnpj = clean_cnpj(data.get('cnpj', ''))
+    params = {
+        'cnpj':             cnpj,
+        'valor_solicitado': float(data.get('valor_solicitado', 0)),
+        'parcelas':         int(data.get('parcelas', 12)),
+        'juros':            float(data.get('juros', 2.5)),
+        'company_data':     data.get('company_data', {}),
+    }
+    job_id = enqueue_analysis(params)
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'pendente'}), 202
+
+@app.route('/api/lotes', methods=['POST'])
+def api_lotes():
+    """
+    Cria um lote e o coloca na fila. Aceita JSON {"itens": [...], "usar_ia": bool},
+    upload multipart no campo `arquivo`, ou o texto do arquivo no corpo;
+    ?formato=csv|jsonl e ?ia=1 valem para os dois últimos.
+    """
+    usar_ia = request.args.get('ia') in ('1', 'true')
+    try:
+        if request.is_json:
+            data = request.json
+            if not isinstance(data, dict) or not isinstance(data.get('itens', []), list):
+                raise ValueError('esperado um objeto com a lista "itens"')
+            usar_ia = bool(data.get('usar_ia'))
+            itens = parse_lote('\n'.join(json.dumps(i) for i in data.get('itens', [])), 'jsonl')
+            origem = 'api'
+        else:
+            arquivo = request.files.get('arquivo')
+            texto = arquivo.read().decode('utf-8') if arquivo else request.get_data(as_text=True)
+            formato = request.args.get('formato') or (
+                'jsonl' if arquivo and arquivo.filename.endswith('.jsonl') else 'csv')
+            itens = parse_lote(texto, formato)
+            origem = arquivo.filename if arquivo else 'api'
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({'error': f'Arquivo inválido: {e}'}), 400
+    lote_id = create_lote(itens, usar_ia, origem)
+    _lote_pool.submit(run_lote_background, lote_id)
+    return jsonify({'success': True, 'lote_id': lote_id, 'total': len(itens), 'status': 'pendente'}), 202
+
+@app.route('/api/lotes/<int:lote_id>')
+def api_lote_status(lote_id):
+    rel = lote_report(lote_id)
+    if not rel:
+        return jsonify({'error': 'Lote não encontrado'}), 404
+    return jsonify(rel)
+
+@app.route('/api/lotes/<int:lote_id>/retry', methods=['POST'])
+def api_lote_retry(lote_id):
+    if not lote_report(lote_id):
+        return jsonify({'error': 'Lote não encontrado'}), 404
+    n = retry_lote(lote_id)
+    _lote_pool.submit(run_lote_background, lote_id)
+    return jsonify({'success': True, 'reprocessar': n}), 202
+
+def _print_lote(rel):
+    print(f"Lote {rel['id']}: {rel['ok']} ok, {rel['erros']} erros, {rel['pendentes']} pendentes "
+          f"— {rel['itens_por_min']} itens/min")
+
+@app.cli.command('lote')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False))
+@click.option('--ia', is_flag=True, help='Gera também a pesquisa e a análise por IA de cada item.')
+@click.option('--formato', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='Padrão: pela extensão do arquivo.')
+def lote_cmd(arquivo, ia, formato):
+    """Analisa uma carteira de CNPJs (CSV/JSONL) e grava os resultados em consultas."""
+    with open(arquivo, encoding='utf-8') as f:
+        itens = parse_lote(f.read(), formato or ('jsonl' if arquivo.endswith('.jsonl') else 'csv'))
+    lote_id = create_lote(itens, ia, os.path.basename(arquivo))
+    print(f"Lote {lote_id} criado com {len(itens)} itens (retome com: flask --app app lote-retomar {lote_id})")
+    _print_relatorio_lote(run_lote(lote_id, on_bloco=_print_lote))
+
+@app.cli.command('lote-retomar')
+@click.argument('lote_id', type=int)
+@click.option('--erros', is_flag=True, help='Reprocessa também os itens que falharam.')
+def lote_retomar_cmd(lote_id, erros):
+    """Continua um lote interrompido a partir dos itens pendentes."""
+    if not lote_report(lote_id):
+        raise click.ClickException(f"Lote {lote_id} não encontrado")
+    if erros:
+        retry_lote(lote_id)
+    conn = get_db()
+    with conn:   # o CLI roda em primeiro plano: assume um lote que ficou preso em 'executando'
+        conn.execute("UPDATE lotes SET status='pendente' WHERE id=? AND status='executando'", (lote_id,))
+    _print_relatorio_lote(run_lote(lote_id, on_bloco=_print_lote))
+
+def _print_relatorio_lote(rel):
+    print(f"\nLote {rel['id']} — {rel['status']}")
+    print(f"  itens:      {rel['total']} ({rel['ok']} ok, {rel['erros']} erros, {rel['pendentes']} pendentes)")
+    print(f"  duração:    {rel['duracao_s']}s ({rel['itens_por_min']} itens/min)")
+    print(f"  por risco:  " + ', '.join(f"{k}: {v}" for k, v in rel['por_risco'].items()))
+    print(f"  solicitado: R$ {rel['total_solicitado']:,.2f}  sugerido: R$ {rel['total_sugerido']:,.2f}")
+    for e in rel['amostra_erros'][:10]:
+        print(f"  erro linha {e['linha']} ({e['cnpj']}): {e['erro']}")
+
+@app.route('/api/jobs/<int:job_id>')
+def api_job_status(job_id):
+    conn = get_db()
+    j = conn.execute("SELECT * FROM analise_jobs WHERE id=?", (job_id,)).fetchone()
+    if not j:
+        return jsonify({'error': 'Job não encontrado'}), 404
+    resp = {
+        'id':          j['id'],
+        'status':      j['status'],
+        'etapa':       j['etapa'],
+        'progresso':   j['progresso'],
+        'tentativas':  j['tentativas'],
+        'erro':        j['erro'],
+        'consulta_id': j['consulta_id'],
+    }
+    if j['status'] == 'concluido':
+        resp['resultado'] = job_resultado(json.loads(j['estado'] or '{}'))
+    return jsonify(resp)
+
+SSE_POLL_INTERVAL = 0.3
+SSE_MAX_SECONDS   = 600
+SSE_FIM           = ('concluido', 'erro')
+SSE_HEADERS       = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def job_events_after(job_id, last_id):
+    """Eventos do job com id > last_id (também usado pelo SSE nativo do asgi.py)."""
+    conn = get_db()
+    rows = conn.execute(
+        "SELECT id, tipo, dados FROM job_eventos WHERE job_id=? AND id>? ORDER BY id",
+        (job_id, last_id)
+    ).fetchall()
+    return rows
+
+def sse_event(r):
+    return f"id: {r['id']}\nevent: {r['tipo']}\ndata: {r['dados']}\n\n"
+
+@app.route('/api/jobs/<int:job_id>/eventos')
+def api_job_eventos(job_id):
+    """Server-Sent Events com o andamento do job; aceita Last-Event-ID para reconectar."""
+    last_id = int(request.headers.get('Last-Event-ID') or request.args.get('desde') or 0)
+
+    def stream():
+        nonlocal last_id
+        started = idle = time.time()
+        while time.time() - started < SSE_MAX_SECONDS:
+            rows = job_events_after(job_id, last_id)
+            for r in rows:
+                last_id = r['id']
+                yield sse_event(r)
+                if r['tipo'] in SSE_FIM:
+                    return
+            if rows:
+                idle = time.time()
+            elif time.time() - idle > 15:
+                idle = time.time()
+                yield ": keep-alive\n\n"
+            time.sleep(SSE_POLL_INTERVAL)
+
+    return app.response_class(stream(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@app.route('/api/jobs/<int:job_id>/retry', methods=['POST'])
+def api_job_retry(job_id):
+    if not retry_job(job_id):
+        return jsonify({'error': 'Só jobs com erro podem ser reprocessados'}), 409
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'pendente'}), 202
+
+@app.route('/api/consultas')
+def api_consultas():
+    try:
+        rows, proximo = list_consultas(request.args, request.args.get('cursor'),
+                                       request.args.get('limite', 20))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Parâmetros inválidos'}), 400
+    return jsonify({'itens': [dict(r) for r in rows], 'proximo_cursor': proximo})
+
+@app.route('/api/search')
+def api_search():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'error': 'Informe o termo de busca (q)'}), 400
+    if not SEARCH_ENABLED:
+        return jsonify({'error': 'Busca textual indisponível neste servidor'}), 503
+    limit = max(1, min(request.args.get('limite', 20, type=int), LIST_MAX))
+    t0 = time.time()
+    rows = search_consultas(q, limit)
+    return jsonify({'q': q, 'itens': [dict(r) for r in rows],
+                    'tempo_ms': round((time.time() - t0) * 1000, 2)})
+
+@app.cli.command('reindexar-busca')
+def reindexar_busca_cmd():
+    """Reconstrói o índice de busca textual (busca_fts) a partir das consultas gravadas."""
+    if not SEARCH_ENABLED:
+        print("SQLite sem FTS5: nada a fazer.")
+        return
+    t0 = time.time()
+    n = reindex_search()
+    print(f"{n} consultas indexadas em {time.time() - t0:.1f}s")
+
+@app.cli.command('migrar-payloads')
+def migrar_payloads_cmd():
+    """Move o dados_json restante para `payloads`, apaga blobs órfãos e compacta o banco (VACUUM)."""
+    conn = get_db()
+    antes = os.path.getsize(DB_PATH)
+    n = migrate_payloads(conn)
+    conn.execute("DELETE FROM payloads WHERE hash NOT IN (SELECT hash FROM consulta_payloads)")
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    print(f"{n} consultas migradas; banco: {antes / 1e6:.1f} MB -> {os.path.getsize(DB_PATH) / 1e6:.1f} MB")
+
+@app.cli.command('rescore')
+@click.option('--gravar', is_flag=True, help='Atualiza score, risco e valor sugerido das consultas que mudarem.')
+def rescore_cmd(gravar):
+    """Recalcula o score de todas as consultas gravadas com a política ativa (sem chamar APIs)."""
+    conn = get_db()
+    politica = policy_state()[0]
+    t0, total, mudaram, t_score = time.time(), 0, 0, 0.0
+    for bloco in iter_dados(conn, ('company', 'judicial', 'social'), batch=5000):
+        feats = [features_from_dados(d) for _, d in bloco]
+        t1 = time.time()
+        res = politica.bulk(feats, [r['valor_solicitado'] or 0 for r, _ in bloco])
+        t_score += time.time() - t1
+        alterados = [i for i, (r, _) in enumerate(bloco)
+                     if (r['score_empresa'], r['risco']) != (int(res['score'][i]), res['risco'][i])]
+        total += len(bloco)
+        mudaram += len(alterados)
+        if gravar and alterados:
+            # Linhas e payloads prontos antes; o bloco todo entra numa transação só.
+            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            novos = [(bloco[i][0]['id'], politica.bulk_row(res, i)) for i in alterados]
+            linhas = [(novo['score'], novo['risco'], novo['valor_sugerido'], politica.versao, now, cid)
+                      for cid, novo in novos]
+            partes = [(cid, encode_dados({'score': novo})) for cid, novo in novos]
+            with conn:
+                conn.executemany("""UPDATE consultas SET score_empresa=?, risco=?, valor_sugerido=?,
+                                    politica_versao=?, updated_at=? WHERE id=?""", linhas)
+                write_dados_many(conn, partes)
+    print(f"{total} consultas em {time.time() - t0:.1f}s (score: {t_score:.2f}s); "
+          f"{mudaram} mudariam{' e foram atualizadas' if gravar else ' (use --gravar para aplicar)'}")
+
+@app.cli.command('simular-politica')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False), required=False)
+@click.option('--versao', type=int, help='Versão gravada a simular (em vez de um arquivo JSON com as regras).')
+@click.option('--base', 'base_versao', type=int, help='Versão de comparação (padrão: a ativa).')
+@click.option('--de', help='Só consultas a partir desta data (AAAA-MM-DD).')
+@click.option('--ate', help='Só consultas até esta data (AAAA-MM-DD).')
+@click.option('--workers', type=int, default=None, help='Processos em paralelo (padrão: SIM_WORKERS).')
+@click.option('--json', 'como_json', is_flag=True, help='Imprime o resultado em JSON.')
+def simular_politica_cmd(arquivo, versao, base_versao, de, ate, workers, como_json):
+    """Reaplica uma política candidata sobre o histórico gravado e mostra o impacto (sem chamar APIs)."""
+    conn = get_db()
+    if arquivo:
+        try:
+            with open(arquivo, encoding='utf-8') as f:
+                cand = ScorePolicy(json.load(f))
+        except ValueError as e:
+            raise click.UsageError(f'política inválida: {e}')
+    elif versao is not None:
+        cand = _stored_policy(conn, versao)
+    else:
+        raise click.UsageError('informe ARQUIVO ou --versao')
+    base = _stored_policy(conn, base_versao) if base_versao is not None else None
+    if cand is None or (base_versao is not None and base is None):
+        raise click.UsageError('versão não encontrada')
+    res = simulate_policy(cand, base, de, ate, workers)
+    if como_json:
+        print(json.dumps(res, ensure_ascii=False, indent=2))
+        return
+
+    m = res['matriz']
+    print(f"{res['total']} consultas em {res['duracao_s']}s — base v{res['base_versao']} x candidata "
+          f"{'v' + str(res['candidata_versao']) if res['candidata_versao'] else '(arquivo)'}")
+    largura = max(len(n) for n in m['linhas'] + m['colunas']) + 2
+    print('\n' + 'base/cand.'.ljust(largura) + ''.join(f"{c:>{largura}}" for c in m['colunas']))
+    for nome, linha in zip(m['linhas'], m['contagem']):
+        print(f"{nome:<{largura}}" + ''.join(f"{n:>{largura}}" for n in linha))
+    print(f"\n  mudaram de faixa: {res['mudaram_faixa']} (score subiu: {res['score_subiu']}, desceu: {res['score_desceu']})")
+    print(f"  score médio:      {res['score_medio']['base']} -> {res['score_medio']['candidata']}")
+    a, v = res['aprovadas'], res['valor_aprovado']
+    print(f"  aprovadas:        {a['base']} -> {a['candidata']} ({a['delta']:+d})")
+    print(f"  valor aprovado:   R$ {v['base']:,.2f} -> R$ {v['candidata']:,.2f} ({v['delta']:+,.2f})")
+
 @app.route('/relatorio/<int:consulta_id>')
 def ver_relatorio(consulta_id):
     conn = get_db()
     c = conn.execute("SELECT * FROM consultas WHERE id=?", (consulta_id,)).fetchone()
-    conn.close()
+    dados = load_dados(conn, consulta_id) if c else {}
     if not c:
         return "Relatório não encontrado", 404
-    dados = json.loads(c['dados_json'])
     return render_template('relatorio.html', consulta=c, dados=dados)
 
 @app.route('/download-pdf/<int:consulta_id>')
 def download_pdf(consulta_id):
-    conn = get_db()
-    c = conn.execute("SELECT relatorio_path FROM consultas WHERE id=?", (consulta_id,)).fetchone()
-    conn.close()
-    if c and c['relatorio_path'] and os.path.exists(c['relatorio_path']):
-        return send_file(c['relatorio_path'], as_attachment=True,
+    pdf_path = ensure_pdf(consulta_id)
+    if pdf_path:
+        return send_file(pdf_path, as_attachment=True,
                          download_name=f"relatorio_credito_{consulta_id}.pdf")
     return "PDF não encontrado", 404
 
@@ -985,20 +4228,223 @@ def api_config():
                 (1 if val.get('enabled') else 0, val.get('api_key', ''), now, key)
             )
         conn.commit()
-        conn.close()
+        invalidate_api_config()
         return jsonify({'success': True})
-    return jsonify(get_api_config())
+    # Estado do circuit breaker de cada provedor vai junto, em 'saude', e o balde do limitador em 'limite'.
+    return jsonify({key: {**val, 'saude': provider_health(key).snapshot(), 'limite': rate_snapshot(key)}
+                    for key, val in get_api_config().items()})
+
+def _set_policy_status(conn, versao, status, percentual=0):
+    """Muda o status de uma versão; a ativa/desafiante anterior passa a inativa (na transação de quem chamou)."""
+    if status in ('ativa', 'desafiante'):
+        conn.execute("UPDATE politicas_score SET status='inativa', percentual=0 WHERE status=? AND versao!=?",
+                     (status, versao))
+    conn.execute("UPDATE politicas_score SET status=?, percentual=? WHERE versao=?",
+                 (status, percentual if status == 'desafiante' else 0, versao))
+
+@app.route('/api/politica', methods=['GET', 'POST'])
+def api_politica():
+    """
+    GET: política ativa, desafiante e histórico de versões.
+    POST {"nome", "regras", "status": "inativa|ativa|desafiante", "percentual"}:
+    grava uma nova versão (as regras são compiladas antes, para validar).
+    """
+    conn = get_db()
+    if request.method == 'POST':
+        data = request.json or {}
+        status = data.get('status', 'inativa')
+        if status not in ('inativa', 'ativa', 'desafiante'):
+            return jsonify({'error': 'status inválido'}), 400
+        try:
+            ScorePolicy(data.get('regras') or {})
+            percentual = int(data.get('percentual', 0))
+            if not 0 <= percentual <= 100:
+                raise ValueError('percentual deve estar entre 0 e 100')
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': f'Política inválida: {e}'}), 400
+        with conn:
+            versao = conn.execute(
+                "INSERT INTO politicas_score (nome, regras, status, percentual, created_at) VALUES (?,?, 'inativa', 0, ?)",
+                (data.get('nome', ''), json.dumps(data['regras'], ensure_ascii=False),
+                 datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            ).lastrowid
+            _set_policy_status(conn, versao, status, percentual)
+        invalidate_policy()
+        return jsonify({'success': True, 'versao': versao}), 201
+
+    ativa, desafiante, percentual = policy_state()
+    versoes = conn.execute("""
+        SELECT p.versao, p.nome, p.status, p.percentual, p.created_at,
+               (SELECT COUNT(*) FROM consultas c WHERE c.politica_versao = p.versao) AS consultas
+        FROM politicas_score p ORDER BY p.versao DESC
+    """).fetchall()
+    return jsonify({
+        'ativa':      {'versao': ativa.versao, 'regras': ativa.regras},
+        'desafiante': {'versao': desafiante.versao, 'regras': desafiante.regras,
+                       'percentual': percentual} if desafiante else None,
+        'versoes':    [dict(v) for v in versoes],
+    })
+
+@app.route('/api/politica/<int:versao>/status', methods=['POST'])
+def api_politica_status(versao):
+    """Promove, coloca em teste A/B ou desativa uma versão: {"status", "percentual"}."""
+    data = request.json or {}
+    status = data.get('status')
+    if status not in ('inativa', 'ativa', 'desafiante'):
+        return jsonify({'error': 'status inválido'}), 400
+    conn = get_db()
+    atual = conn.execute("SELECT status FROM politicas_score WHERE versao=?", (versao,)).fetchone()
+    if not atual:
+        return jsonify({'error': 'Versão não encontrada'}), 404
+    if atual['status'] == 'ativa' and status != 'ativa':
+        return jsonify({'error': 'Ative outra versão em vez de desativar a atual'}), 409
+    try:
+        percentual = max(0, min(100, int(data.get('percentual', 0))))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'percentual inválido'}), 400
+    with conn:
+        _set_policy_status(conn, versao, status, percentual)
+    invalidate_policy()
+    return jsonify({'success': True})
+
+def _stored_policy(conn, versao):
+    """Versão gravada já compilada, ou None se não existir."""
+    if not conn.execute("SELECT 1 FROM politicas_score WHERE versao=?", (versao,)).fetchone():
+        return None
+    return _compiled_policy(conn, versao)
+
+@app.route('/api/politica/simulacao', methods=['POST'])
+def api_politica_simulacao():
+    """
+    What-if sobre o histórico: {"regras": {...}} ou {"versao": N} como candidata,
+    "base_versao" opcional (padrão: a ativa) e filtro "de"/"ate" (AAAA-MM-DD).
+    Não chama nenhuma API externa; ver simulate_policy. Roda em segundo plano:
+    responde 202 com o id, e GET /api/politica/simulacao/<id> traz o resultado.
+    """
+    data = request.json or {}
+    conn = get_db()
+    if data.get('regras'):
+        try:
+            cand = ScorePolicy(data['regras'])
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': f'Política inválida: {e}'}), 400
+    elif data.get('versao') is not None:
+        cand = _stored_policy(conn, data['versao'])
+        if cand is None:
+            return jsonify({'error': 'Versão não encontrada'}), 404
+    else:
+        return jsonify({'error': 'Informe regras ou versao'}), 400
+    base = None
+    if data.get('base_versao') is not None:
+        base = _stored_policy(conn, data['base_versao'])
+        if base is None:
+            return jsonify({'error': 'Versão base não encontrada'}), 404
+    sim_id = enqueue_simulacao(cand, base, data.get('de'), data.get('ate'))
+    return jsonify({'success': True, 'simulacao_id': sim_id, 'status': 'pendente'}), 202
+
+@app.route('/api/politica/simulacao/<int:sim_id>')
+def api_politica_simulacao_status(sim_id):
+    r = get_db().execute("SELECT status, resultado, erro, created_at, updated_at FROM simulacoes WHERE id=?",
+                         (sim_id,)).fetchone()
+    if not r:
+        return jsonify({'error': 'Simulação não encontrada'}), 404
+    return jsonify({'simulacao_id': sim_id, 'status': r['status'], 'erro': r['erro'],
+                    'created_at': r['created_at'], 'updated_at': r['updated_at'],
+                    'resultado': json.loads(r['resultado']) if r['resultado'] else None})
+
+
+STATS_GROUPS = {'dia': 'dia', 'uf': 'uf', 'porte': 'porte', 'risco': 'risco'}
 
 @app.route('/api/stats')
 def api_stats():
+    """
+    Totais por risco a partir de stats_resumo (custo fixo, independe de consultas).
+    ?inicio=AAAA-MM-DD&fim=AAAA-MM-DD limitam o período; ?por=dia|uf|porte|risco
+    acrescenta a quebra por essa dimensão.
+    """
+    where, args = [], []
+    if request.args.get('inicio'):
+        where.append("dia >= ?"); args.append(request.args['inicio'])
+    if request.args.get('fim'):
+        where.append("dia <= ?"); args.append(request.args['fim'])
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+
     conn = get_db()
-    total = conn.execute("SELECT COUNT(*) as c FROM consultas").fetchone()['c']
-    baixo = conn.execute("SELECT COUNT(*) as c FROM consultas WHERE risco='BAIXO'").fetchone()['c']
-    medio = conn.execute("SELECT COUNT(*) as c FROM consultas WHERE risco='MÉDIO'").fetchone()['c']
-    alto = conn.execute("SELECT COUNT(*) as c FROM consultas WHERE risco='ALTO' OR risco='MUITO ALTO'").fetchone()['c']
-    avg_score = conn.execute("SELECT AVG(score_empresa) as a FROM consultas").fetchone()['a'] or 0
-    conn.close()
-    return jsonify({'total': total, 'baixo': baixo, 'medio': medio, 'alto': alto, 'avg_score': round(avg_score, 1)})
+    rows = conn.execute(f"""
+        SELECT risco, SUM(total) AS total, SUM(soma_score) AS soma_score
+        FROM stats_resumo {where_sql} GROUP BY risco
+    """, args).fetchall()
+    by_risk = {r['risco']: r for r in rows}
+    total = sum(r['total'] for r in rows)
+    soma_score = sum(r['soma_score'] for r in rows)
+    count = lambda *riscos: sum(by_risk[k]['total'] for k in riscos if k in by_risk)
+    resp = {
+        'total': total,
+        'baixo': count('BAIXO'),
+        'medio': count('MÉDIO'),
+        'alto': count('ALTO', 'MUITO ALTO'),
+        'avg_score': round(soma_score / total, 1) if total else 0,
+    }
+
+    por = request.args.get('por')
+    if por in STATS_GROUPS:
+        col = STATS_GROUPS[por]
+        groups = conn.execute(f"""
+            SELECT {col} AS chave, SUM(total) AS total, SUM(soma_score) AS soma_score,
+                   SUM(soma_solicitado) AS solicitado, SUM(soma_sugerido) AS sugerido
+            FROM stats_resumo {where_sql}
+            GROUP BY {col} HAVING SUM(total) > 0 ORDER BY {col}
+        """, args).fetchall()
+        resp['por'] = por
+        resp['grupos'] = [{
+            'chave':            g['chave'],
+            'total':            g['total'],
+            'avg_score':        round(g['soma_score'] / g['total'], 1),
+            'valor_solicitado': round(g['solicitado'], 2),
+            'valor_sugerido':   round(g['sugerido'], 2),
+        } for g in groups]
+    return jsonify(resp)
+
+@app.route('/api/metrics')
+def api_metrics():
+    """Latência por API externa e por etapa. ?format=prometheus para o formato texto."""
+    try:
+        horas = float(request.args.get('horas', 24))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Parâmetros inválidos'}), 400
+    if not 0 < horas < float('inf'):
+        return jsonify({'error': 'Parâmetros inválidos'}), 400
+    metrics = latency_metrics(horas)
+    if request.args.get('format') == 'prometheus':
+        lines = [
+            '# HELP creditoia_latency_ms Latência das chamadas externas e etapas do pipeline (ms)',
+            '# TYPE creditoia_latency_ms summary',
+        ]
+        for name, m in sorted(metrics.items()):
+            tipo, _, nome = name.rpartition(':')
+            labels = f'tipo="{tipo or "api"}",nome="{nome}"'
+            for quantile, key in (('0.5', 'p50_ms'), ('0.95', 'p95_ms'), ('0.99', 'p99_ms')):
+                lines.append(f'creditoia_latency_ms{{{labels},quantile="{quantile}"}} {m[key]}')
+            lines.append(f'creditoia_latency_ms_sum{{{labels}}} {m["soma_ms"]}')
+            lines.append(f'creditoia_latency_ms_count{{{labels}}} {m["chamadas"]}')
+        lines += ['# HELP creditoia_errors_total Chamadas com erro', '# TYPE creditoia_errors_total counter']
+        for name, m in sorted(metrics.items()):
+            tipo, _, nome = name.rpartition(':')
+            lines.append(f'creditoia_errors_total{{tipo="{tipo or "api"}",nome="{nome}"}} {m["erros"]}')
+        return app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+    return jsonify({
+        'janela_horas': horas,
+        'apis':   {k: v for k, v in metrics.items() if not k.startswith('etapa:')},
+        'etapas': {k.split(':', 1)[1]: v for k, v in metrics.items() if k.startswith('etapa:')},
+    })
+
+# Comandos do `flask` CLI (lote, reindexar-busca...) e processos filhos da
+# simulação (PROCESSO_FILHO) não disputam a fila com o servidor.
+if not (os.environ.get('FLASK_RUN_FROM_CLI') or PROCESSO_FILHO):
+    resume_jobs()
+    resume_lotes()
+    resume_simulacoes()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5099))
@@ -0,0 +1,131 @@
+"""
+Entrada ASGI do CréditoIA (`uvicorn asgi:app`).
+
+O SSE de /api/jobs/<id>/eventos roda direto no event loop do uvicorn: cada
+cliente conectado é uma corrotina esperando o próximo evento, não um worker
+preso. As demais rotas vão para o Flask via WsgiToAsgi, num pool fixo de
+WSGI_THREADS threads: cada uma mantém sua conexão SQLite (get_db) entre
+requisições, como as threads do gunicorn. (O padrão do asgiref enfileira
+todas as views numa thread só.)
+"""
+import asyncio, os, re, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgiInstance
+
+import app as creditoia
+
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 8))
+_wsgi_pool = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='wsgi')
+
+def _run_wsgi_app(self, body):
+    """
+    Roda a view do Flask numa thread de _wsgi_pool e repassa a resposta ao
+    ASGI. Usa só a parte pública do WsgiToAsgiInstance (build_environ,
+    start_response e o sync_send que o __call__ prepara).
+    """
+    try:
+        environ = self.build_environ(self.scope, body)
+    except ValueError:   # cabeçalhos duplicados demais
+        self.sync_send({'type': 'http.response.start', 'status': 400,
+                        'headers': [(b'content-type', b'text/plain')]})
+        self.sync_send({'type': 'http.response.body', 'body': b'Bad Request'})
+        return
+    resposta = self.wsgi_application(environ, self.start_response)
+    try:
+        enviados = 0
+        for trecho in resposta:
+            if not self.response_started:
+                self.response_started = True
+                self.sync_send(self.response_start)
+            if self.response_content_length is not None:
+                trecho = trecho[:self.response_content_length - enviados]
+            self.sync_send({'type': 'http.response.body', 'body': trecho, 'more_body': True})
+            enviados += len(trecho)
+            if enviados == self.response_content_length:
+                break
+    finally:
+        if hasattr(resposta, 'close'):
+            resposta.close()
+    if not self.response_started:
+        self.response_started = True
+        self.sync_send(self.response_start)
+    self.sync_send({'type': 'http.response.body'})
+
+class _WsgiInstance(WsgiToAsgiInstance):
+    run_wsgi_app = sync_to_async(_run_wsgi_app, thread_sensitive=False, executor=_wsgi_pool)
+
+_EVENTOS = re.compile(r'^/api/jobs/(\d+)/eventos$')
+SSE_KEEPALIVE = 15
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        m = _EVENTOS.match(scope['path'])
+        if m:
+            return await job_eventos(scope, receive, send, int(m.group(1)))
+    await _WsgiInstance(creditoia.app)(scope, receive, send)
+
+async def _lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif msg['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def _texto(send, status, corpo):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': corpo.encode()})
+
+async def job_eventos(scope, receive, send, job_id):
+    """Mesmo protocolo de api_job_eventos (Last-Event-ID ou ?desde=, keep-alive, fim em concluido/erro)."""
+    headers = dict(scope['headers'])
+    desde = parse_qs(scope.get('query_string', b'').decode()).get('desde', [''])[0]
+    try:
+        last_id = int(headers.get(b'last-event-id', b'').decode() or desde or 0)
+    except ValueError:
+        return await _texto(send, 400, 'Last-Event-ID inválido')
+
+    desconectou = asyncio.Event()
+
+    async def vigiar():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        desconectou.set()
+
+    vigia = asyncio.create_task(vigiar())
+    sse_headers = [(k.lower().encode(), v.encode()) for k, v in creditoia.SSE_HEADERS.items()]
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/event-stream; charset=utf-8')] + sse_headers})
+    try:
+        started = idle = time.time()
+        fim = False
+        while not fim and not desconectou.is_set() and time.time() - started < creditoia.SSE_MAX_SECONDS:
+            rows = await asyncio.to_thread(creditoia.job_events_after, job_id, last_id)
+            partes = []
+            for r in rows:
+                last_id = r['id']
+                partes.append(creditoia.sse_event(r))
+                if r['tipo'] in creditoia.SSE_FIM:
+                    fim = True
+                    break
+            if partes:
+                idle = time.time()
+                await send({'type': 'http.response.body', 'body': ''.join(partes).encode(), 'more_body': True})
+            elif time.time() - idle > SSE_KEEPALIVE:
+                idle = time.time()
+                await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+            if not fim:
+                try:
+                    await asyncio.wait_for(desconectou.wait(), creditoia.SSE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        vigia.cancel()
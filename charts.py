@@ -0,0 +1,101 @@
+"""
+Gráficos vetoriais do relatório PDF (ReportLab graphics, sem matplotlib).
+
+A parte fixa do medidor de score (faixas, rótulos, título) é montada uma
+única vez; a cada relatório só o ponteiro, o número e os fatores são desenhados.
+"""
+import math
+from functools import lru_cache
+
+from reportlab.graphics.shapes import Drawing, Group, Wedge, Line, Circle, Rect, String
+from reportlab.lib import colors
+
+GAUGE_BANDS = ['#ef4444', '#f97316', '#eab308', '#10b981']   # 0-25, 25-50, 50-75, 75-100
+GAUGE_WIDTH = 190
+GAUGE_RADIUS = 80
+POSITIVE = colors.HexColor('#10b981')
+NEGATIVE = colors.HexColor('#ef4444')
+
+
+@lru_cache(maxsize=8)
+def _gauge_template(height):
+    """Faixas coloridas, rótulos e título do medidor (estáticos)."""
+    cx, cy, r = GAUGE_WIDTH / 2, height * 0.35, GAUGE_RADIUS
+    g = Group()
+    step = 180 / len(GAUGE_BANDS)
+    for i, c in enumerate(GAUGE_BANDS):
+        g.add(Wedge(cx, cy, r, 180 - step * (i + 1), 180 - step * i,
+                    fillColor=colors.HexColor(c), fillOpacity=0.7, strokeColor=None))
+    g.add(String(cx, height - 14, 'Score da Empresa', textAnchor='middle',
+                 fontName='Helvetica-Bold', fontSize=11))
+    g.add(String(cx - r, cy - 12, 'MUITO ALTO', textAnchor='start', fontName='Helvetica', fontSize=7,
+                 fillColor=colors.HexColor('#ef4444')))
+    g.add(String(cx + r, cy - 12, 'BAIXO', textAnchor='end', fontName='Helvetica', fontSize=7,
+                 fillColor=colors.HexColor('#10b981')))
+    return g
+
+
+def _gauge(score_result, height):
+    score = max(0, min(100, score_result['score']))
+    cx, cy, r = GAUGE_WIDTH / 2, height * 0.35, GAUGE_RADIUS
+    ang = math.pi - (score / 100) * math.pi
+    g = Group(_gauge_template(height))
+    g.add(Line(cx, cy, cx + math.cos(ang) * r * 0.83, cy + math.sin(ang) * r * 0.83,
+               strokeColor=colors.black, strokeWidth=3, strokeLineCap=1))
+    g.add(Circle(cx, cy, 4, fillColor=colors.black, strokeColor=None))
+    g.add(String(cx, cy - 28, f"{score_result['score']}/100", textAnchor='middle',
+                 fontName='Helvetica-Bold', fontSize=16))
+    g.add(String(cx, cy - 46, score_result['risco'], textAnchor='middle',
+                 fontName='Helvetica-Bold', fontSize=12,
+                 fillColor=colors.HexColor(score_result['risco_color'])))
+    return g
+
+
+def _factors(reasons, x0, width, height):
+    """Barras horizontais com o impacto de cada fator no score (até 8)."""
+    reasons = reasons[:8]
+    labels = [r[1][:35] + '...' if len(r[1]) > 35 else r[1] for r in reasons]
+    values = [r[2] for r in reasons]
+
+    g = Group()
+    g.add(String(x0 + width / 2, height - 14, 'Fatores de Avaliação', textAnchor='middle',
+                 fontName='Helvetica-Bold', fontSize=11))
+    g.add(String(x0 + width / 2, 4, 'Impacto no Score', textAnchor='middle', fontName='Helvetica',
+                 fontSize=8))
+    if not values:
+        return g
+
+    px0, px1 = x0 + 130, x0 + width - 18
+    bottom, top = 30, height - 26
+    lo, hi = min(0, min(values)), max(0, max(values))
+    if hi == lo:
+        hi = lo + 1
+
+    def x(v):
+        return px0 + (v - lo) / (hi - lo) * (px1 - px0)
+
+    row = (top - bottom) / len(values)
+    for i, (label, v) in enumerate(zip(labels, values)):
+        y = top - row * (i + 1)
+        bar_h = row * 0.6
+        x_start, x_end = sorted((x(0), x(v)))
+        g.add(Rect(x_start, y + (row - bar_h) / 2, x_end - x_start, bar_h,
+                   fillColor=POSITIVE if v > 0 else NEGATIVE, fillOpacity=0.8, strokeColor=None))
+        g.add(String(px0 - 6, y + row / 2 - 2.5, label, textAnchor='end', fontName='Helvetica', fontSize=7))
+        # Valor sempre à direita (da barra ou do zero) para não encostar nos rótulos.
+        g.add(String(x_end + 2, y + row / 2 - 2.5, f"{v:+g}", fontName='Helvetica', fontSize=6,
+                     fillColor=colors.HexColor('#6b7280')))
+
+    g.add(Line(x(0), bottom, x(0), top, strokeColor=colors.black, strokeWidth=0.8))
+    g.add(Line(px0, bottom, px1, bottom, strokeColor=colors.HexColor('#9ca3af'), strokeWidth=0.5))
+    for v in sorted({lo, 0, hi}):
+        g.add(String(x(v), bottom - 9, f"{v:g}", textAnchor='middle', fontName='Helvetica', fontSize=6))
+    return g
+
+
+def score_charts(score_result, width, height):
+    """Medidor do score + gráfico de fatores lado a lado, como um Drawing (Flowable)."""
+    d = Drawing(width, height)
+    d.add(_gauge(score_result, height))
+    d.add(_factors(score_result.get('reasons', []), GAUGE_WIDTH + 10, width - GAUGE_WIDTH - 10, height))
+    return d
@@ -0,0 +1,18 @@
+"""
+Ponto de entrada dos processos filhos da simulação de política (app.simulate_policy).
+
+Os filhos nascem com 'spawn' e importam o app do zero. O pool roda iniciar()
+em cada filho antes da primeira tarefa: a variável marca o processo como filho
+para o import do app não rodar init_db nem retomar jobs, lotes e simulações
+como se fosse um servidor. Importar este módulo não muda nada no servidor.
+"""
+import os
+
+
+def iniciar():
+    os.environ['CREDITOIA_FILHO'] = '1'
+
+
+def simular_intervalo(*args):
+    import app
+    return app._simular_intervalo(*args)
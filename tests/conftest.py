@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# app.py abre o banco no import: aponta para uma pasta temporária e não retoma jobs.
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='creditoia-tests-'))
+os.environ.setdefault('FLASK_RUN_FROM_CLI', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
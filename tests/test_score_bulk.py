@@ -0,0 +1,231 @@
+"""
+Equivalência entre o score em massa (ScorePolicy.bulk + bulk_row), o score
+individual (calculate_score) e o calculate_score original, anterior à política
+declarativa, com a política padrão.
+"""
+import random
+import re
+from datetime import datetime
+
+import pytest
+
+import app
+
+POLITICA = app.ScorePolicy(app.DEFAULT_POLICY, 1)
+
+
+# Cópia congelada do calculate_score de antes do score em massa e da política
+# declarativa: a referência não passa pelas tabelas de DEFAULT_POLICY, então um
+# erro nelas não se esconde comparando o gerado com o NumPy.
+def calculate_score_original(company_data, judicial_data, social_data, valor_solicitado, capital_social):
+    score = 50  # base
+    reasons = []
+
+    # Situação cadastral
+    situacao = str(company_data.get('situacao_cadastral', '')).lower()
+    if 'ativa' in situacao:
+        score += 15
+        reasons.append(('✓', 'Empresa ativa na Receita Federal', +15))
+    else:
+        score -= 25
+        reasons.append(('✗', f'Situação cadastral irregular: {situacao}', -25))
+
+    # Tempo de empresa
+    try:
+        inicio = company_data.get('data_inicio_atividade', '') or company_data.get('abertura', '')
+        if inicio:
+            ano = int(str(inicio)[:4])
+            anos = datetime.now().year - ano
+            if anos >= 10:
+                score += 15
+                reasons.append(('✓', f'Empresa com {anos} anos de atividade', +15))
+            elif anos >= 5:
+                score += 8
+                reasons.append(('~', f'Empresa com {anos} anos de atividade', +8))
+            elif anos < 2:
+                score -= 10
+                reasons.append(('✗', f'Empresa jovem ({anos} anos)', -10))
+    except:
+        pass
+
+    # Capital social vs valor solicitado
+    try:
+        cap_str = str(capital_social or company_data.get('capital_social', '0'))
+        cap = float(re.sub(r'[^\d.,]', '', cap_str).replace(',', '.'))
+        if cap > 0 and valor_solicitado > 0:
+            ratio = cap / valor_solicitado
+            if ratio >= 2:
+                score += 12
+                reasons.append(('✓', f'Capital social ({cap:,.2f}) sólido vs valor solicitado', +12))
+            elif ratio >= 0.5:
+                score += 5
+                reasons.append(('~', f'Capital social adequado em relação ao crédito', +5))
+            else:
+                score -= 8
+                reasons.append(('✗', 'Capital social baixo para o crédito solicitado', -8))
+    except:
+        pass
+
+    # Porte
+    porte = str(company_data.get('porte_empresa', '') or company_data.get('porte', '')).lower()
+    if 'grande' in porte:
+        score += 10
+        reasons.append(('✓', 'Grande empresa', +10))
+    elif 'medio' in porte or 'média' in porte:
+        score += 5
+        reasons.append(('~', 'Empresa de médio porte', +5))
+    elif 'micro' in porte or 'mei' in porte:
+        score -= 3
+        reasons.append(('~', 'Microempresa/MEI', -3))
+
+    # Processos judiciais
+    proc_count = 0
+    if isinstance(judicial_data, dict):
+        hits = judicial_data.get('hits', {})
+        if isinstance(hits, dict):
+            proc_count = hits.get('total', {}).get('value', 0) if isinstance(hits.get('total'), dict) else int(hits.get('total', 0))
+    if proc_count > 10:
+        score -= 20
+        reasons.append(('✗', f'{proc_count} processos judiciais encontrados', -20))
+    elif proc_count > 3:
+        score -= 10
+        reasons.append(('~', f'{proc_count} processos judiciais encontrados', -10))
+    elif proc_count > 0:
+        score -= 3
+        reasons.append(('~', f'{proc_count} processo(s) judicial(is) encontrado(s)', -3))
+    else:
+        score += 8
+        reasons.append(('✓', 'Nenhum processo judicial identificado', +8))
+
+    # Social media issues
+    if social_data.get('controversias'):
+        score -= 10
+        reasons.append(('✗', 'Controvérsias identificadas nas redes sociais', -10))
+
+    score = max(0, min(100, score))
+    
+    # Risk level
+    if score >= 75:
+        risco = 'BAIXO'
+        risco_color = '#10b981'
+    elif score >= 50:
+        risco = 'MÉDIO'
+        risco_color = '#f59e0b'
+    elif score >= 30:
+        risco = 'ALTO'
+        risco_color = '#ef4444'
+    else:
+        risco = 'MUITO ALTO'
+        risco_color = '#dc2626'
+
+    # Suggested value
+    if score >= 75:
+        mult = 1.0
+    elif score >= 60:
+        mult = 0.8
+    elif score >= 45:
+        mult = 0.5
+    elif score >= 30:
+        mult = 0.25
+    else:
+        mult = 0.0
+
+    valor_sugerido = round(valor_solicitado * mult, 2)
+
+    return {
+        'score': score,
+        'risco': risco,
+        'risco_color': risco_color,
+        'valor_sugerido': valor_sugerido,
+        'multiplicador': mult,
+        'reasons': reasons
+    }
+
+
+def _original(company, judicial, social, valor):
+    return {**calculate_score_original(company, judicial, social, valor, company.get('capital_social', '0')),
+            'politica_versao': POLITICA.versao}
+
+
+def _individual(company, judicial, social, valor):
+    return app.calculate_score(company, judicial, social, valor, company.get('capital_social', '0'),
+                               politica=POLITICA)
+
+
+def _em_massa(casos):
+    feats = [app.score_features(c, j, s, c.get('capital_social', '0')) for c, j, s, _ in casos]
+    result = POLITICA.bulk(feats, [v for *_, v in casos], with_reasons=True)
+    return [POLITICA.bulk_row(result, i) for i in range(len(casos))]
+
+
+def _assert_equivalentes(casos):
+    for caso, bulk in zip(casos, _em_massa(casos)):
+        original = _original(*caso)
+        assert _individual(*caso) == original, caso
+        assert bulk == original, caso
+
+
+def _aleatorio(rnd):
+    company = {
+        'situacao_cadastral': rnd.choice(['ATIVA', 'Ativa', 'BAIXADA', '', 'inapta', None, 'INATIVA']),
+        rnd.choice(['data_inicio_atividade', 'abertura']):
+            rnd.choice(['2020-01-01', '2015-05-05', '2000-01-01', '2024-02-02', 'abcd', '', None, 2019, '1990']),
+        'capital_social': rnd.choice(['100000', '1.000,50', '5000.00', 'R$ 2.000', '0', '', 'abc',
+                                      300000.0, 1e7, None, '12,5', '-500']),
+        rnd.choice(['porte_empresa', 'porte']):
+            rnd.choice(['DEMAIS', 'Grande', 'MÉDIA EMPRESA', 'Média', 'medio', 'MICRO EMPRESA', 'MEI', '', None]),
+    }
+    judicial = rnd.choice([
+        {}, None, {'hits': []},
+        {'hits': {'total': {'value': rnd.choice([0, 1, 3, 4, 10, 11, 50])}}},
+        {'hits': {'total': rnd.choice([0, 2, 5, 12])}},
+    ])
+    social = {'controversias': rnd.random() < 0.2}
+    valor = rnd.choice([0, 1000, 12345.678, 50000, 0.005, 1e6, 333.335, -100,
+                        round(rnd.uniform(0, 1e6), 3)])
+    return company, judicial, social, valor
+
+
+def test_aleatorio():
+    rnd = random.Random(20240501)
+    _assert_equivalentes([_aleatorio(rnd) for _ in range(5000)])
+
+
+@pytest.mark.parametrize('company', [
+    {'situacao_cadastral': 'ATIVA', 'data_inicio_atividade': 'abcd', 'capital_social': 'abc'},
+    {'situacao_cadastral': 'ATIVA', 'abertura': '', 'capital_social': ''},
+    {'situacao_cadastral': 'ATIVA', 'data_inicio_atividade': None, 'capital_social': None},
+], ids=['texto', 'vazio', 'none'])
+def test_ano_e_capital_ilegiveis(company):
+    _assert_equivalentes([(company, {}, {}, v) for v in (0, 1000, 50000)])
+
+
+@pytest.mark.parametrize('valor', [0.005, 0.015, 333.335, 1000.125, 2.675, 1234.565])
+def test_meio_centavo(valor):
+    company = {'situacao_cadastral': 'ATIVA', 'data_inicio_atividade': '2000-01-01',
+               'capital_social': '1000000', 'porte': 'Grande'}
+    _assert_equivalentes([(company, {}, {}, valor)])
+
+
+@pytest.mark.parametrize('judicial', [
+    {'hits': {'total': 0}}, {'hits': {'total': 5}}, {'hits': {'total': 12}},
+    {'hits': {'total': {'value': 0}}}, {'hits': {'total': {'value': 4}}}, {'hits': {'total': {'value': 11}}},
+], ids=['int-0', 'int-5', 'int-12', 'dict-0', 'dict-4', 'dict-11'])
+def test_total_de_processos(judicial):
+    company = {'situacao_cadastral': 'ATIVA', 'data_inicio_atividade': '2010-01-01', 'capital_social': '50000'}
+    _assert_equivalentes([(company, judicial, {}, 10000)])
+
+
+@pytest.mark.parametrize('valor', [0, -1, -1000.5])
+def test_valor_zero_ou_negativo(valor):
+    company = {'situacao_cadastral': 'ATIVA', 'data_inicio_atividade': '2010-01-01', 'capital_social': '50000'}
+    _assert_equivalentes([(company, {}, {}, valor)])
+
+
+@pytest.mark.parametrize('company', [
+    {'data_inicio_atividade': '2010-01-01', 'capital_social': '50000'},
+    {'situacao_cadastral': None, 'capital_social': '50000'},
+    {},
+], ids=['ausente', 'none', 'vazia'])
+def test_sem_situacao(company):
+    _assert_equivalentes([(company, {}, {}, 10000)])